@@ -0,0 +1,51 @@
+"""create lookup indexes
+
+Revision ID: 0d0615b92104
+Revises: a7bdc40c7704
+Create Date: 2026-10-18 14:05:52.660184
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0d0615b92104'
+down_revision = 'a7bdc40c7704'
+branch_labels = None
+depends_on = None
+
+SCHEMA_NAME = 'metabase'
+
+
+def upgrade():
+    '''Index the ETL tables by data table.
+
+    Lookups of column level metadata and ranges by data_table_id or
+    (data_table_id, column_name) already use the primary keys, which start
+    with these columns, as do ETL lookups by workflow_id. The indexes hold all
+    columns of the ETL tables so lookups by data table are index only scans.
+
+    '''
+
+    op.create_index(
+        'etl_input_data_table_idx',
+        'etl_input',
+        ['data_table_id', 'workflow_id', 'etl_step'],
+        schema=SCHEMA_NAME,
+    )
+
+    op.create_index(
+        'etl_output_data_table_idx',
+        'etl_output',
+        ['data_table_id', 'workflow_id', 'etl_step'],
+        schema=SCHEMA_NAME,
+    )
+
+
+def downgrade():
+    '''Drop the ETL table indexes.'''
+
+    op.drop_index('etl_output_data_table_idx', 'etl_output',
+                  schema=SCHEMA_NAME)
+    op.drop_index('etl_input_data_table_idx', 'etl_input',
+                  schema=SCHEMA_NAME)
@@ -0,0 +1,64 @@
+"""create partition_profile
+
+Revision ID: 3f9a6d2e7b14
+Revises: 8d4b2f61c9a5
+Create Date: 2026-10-18 19:05:41.662310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a6d2e7b14'
+down_revision = '8d4b2f61c9a5'
+branch_labels = None
+depends_on = None
+
+SCHEMA_NAME = 'metabase'
+
+
+def upgrade():
+    '''Create the table of partition states at their last profiling.
+
+    The metadata of a partitioned data table is merged from the column
+    states of its partitions. A partition whose current state matches its
+    watermark has not changed, so its stored column states are merged
+    without profiling it again.
+
+    '''
+
+    op.create_table(
+        'partition_profile',
+        sa.Column('data_table_id', sa.Integer),
+        sa.Column('partition_name', sa.Text),
+        sa.Column('relfilenode', sa.BigInteger),
+        sa.Column('relation_size', sa.BigInteger),
+        sa.Column('n_tup_ins', sa.BigInteger),
+        sa.Column('n_tup_upd', sa.BigInteger),
+        sa.Column('n_tup_del', sa.BigInteger),
+        sa.Column('column_signature', sa.Text),
+        sa.Column('checksum', sa.Text),
+        sa.Column('column_states', postgresql.JSONB),
+        sa.Column('updated_by', sa.Text),
+        sa.Column('date_last_updated', sa.TIMESTAMP),
+        sa.PrimaryKeyConstraint('data_table_id', 'partition_name'),
+        schema=SCHEMA_NAME
+    )
+
+    op.create_foreign_key(
+        'partition_profile_data_table_fk',
+        'partition_profile',
+        'data_table',
+        ['data_table_id'],
+        ['data_table_id'],
+        source_schema=SCHEMA_NAME,
+        referent_schema=SCHEMA_NAME,
+    )
+
+
+def downgrade():
+    '''Drop the partition_profile table.'''
+
+    op.drop_table('partition_profile', schema=SCHEMA_NAME)
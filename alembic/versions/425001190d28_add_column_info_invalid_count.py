@@ -0,0 +1,37 @@
+"""add column_info invalid_count
+
+Revision ID: 425001190d28
+Revises: 9c4e7d1a2f58
+Create Date: 2026-10-18 23:52:41.318094
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '425001190d28'
+down_revision = '9c4e7d1a2f58'
+branch_labels = None
+depends_on = None
+
+SCHEMA_NAME = 'metabase'
+
+
+def upgrade():
+    '''Add the number of values that do not cast to column_info.
+
+    With a max_invalid_fraction, such values are tolerated in numeric and
+    date columns and left out of their metadata.
+
+    '''
+
+    op.add_column('column_info',
+                  sa.Column('invalid_count', sa.BigInteger),
+                  schema=SCHEMA_NAME)
+
+
+def downgrade():
+    '''Drop the number of invalid values from column_info.'''
+
+    op.drop_column('column_info', 'invalid_count', schema=SCHEMA_NAME)
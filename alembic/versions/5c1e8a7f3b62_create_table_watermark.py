@@ -0,0 +1,58 @@
+"""create table_watermark
+
+Revision ID: 5c1e8a7f3b62
+Revises: 0d0615b92104
+Create Date: 2026-10-18 16:22:37.418903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e8a7f3b62'
+down_revision = '0d0615b92104'
+branch_labels = None
+depends_on = None
+
+SCHEMA_NAME = 'metabase'
+
+
+def upgrade():
+    '''Create the table of data table states at their last profiling.
+
+    A data table whose current state matches its watermark has not changed
+    since it was profiled, so profiling it again can be skipped.
+
+    '''
+
+    op.create_table(
+        'table_watermark',
+        sa.Column('data_table_id', sa.Integer, primary_key=True),
+        sa.Column('relfilenode', sa.BigInteger),
+        sa.Column('relation_size', sa.BigInteger),
+        sa.Column('n_tup_ins', sa.BigInteger),
+        sa.Column('n_tup_upd', sa.BigInteger),
+        sa.Column('n_tup_del', sa.BigInteger),
+        sa.Column('column_signature', sa.Text),
+        sa.Column('checksum', sa.Text),
+        sa.Column('updated_by', sa.Text),
+        sa.Column('date_last_updated', sa.TIMESTAMP),
+        schema=SCHEMA_NAME
+    )
+
+    op.create_foreign_key(
+        'table_watermark_data_table_fk',
+        'table_watermark',
+        'data_table',
+        ['data_table_id'],
+        ['data_table_id'],
+        source_schema=SCHEMA_NAME,
+        referent_schema=SCHEMA_NAME,
+    )
+
+
+def downgrade():
+    '''Drop the table_watermark table.'''
+
+    op.drop_table('table_watermark', schema=SCHEMA_NAME)
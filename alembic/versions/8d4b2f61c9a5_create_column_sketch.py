@@ -0,0 +1,67 @@
+"""create column_sketch
+
+Revision ID: 8d4b2f61c9a5
+Revises: 5c1e8a7f3b62
+Create Date: 2026-10-18 17:48:03.127546
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '8d4b2f61c9a5'
+down_revision = '5c1e8a7f3b62'
+branch_labels = None
+depends_on = None
+
+SCHEMA_NAME = 'metabase'
+
+
+def upgrade():
+    '''Create the table of mergeable column states and add ID watermarks.
+
+    column_sketch keeps the counts, extremes and sketches from which the
+    column metadata is computed, so that the metadata of rows appended to a
+    data table can be merged in without scanning the table again. The
+    greatest value of an ID column in table_watermark identifies the rows
+    appended since.
+
+    '''
+
+    op.create_table(
+        'column_sketch',
+        sa.Column('data_table_id', sa.Integer),
+        sa.Column('column_name', sa.Text),
+        sa.Column('sketch', postgresql.JSONB),
+        sa.Column('updated_by', sa.Text),
+        sa.Column('date_last_updated', sa.TIMESTAMP),
+        sa.PrimaryKeyConstraint('data_table_id', 'column_name'),
+        schema=SCHEMA_NAME
+    )
+
+    op.create_foreign_key(
+        'column_sketch_column_info_fk',
+        'column_sketch',
+        'column_info',
+        ['data_table_id', 'column_name'],
+        ['data_table_id', 'column_name'],
+        source_schema=SCHEMA_NAME,
+        referent_schema=SCHEMA_NAME,
+    )
+
+    op.add_column('table_watermark',
+                  sa.Column('id_column', sa.Text),
+                  schema=SCHEMA_NAME)
+    op.add_column('table_watermark',
+                  sa.Column('max_id', sa.Text),
+                  schema=SCHEMA_NAME)
+
+
+def downgrade():
+    '''Drop column_sketch and the ID watermarks.'''
+
+    op.drop_column('table_watermark', 'max_id', schema=SCHEMA_NAME)
+    op.drop_column('table_watermark', 'id_column', schema=SCHEMA_NAME)
+    op.drop_table('column_sketch', schema=SCHEMA_NAME)
@@ -0,0 +1,39 @@
+"""add watermark options_hash
+
+Revision ID: 9c4e7d1a2f58
+Revises: e2a7c41f8b36
+Create Date: 2026-10-18 23:14:08.536201
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4e7d1a2f58'
+down_revision = 'e2a7c41f8b36'
+branch_labels = None
+depends_on = None
+
+SCHEMA_NAME = 'metabase'
+
+
+def upgrade():
+    '''Record the profiling options with the watermarks.
+
+    A table profiled again with options that change its metadata, e.g. a
+    different categorical threshold, must not be skipped as unchanged.
+
+    '''
+
+    for table in ('table_watermark', 'partition_profile'):
+        op.add_column(table,
+                      sa.Column('options_hash', sa.Text),
+                      schema=SCHEMA_NAME)
+
+
+def downgrade():
+    '''Drop the options_hash columns.'''
+
+    for table in ('table_watermark', 'partition_profile'):
+        op.drop_column(table, 'options_hash', schema=SCHEMA_NAME)
@@ -0,0 +1,32 @@
+"""add column_info null_count
+
+Revision ID: a7bdc40c7704
+Revises: ba742ea32e7a
+Create Date: 2026-10-18 12:41:19.207763
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7bdc40c7704'
+down_revision = 'ba742ea32e7a'
+branch_labels = None
+depends_on = None
+
+SCHEMA_NAME = 'metabase'
+
+
+def upgrade():
+    '''Add the number of null values to column_info.'''
+
+    op.add_column('column_info',
+                  sa.Column('null_count', sa.BigInteger),
+                  schema=SCHEMA_NAME)
+
+
+def downgrade():
+    '''Drop the number of null values from column_info.'''
+
+    op.drop_column('column_info', 'null_count', schema=SCHEMA_NAME)
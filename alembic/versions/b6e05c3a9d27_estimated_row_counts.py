@@ -0,0 +1,49 @@
+"""estimated row counts
+
+Revision ID: b6e05c3a9d27
+Revises: 3f9a6d2e7b14
+Create Date: 2026-10-18 20:12:09.514872
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6e05c3a9d27'
+down_revision = '3f9a6d2e7b14'
+branch_labels = None
+depends_on = None
+
+SCHEMA_NAME = 'metabase'
+
+
+def upgrade():
+    '''Record estimated row counts and total sizes of data tables.
+
+    number_rows may be estimated from the catalog instead of counted, which
+    number_rows_estimated records. It becomes a BIGINT, as the tables whose
+    rows are too many to count hold more than 2^31 rows. total_size adds the
+    TOAST data and indexes of the table to its size.
+
+    '''
+
+    op.alter_column('data_table', 'number_rows',
+                    type_=sa.BigInteger,
+                    schema=SCHEMA_NAME)
+    op.add_column('data_table',
+                  sa.Column('number_rows_estimated', sa.Boolean),
+                  schema=SCHEMA_NAME)
+    op.add_column('data_table',
+                  sa.Column('total_size', sa.BigInteger),
+                  schema=SCHEMA_NAME)
+
+
+def downgrade():
+    '''Drop the estimated flag and total size, and restore number_rows.'''
+
+    op.drop_column('data_table', 'total_size', schema=SCHEMA_NAME)
+    op.drop_column('data_table', 'number_rows_estimated', schema=SCHEMA_NAME)
+    op.alter_column('data_table', 'number_rows',
+                    type_=sa.Integer,
+                    schema=SCHEMA_NAME)
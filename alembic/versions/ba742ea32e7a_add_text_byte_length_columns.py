@@ -0,0 +1,45 @@
+"""add text byte length columns
+
+Revision ID: ba742ea32e7a
+Revises: ec6cd9b43064
+Create Date: 2026-10-18 11:20:05.831442
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'ba742ea32e7a'
+down_revision = 'ec6cd9b43064'
+branch_labels = None
+depends_on = None
+
+SCHEMA_NAME = 'metabase'
+
+
+def upgrade():
+    '''Add byte lengths and a length histogram to text_column.'''
+
+    op.add_column('text_column',
+                  sa.Column('max_byte_length', sa.Integer),
+                  schema=SCHEMA_NAME)
+    op.add_column('text_column',
+                  sa.Column('min_byte_length', sa.Integer),
+                  schema=SCHEMA_NAME)
+    op.add_column('text_column',
+                  sa.Column('total_byte_length', sa.BigInteger),
+                  schema=SCHEMA_NAME)
+    op.add_column('text_column',
+                  sa.Column('length_histogram', postgresql.JSONB),
+                  schema=SCHEMA_NAME)
+
+
+def downgrade():
+    '''Drop byte lengths and the length histogram from text_column.'''
+
+    op.drop_column('text_column', 'length_histogram', schema=SCHEMA_NAME)
+    op.drop_column('text_column', 'total_byte_length', schema=SCHEMA_NAME)
+    op.drop_column('text_column', 'min_byte_length', schema=SCHEMA_NAME)
+    op.drop_column('text_column', 'max_byte_length', schema=SCHEMA_NAME)
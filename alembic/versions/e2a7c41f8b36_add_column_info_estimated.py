@@ -0,0 +1,37 @@
+"""add column_info estimated
+
+Revision ID: e2a7c41f8b36
+Revises: b6e05c3a9d27
+Create Date: 2026-10-18 21:03:55.208417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a7c41f8b36'
+down_revision = 'b6e05c3a9d27'
+branch_labels = None
+depends_on = None
+
+SCHEMA_NAME = 'metabase'
+
+
+def upgrade():
+    '''Mark columns whose metadata is estimated from planner statistics.
+
+    The estimate covers the column_info row and the numeric_column,
+    date_column or code_frequency rows of the column.
+
+    '''
+
+    op.add_column('column_info',
+                  sa.Column('estimated', sa.Boolean),
+                  schema=SCHEMA_NAME)
+
+
+def downgrade():
+    '''Drop the estimated column of column_info.'''
+
+    op.drop_column('column_info', 'estimated', schema=SCHEMA_NAME)
@@ -0,0 +1,55 @@
+"""create try cast functions
+
+Revision ID: e317fcf0a31a
+Revises: 0fbe9f4e9934
+Create Date: 2026-10-18 09:12:31.402117
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e317fcf0a31a'
+down_revision = '0fbe9f4e9934'
+branch_labels = None
+depends_on = None
+
+SCHEMA_NAME = 'metabase'
+
+
+def upgrade():
+    '''Create functions that return NULL instead of failing a cast.'''
+
+    op.execute(
+        """
+        CREATE FUNCTION {schema}.try_cast_numeric(value TEXT)
+        RETURNS NUMERIC AS $$
+        BEGIN
+            RETURN value::NUMERIC;
+        EXCEPTION WHEN data_exception THEN
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql IMMUTABLE;
+        """.format(schema=SCHEMA_NAME)
+    )
+
+    # Not immutable: date input depends on the DateStyle setting.
+    op.execute(
+        """
+        CREATE FUNCTION {schema}.try_cast_date(value TEXT)
+        RETURNS DATE AS $$
+        BEGIN
+            RETURN value::DATE;
+        EXCEPTION WHEN data_exception THEN
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql STABLE;
+        """.format(schema=SCHEMA_NAME)
+    )
+
+
+def downgrade():
+    '''Drop try cast functions.'''
+
+    op.execute('DROP FUNCTION {}.try_cast_date(TEXT)'.format(SCHEMA_NAME))
+    op.execute('DROP FUNCTION {}.try_cast_numeric(TEXT)'.format(SCHEMA_NAME))
@@ -0,0 +1,52 @@
+"""add percentile columns
+
+Revision ID: ec6cd9b43064
+Revises: e317fcf0a31a
+Create Date: 2026-10-18 10:02:47.518330
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ec6cd9b43064'
+down_revision = 'e317fcf0a31a'
+branch_labels = None
+depends_on = None
+
+SCHEMA_NAME = 'metabase'
+
+PERCENTS = (1, 5, 25, 75, 95, 99)
+
+
+def upgrade():
+    '''Add percentiles to numeric_column and text_column.'''
+
+    for percent in PERCENTS:
+        op.add_column(
+            'numeric_column',
+            sa.Column('percentile_{}'.format(percent), sa.Numeric),
+            schema=SCHEMA_NAME,
+        )
+        op.add_column(
+            'text_column',
+            sa.Column('percentile_{}_length'.format(percent), sa.Numeric),
+            schema=SCHEMA_NAME,
+        )
+
+
+def downgrade():
+    '''Drop percentiles from numeric_column and text_column.'''
+
+    for percent in PERCENTS:
+        op.drop_column(
+            'numeric_column',
+            'percentile_{}'.format(percent),
+            schema=SCHEMA_NAME,
+        )
+        op.drop_column(
+            'text_column',
+            'percentile_{}_length'.format(percent),
+            schema=SCHEMA_NAME,
+        )
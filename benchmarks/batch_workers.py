@@ -0,0 +1,100 @@
+"""Benchmark process_tables with worker threads against worker processes.
+
+Usage:
+
+    python benchmarks/batch_workers.py postgresql://user@host/scratch_db
+
+The database must be an empty scratch database: the script creates the
+``metabase`` and ``data`` schemas, migrates the metabase to the latest
+revision, creates synthetic numeric tables and profiles all of them with
+``process_tables``, first with worker threads, then with worker processes.
+With estimated quantiles, every numeric value updates a KLL sketch on the
+client, so threads are bound by the GIL while processes use one core each.
+Run it from the root of the repository so that alembic finds its scripts.
+
+"""
+
+import sys
+import time
+
+from alembic import command
+from alembic.config import Config
+import sqlalchemy
+
+from metabase import batch
+
+
+############################################
+# Change here.
+############################################
+n_tables = 8
+n_columns = 5              # Numeric columns per table.
+n_rows = 200000            # Rows per table.
+workers = 4
+############################################
+
+
+def migrate(connection_string):
+    """Upgrade the metabase to the latest revision."""
+
+    alembic_cfg = Config()
+    alembic_cfg.set_main_option('script_location', 'alembic')
+    alembic_cfg.set_main_option('sqlalchemy.url', connection_string)
+    command.upgrade(alembic_cfg, 'head')
+
+
+def load(engine):
+    """Create the data tables and their Data Table rows."""
+
+    engine.execute('CREATE SCHEMA data')
+    for i in range(1, n_tables + 1):
+        engine.execute("""
+            CREATE TABLE data.table_{i} AS
+            SELECT {columns}
+            FROM generate_series(1, {n_rows}) AS i;
+
+            INSERT INTO metabase.data_table (data_table_id, file_table_name)
+            VALUES ({i}, 'data.table_{i}');
+        """.format(
+            i=i,
+            columns=', '.join('random() * i AS c_{}'.format(j)
+                              for j in range(n_columns)),
+            n_rows=n_rows,
+        ))
+
+
+def time_batch(connection_string, processes):
+    """Return the wall time of profiling all tables, in seconds."""
+
+    start = time.perf_counter()
+    results = batch.process_tables(
+        list(range(1, n_tables + 1)),
+        workers=workers,
+        processes=processes,
+        metabase_connection_string=connection_string,
+        data_connection_string=connection_string,
+    )
+    seconds = time.perf_counter() - start
+
+    failures = [result for result in results if not result.success]
+    if failures:
+        raise failures[0].error
+
+    return seconds
+
+
+def main(connection_string):
+    engine = sqlalchemy.create_engine(connection_string)
+    engine.execute(sqlalchemy.schema.CreateSchema('metabase'))
+
+    migrate(connection_string)
+    load(engine)
+
+    print('{:<12} {:>12}'.format('workers', 'seconds'))
+    for name, processes in [('threads', False), ('processes', True)]:
+        print('{:<12} {:>12.2f}'.format(
+            name, time_batch(connection_string, processes)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
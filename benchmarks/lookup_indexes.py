@@ -0,0 +1,134 @@
+"""Benchmark metabase lookups before and after the lookup indexes.
+
+Usage:
+
+    python benchmarks/lookup_indexes.py postgresql://user@host/scratch_db
+
+The database must be an empty scratch database: the script creates the
+``metabase`` schema, migrates it to the revision before the lookup indexes,
+fills it with synthetic rows and times lookups by data table, then migrates to
+the lookup indexes and times the same lookups again. Run it from the root of
+the repository so that alembic finds its scripts.
+
+"""
+
+import random
+import statistics
+import sys
+import time
+
+from alembic import command
+from alembic.config import Config
+import sqlalchemy
+
+
+############################################
+# Change here.
+############################################
+n_data_tables = 20000
+n_columns = 20             # Column info rows per data table.
+n_workflows = 2000
+n_etl_rows = 200000        # Rows in each of etl_input and etl_output.
+n_lookups = 500
+############################################
+
+BEFORE_REVISION = 'a7bdc40c7704'
+AFTER_REVISION = '0d0615b92104'
+
+# Lookup name -> (query, number of ids to look up).
+LOOKUPS = {
+    'etl_input by data_table_id': (
+        'SELECT * FROM metabase.etl_input WHERE data_table_id = %(id)s',
+        n_data_tables,
+    ),
+    'etl_output by data_table_id': (
+        'SELECT * FROM metabase.etl_output WHERE data_table_id = %(id)s',
+        n_data_tables,
+    ),
+    'etl_input by workflow_id': (
+        'SELECT * FROM metabase.etl_input WHERE workflow_id = %(id)s',
+        n_workflows,
+    ),
+    'column_info by data_table_id': (
+        'SELECT * FROM metabase.column_info WHERE data_table_id = %(id)s',
+        n_data_tables,
+    ),
+}
+
+
+def migrate(connection_string, revision):
+    """Upgrade the metabase to a revision."""
+
+    alembic_cfg = Config()
+    alembic_cfg.set_main_option('script_location', 'alembic')
+    alembic_cfg.set_main_option('sqlalchemy.url', connection_string)
+    command.upgrade(alembic_cfg, revision)
+
+
+def load(engine):
+    """Fill the metabase with synthetic rows."""
+
+    engine.execute("""
+        INSERT INTO metabase.data_table (data_table_id, file_table_name)
+        SELECT i, 'data.table_' || i
+        FROM generate_series(1, {n_data_tables}) AS i;
+
+        INSERT INTO metabase.column_info (data_table_id, column_name)
+        SELECT i, 'column_' || j
+        FROM generate_series(1, {n_data_tables}) AS i,
+            generate_series(1, {n_columns}) AS j;
+    """.format(n_data_tables=n_data_tables, n_columns=n_columns))
+
+    for table in ['etl_input', 'etl_output']:
+        engine.execute("""
+            INSERT INTO metabase.{table} (workflow_id, etl_step, data_table_id)
+            SELECT DISTINCT
+                1 + mod(i, {n_workflows}),
+                1 + mod(i / {n_workflows}, 10),
+                1 + mod(i * 7919, {n_data_tables})
+            FROM generate_series(1, {n_etl_rows}) AS i;
+            ANALYZE metabase.{table};
+        """.format(table=table, n_workflows=n_workflows,
+                   n_data_tables=n_data_tables, n_etl_rows=n_etl_rows))
+
+    engine.execute('ANALYZE metabase.column_info')
+
+
+def time_lookups(engine):
+    """Return the median latency of each lookup in milliseconds."""
+
+    random.seed(0)
+    latencies = {}
+    with engine.connect() as conn:
+        for name, (query, n_ids) in LOOKUPS.items():
+            times = []
+            for _ in range(n_lookups):
+                start = time.perf_counter()
+                conn.execute(query, {'id': random.randint(1, n_ids)})
+                times.append(time.perf_counter() - start)
+            latencies[name] = 1000 * statistics.median(times)
+
+    return latencies
+
+
+def main(connection_string):
+    engine = sqlalchemy.create_engine(connection_string)
+    engine.execute(sqlalchemy.schema.CreateSchema('metabase'))
+
+    migrate(connection_string, BEFORE_REVISION)
+    load(engine)
+    before = time_lookups(engine)
+
+    migrate(connection_string, AFTER_REVISION)
+    engine.execute('ANALYZE metabase.etl_input; ANALYZE metabase.etl_output')
+    after = time_lookups(engine)
+
+    print('{:<30} {:>12} {:>12}'.format('median latency (ms)', 'before',
+                                        'after'))
+    for name in LOOKUPS:
+        print('{:<30} {:>12.3f} {:>12.3f}'.format(name, before[name],
+                                                  after[name]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
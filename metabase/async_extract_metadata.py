@@ -0,0 +1,758 @@
+"""Extract metadata from many Data Tables on one asyncio event loop.
+
+The connections use the asynchronous mode of psycopg2, waiting for query
+results on the event loop instead of blocking a thread, so that one thread
+keeps the queries of many tables in flight. The queries and the metadata
+written to the metabase are the same as ``ExtractMetadata``'s.
+
+Example:
+
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(process_tables(data_table_ids))
+
+"""
+
+import asyncio
+import functools
+import time
+
+import psycopg2
+from psycopg2 import extensions, sql
+
+from . import settings
+from . import extract_metadata_helper
+from .batch import TableResult
+from .write_session import TABLE_ORDER, WriteSession
+
+
+class AsyncConnection():
+    """psycopg2 connection in asynchronous mode driven by the event loop.
+
+    Each statement runs in autocommit mode unless a transaction is opened
+    explicitly with ``BEGIN``. Only one query runs on a connection at a time.
+
+    """
+
+    def __init__(self, conn):
+        """Wrap a psycopg2 connection opened with ``async_=True``."""
+        self.conn = conn
+        self.cursor = conn.cursor()
+
+    @classmethod
+    async def connect(cls, connection_string):
+        """Open an asynchronous connection.
+
+        Returns:
+            AsyncConnection: Open connection.
+
+        """
+
+        conn = psycopg2.connect(connection_string, async_=True)
+        try:
+            await wait(conn)
+        except Exception:
+            conn.close()
+            raise
+
+        return cls(conn)
+
+    @property
+    def closed(self):
+        """True if the connection is closed or broken."""
+        return bool(self.conn.closed)
+
+    async def execute(self, query, params=None):
+        """Run a query.
+
+        Returns:
+            cursor: psycopg2 cursor to fetch the result from.
+
+        """
+
+        self.cursor.execute(query, params)
+        await wait(self.conn)
+
+        return self.cursor
+
+    async def fetch_batches(self, query, on_rows, name,
+                            itersize=extract_metadata_helper.ITERSIZE):
+        """Stream the result of a query in batches of ``itersize`` rows.
+
+        Named cursors are not available in asynchronous mode, so the query
+        is declared as a cursor. Outside a transaction, it is declared in a
+        transaction that is rolled back at the end. Otherwise it is
+        declared in the current transaction and closed at the end.
+
+        Args:
+            on_rows (function): Called with each list of rows. It may be a
+                coroutine function. Fetching stops early if it returns True.
+            name (str): Name of the cursor.
+
+        """
+
+        in_transaction = (self.conn.get_transaction_status()
+                          != extensions.TRANSACTION_STATUS_IDLE)
+        if not in_transaction:
+            await self.execute('BEGIN')
+        try:
+            await self.execute(
+                sql.SQL('DECLARE {} NO SCROLL CURSOR FOR {}').format(
+                    sql.Identifier(name), query))
+            while True:
+                rows = (await self.execute(
+                    sql.SQL('FETCH {} FROM {}').format(
+                        sql.Literal(itersize), sql.Identifier(name))
+                )).fetchall()
+                if not rows:
+                    break
+                stop = on_rows(rows)
+                if asyncio.iscoroutine(stop):
+                    stop = await stop
+                if stop:
+                    break
+        finally:
+            if self.closed:
+                pass
+            elif not in_transaction:
+                await self.execute('ROLLBACK')
+            elif (self.conn.get_transaction_status()
+                  == extensions.TRANSACTION_STATUS_INTRANS):
+                await self.execute(
+                    sql.SQL('CLOSE {}').format(sql.Identifier(name)))
+
+    def close(self):
+        """Close the connection."""
+
+        self.conn.close()
+
+
+async def run_steps(conn, steps, itersize=extract_metadata_helper.ITERSIZE):
+    """Execute the requests of a steps generator on an async connection.
+
+    See ``extract_metadata_helper.run_steps``.
+
+    Args:
+        conn (AsyncConnection): Connection in autocommit mode.
+
+    Returns:
+        The return value of the generator.
+
+    """
+
+    result = None
+    error = None
+    while True:
+        try:
+            if error is None:
+                request = steps.send(result)
+            else:
+                request = steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+
+        try:
+            result = await execute_request(conn, request, itersize)
+            error = None
+        except Exception as request_error:
+            result = None
+            error = request_error
+
+
+async def execute_request(conn, request,
+                          itersize=extract_metadata_helper.ITERSIZE):
+    """Execute a request of a steps generator, see ``run_steps``."""
+
+    helper = extract_metadata_helper
+    if isinstance(request, helper.FetchBatches):
+        await conn.fetch_batches(request.query, request.on_rows,
+                                 request.name, itersize)
+        return None
+
+    if isinstance(request, helper.Succeeds):
+        try:
+            await conn.execute(request.query)
+        except psycopg2.DataError:
+            return False
+        return True
+
+    cursor = await conn.execute(request.query)
+    if isinstance(request, helper.FetchOne):
+        return cursor.fetchone()
+    return cursor.fetchall()
+
+
+async def wait(conn):
+    """Wait on the event loop until the pending operation of ``conn`` ends.
+
+    Raises the psycopg2 exception of a failed query, as a blocking
+    connection would.
+
+    """
+
+    loop = asyncio.get_event_loop()
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+
+        ready = loop.create_future()
+        fileno = conn.fileno()
+        if state == extensions.POLL_READ:
+            loop.add_reader(fileno, ready.set_result, None)
+            try:
+                await ready
+            finally:
+                loop.remove_reader(fileno)
+        elif state == extensions.POLL_WRITE:
+            loop.add_writer(fileno, ready.set_result, None)
+            try:
+                await ready
+            finally:
+                loop.remove_writer(fileno)
+        else:
+            raise psycopg2.OperationalError(
+                'Unexpected poll state: {}'.format(state))
+
+
+class AsyncWriteSession(WriteSession):
+    """``WriteSession`` flushed on an ``AsyncConnection``.
+
+    Rows of a query on the data database can be added with
+    ``add_fetched_rows``, in place of the iterables of ``add_rows``, which
+    cannot wait on the event loop.
+
+    """
+
+    def __init__(self, metabase_conn):
+        """Create an empty session.
+
+        Args:
+            metabase_conn (AsyncConnection): Connection to the metabase.
+
+        """
+        super().__init__(metabase_conn)
+        self.fetched_rows = []
+
+    def add_fetched_rows(self, table, data_conn, query, read_rows,
+                         itersize=extract_metadata_helper.ITERSIZE):
+        """Add the rows of a query, fetched in batches by ``flush``.
+
+        Each batch is written before the next one is fetched, so that only
+        ``itersize`` rows of the query are in memory at a time. The rows are
+        inserted after all other rows.
+
+        Args:
+            table (str): Table name, one of ``TABLE_ORDER``.
+            data_conn (AsyncConnection): Connection to run the query on. It
+                may be the connection to the metabase.
+            query (sql.Composable): Query on the data database.
+            read_rows (function): Returns the rows for ``table``, as for
+                ``add``, from a list of rows of the query.
+
+        """
+
+        if table not in TABLE_ORDER:
+            raise ValueError('Unknown metabase table: {}'.format(table))
+
+        self.fetched_rows.append((table, data_conn, query, read_rows,
+                                  itersize))
+
+    async def flush(self):
+        """Upsert all buffered rows in a single transaction.
+
+        Returns:
+            float: Seconds spent committing the transaction.
+
+        """
+
+        await self.metabase_conn.execute('BEGIN')
+        try:
+            for query, params in self.statements():
+                await self.metabase_conn.execute(query, params)
+
+            for table, data_conn, query, read_rows, itersize in (
+                    self.fetched_rows):
+                async def write_rows(rows):
+                    for statement in self.upsert_statements(
+                            table, read_rows(rows)):
+                        await self.metabase_conn.execute(*statement)
+
+                await data_conn.fetch_batches(query, write_rows,
+                                              'fetched_rows', itersize)
+
+            start = time.perf_counter()
+            await self.metabase_conn.execute('COMMIT')
+            self.commit_latency = time.perf_counter() - start
+        except Exception:
+            if not self.metabase_conn.closed:
+                await self.metabase_conn.execute('ROLLBACK')
+            self.close_streams()
+            self.fetched_rows = []
+            raise
+
+        self.queries = []
+        self.rows = {}
+        self.streams = {}
+        self.fetched_rows = []
+
+        return self.commit_latency
+
+
+# Column type -> function adding the metadata of a column to the session.
+UPDATES = {
+    'numeric': extract_metadata_helper.update_numeric,
+    'text': extract_metadata_helper.update_text,
+    'date': extract_metadata_helper.update_date,
+    'code': extract_metadata_helper.update_code,
+}
+
+
+class AsyncExtractMetadata():
+    """Extract metadata from a Data Table on asynchronous connections.
+
+    Runs the table level and column level steps of ``ExtractMetadata``, with
+    the same queries, and writes the same rows to the metabase.
+
+    """
+
+    def __init__(self, data_table_id, metabase_conn, data_conn):
+        """Set Data Table ID and connections.
+
+        Args:
+           data_table_id (int): ID associated with this Data Table.
+           metabase_conn (AsyncConnection): Connection to the metabase.
+           data_conn (AsyncConnection): Connection to the data database. It
+               may be ``metabase_conn``.
+
+        """
+        self.data_table_id = data_table_id
+        self.metabase_conn = metabase_conn
+        self.data_conn = data_conn
+
+        # Column level metadata is written in one transaction per table.
+        self.write_session = AsyncWriteSession(metabase_conn)
+        # Seconds spent committing the column level metadata.
+        self.commit_latency = None
+        # True if process_table found the table unchanged and skipped it.
+        self.skipped = False
+
+        self.schema_name = None
+        self.table_name = None
+
+    async def process_table(self, categorical_threshold=10,
+                            sample_percent=None, sample_method='SYSTEM',
+                            max_invalid_fraction=0, exact_quantiles=False,
+                            itersize=extract_metadata_helper.ITERSIZE,
+                            skip_unchanged=False, checksum=False,
+                            store_sketches=False, id_column=None,
+                            estimate_rows=False, statistics_only=False):
+        """Update the metabase with metadata from this Data Table.
+
+        Takes the arguments of ``ExtractMetadata.process_table`` except
+        ``column_workers``: concurrency comes from processing many tables at
+        a time instead. As in ``ExtractMetadata``, code frequencies are
+        written to the metabase ``itersize`` at a time as they are fetched.
+        Appended rows and partitions are only processed by
+        ``ExtractMetadata``.
+
+        """
+
+        if id_column is not None and not store_sketches:
+            raise ValueError('id_column requires store_sketches.')
+        if id_column is not None and (estimate_rows or statistics_only):
+            raise ValueError('id_column requires an exact row count.')
+        if store_sketches and (exact_quantiles or statistics_only):
+            raise ValueError('Sketches require estimated quantiles from '
+                             'a scan.')
+
+        self.schema_name, self.table_name = await self._get_table_name()
+
+        watermark = extract_metadata_helper.read_table_watermark(
+            (await self.data_conn.execute(
+                *extract_metadata_helper.table_watermark_query(
+                    self.schema_name, self.table_name, checksum)
+            )).fetchone()
+        )
+        watermark['options_hash'] = extract_metadata_helper.hash_options(
+            categorical_threshold, sample_percent, sample_method,
+            max_invalid_fraction, exact_quantiles, store_sketches,
+            id_column, estimate_rows)
+        if skip_unchanged:
+            stored_watermark = extract_metadata_helper.read_table_watermark(
+                (await self.metabase_conn.execute(
+                    *extract_metadata_helper.stored_watermark_query(
+                        self.data_table_id)
+                )).fetchone()
+            )
+            if extract_metadata_helper.is_unchanged(stored_watermark,
+                                                    watermark):
+                self.skipped = True
+                return
+
+        if estimate_rows or statistics_only:
+            await self.data_conn.execute(
+                extract_metadata_helper.analyze_table_query(
+                    self.schema_name, self.table_name))
+
+        # No watermark is stored with estimated metadata, see
+        # ``ExtractMetadata.process_table``.
+        if statistics_only:
+            await self._get_statistics_metadata(categorical_threshold)
+            return
+
+        max_id = None
+        condition = None
+        if id_column is not None:
+            max_id = (await self.data_conn.execute(
+                extract_metadata_helper.max_id_query(
+                    id_column, self.schema_name, self.table_name)
+            )).fetchone()[0]
+            condition = extract_metadata_helper.id_range_condition(
+                id_column, None, max_id)
+
+        extract_metadata_helper.update_table_watermark(
+            self.write_session, self.data_table_id, watermark, id_column,
+            max_id)
+
+        await self._get_table_level_metadata(condition, estimate_rows)
+        await self._get_column_level_metadata(categorical_threshold,
+                                              sample_percent,
+                                              sample_method,
+                                              max_invalid_fraction,
+                                              exact_quantiles,
+                                              itersize,
+                                              store_sketches,
+                                              condition)
+
+    async def _get_table_name(self):
+        """Return the the table schema and name using the Data Table ID.
+
+        Returns:
+            (str, str): (schema name, table name)
+
+        """
+
+        result = (await self.metabase_conn.execute(
+            """
+            SELECT file_table_name
+            FROM metabase.data_table
+            WHERE data_table_id = %(data_table_id)s;
+            """,
+            {'data_table_id': self.data_table_id},
+        )).fetchone()
+
+        if result is None:
+            raise ValueError('data_table_id not found in metabase.data_table')
+
+        return extract_metadata_helper.split_file_table_name(result[0])
+
+    async def _get_table_level_metadata(self, condition=None,
+                                        estimate_rows=False):
+        """Extract table level metadata and add it to the write session.
+
+        See ``ExtractMetadata._get_table_level_metadata``.
+
+        Returns:
+            int: Number of rows.
+
+        """
+
+        n_rows, n_cols, table_size, total_size = (
+            await self.data_conn.execute(
+                *extract_metadata_helper.table_level_metadata_query(
+                    self.schema_name,
+                    self.table_name,
+                    'estimate' if estimate_rows else 'exact',
+                    condition,
+                )
+            )
+        ).fetchone()
+
+        if n_rows == 0:
+            raise ValueError('Selected data table has 0 rows.')
+
+        self.write_session.add_statement(
+            *extract_metadata_helper.update_data_table_query(
+                self.data_table_id, n_rows, n_cols, table_size, total_size,
+                estimate_rows))
+
+        return n_rows
+
+    async def _get_statistics_metadata(self, categorical_threshold):
+        """Estimate all metadata from statistics and store it in the metabase.
+
+        See ``ExtractMetadata._get_statistics_metadata``.
+
+        """
+
+        n_rows = await self._get_table_level_metadata(estimate_rows=True)
+
+        declared_types = await self._get_declared_column_types()
+        column_types, column_metadata = await run_steps(
+            self.data_conn,
+            extract_metadata_helper.get_statistics_metadata_steps(
+                declared_types,
+                extract_metadata_helper.read_column_statistics(
+                    (await self.data_conn.execute(
+                        *extract_metadata_helper.column_statistics_query(
+                            self.schema_name, self.table_name)
+                    )).fetchall()
+                ),
+                n_rows,
+                categorical_threshold,
+            ),
+        )
+
+        for (col, _) in declared_types:
+            if column_types[col] == 'text':
+                extract_metadata_helper.update_column_info(
+                    self.write_session, col, self.data_table_id, 'text',
+                    column_metadata[col]['null_count'], estimated=True)
+            else:
+                UPDATES[column_types[col]](self.write_session, col,
+                                           self.data_table_id,
+                                           column_metadata[col])
+
+        self.commit_latency = await self.write_session.flush()
+
+    async def _get_declared_column_types(self):
+        """Return the columns of the data table and their declared types.
+
+        See ``extract_metadata_helper.get_declared_column_types``.
+
+        """
+
+        return extract_metadata_helper.read_declared_column_types(
+            (await self.data_conn.execute(
+                *extract_metadata_helper.declared_column_types_query(
+                    self.schema_name, self.table_name)
+            )).fetchall()
+        )
+
+    async def _get_column_level_metadata(
+            self, categorical_threshold, sample_percent=None,
+            sample_method='SYSTEM', max_invalid_fraction=0,
+            exact_quantiles=False, itersize=extract_metadata_helper.ITERSIZE,
+            store_sketches=False, condition=None):
+        """Extract column level metadata and store it in the metabase.
+
+        See ``ExtractMetadata._get_column_level_metadata``.
+
+        """
+
+        # See ``extract_metadata_helper.use_try_cast``.
+        try_cast = bool(max_invalid_fraction)
+        if try_cast and not (await self.data_conn.execute(
+                extract_metadata_helper.TRY_CAST_FUNCTIONS_QUERY
+        )).fetchone()[0]:
+            raise ValueError('max_invalid_fraction requires the try cast '
+                             'functions in the data database.')
+
+        declared_types = await self._get_declared_column_types()
+        column_names = [col for (col, _) in declared_types]
+
+        column_types = {col: column_type
+                        for (col, column_type) in declared_types
+                        if column_type is not None}
+        untyped_column_names = [col for col in column_names
+                                if col not in column_types]
+        if untyped_column_names:
+            column_types.update(await run_steps(
+                self.data_conn,
+                extract_metadata_helper.get_column_types_steps(
+                    untyped_column_names,
+                    categorical_threshold,
+                    self.schema_name,
+                    self.table_name,
+                    sample_percent,
+                    sample_method,
+                    try_cast,
+                    max_invalid_fraction,
+                ),
+            ))
+
+        try_cast_columns = untyped_column_names if try_cast else []
+        column_metadata = await self._get_column_metadata(
+            column_types,
+            untyped_column_names,
+            try_cast_columns,
+            categorical_threshold,
+            exact_quantiles,
+            itersize,
+            store_sketches,
+            condition,
+        )
+
+        for col in column_names:
+            UPDATES[column_types[col]](self.write_session, col,
+                                       self.data_table_id,
+                                       column_metadata[col])
+            if store_sketches:
+                extract_metadata_helper.update_column_sketch(
+                    self.write_session,
+                    col,
+                    self.data_table_id,
+                    extract_metadata_helper.column_sketch(
+                        column_types[col], column_metadata[col]),
+                )
+
+        code_columns = [col for col in column_names
+                        if column_types[col] == 'code']
+        if code_columns:
+            self.write_session.add_fetched_rows(
+                'code_frequency',
+                self.data_conn,
+                extract_metadata_helper.code_frequencies_query(
+                    [extract_metadata_helper.cast_expression(col, 'code')
+                     for col in code_columns],
+                    self.schema_name,
+                    self.table_name,
+                    condition,
+                ),
+                functools.partial(
+                    extract_metadata_helper.read_code_frequency_rows,
+                    self.data_table_id,
+                    code_columns,
+                ),
+                itersize,
+            )
+
+        self.commit_latency = await self.write_session.flush()
+
+    async def _get_column_metadata(self, column_types, untyped_column_names,
+                                   try_cast_columns, categorical_threshold,
+                                   exact_quantiles, itersize,
+                                   with_sketches=False, condition=None):
+        """Compute the metadata of all columns, except code frequencies.
+
+        Columns inferred as numeric or date from patterns that turn out not
+        to cast are inferred again as code or text, updating
+        ``column_types``.
+
+        Returns:
+            dict: Column name -> dict of metadata, see
+            ``get_column_metadata``.
+
+        """
+
+        while True:
+            try:
+                return await run_steps(
+                    self.data_conn,
+                    extract_metadata_helper.get_column_metadata_steps(
+                        column_types,
+                        self.schema_name,
+                        self.table_name,
+                        try_cast_columns,
+                        exact_quantiles,
+                        with_code_frequencies=False,
+                        with_sketches=with_sketches,
+                        condition=condition,
+                    ),
+                    itersize,
+                )
+            except psycopg2.DataError:
+                if not await run_steps(
+                        self.data_conn,
+                        extract_metadata_helper
+                        .retype_uncastable_columns_steps(
+                            column_types,
+                            untyped_column_names,
+                            try_cast_columns,
+                            categorical_threshold,
+                            self.schema_name,
+                            self.table_name,
+                        )):
+                    raise
+
+
+async def process_tables(data_table_ids, concurrency=20,
+                         metabase_connection_string=None,
+                         data_connection_string=None,
+                         **process_table_kwargs):
+    """Update the metabase with metadata from many Data Tables.
+
+    ``concurrency`` workers each open their own connections once and
+    process tables one after the other, so that at most ``concurrency``
+    tables are profiled, and as many queries are in flight, at a time.
+
+    Args:
+        data_table_ids (list): IDs of the Data Tables to process.
+        concurrency (int): Number of tables processed at a time.
+        metabase_connection_string (str): Defaults to
+            ``settings.metabase_connection_string``.
+        data_connection_string (str): Defaults to
+            ``settings.data_connection_string``. If both connection strings
+            are identical, each worker uses one connection for both.
+        **process_table_kwargs: Arguments of
+            ``AsyncExtractMetadata.process_table``.
+
+    Returns:
+        list: One ``TableResult`` per Data Table, in the order of
+        ``data_table_ids``. A failure of one table does not stop the others.
+
+    """
+
+    if metabase_connection_string is None:
+        metabase_connection_string = settings.metabase_connection_string
+    if data_connection_string is None:
+        data_connection_string = settings.data_connection_string
+
+    pending = list(enumerate(data_table_ids))
+    pending.reverse()
+    results = [None] * len(pending)
+
+    async def worker():
+        """Process pending tables until there are none left."""
+
+        connections = {}
+        try:
+            while pending:
+                index, data_table_id = pending.pop()
+                results[index] = await _process_table(
+                    data_table_id, connections, metabase_connection_string,
+                    data_connection_string, process_table_kwargs)
+        finally:
+            for conn in connections.values():
+                conn.close()
+
+    workers = [worker() for _ in range(max(1, min(concurrency,
+                                                  len(pending))))]
+    await asyncio.gather(*workers)
+
+    return results
+
+
+async def _process_table(data_table_id, connections,
+                         metabase_connection_string, data_connection_string,
+                         process_table_kwargs):
+    """Process a Data Table and return its ``TableResult``.
+
+    Args:
+        connections (dict): Connection string -> ``AsyncConnection`` of the
+            worker. Missing or broken connections are opened.
+
+    """
+
+    start = time.perf_counter()
+    try:
+        for connection_string in {metabase_connection_string,
+                                  data_connection_string}:
+            conn = connections.get(connection_string)
+            if conn is None or conn.closed:
+                connections[connection_string] = (
+                    await AsyncConnection.connect(connection_string))
+
+        extract = AsyncExtractMetadata(
+            data_table_id,
+            connections[metabase_connection_string],
+            connections[data_connection_string],
+        )
+        await extract.process_table(**process_table_kwargs)
+    except Exception as error:
+        return TableResult(data_table_id, False, error,
+                           time.perf_counter() - start, None, False)
+
+    return TableResult(data_table_id, True, None,
+                       time.perf_counter() - start, extract.commit_latency,
+                       extract.skipped)
@@ -0,0 +1,121 @@
+"""Extract metadata from many Data Tables concurrently."""
+
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import time
+
+from .connection_pool import ConnectionProvider
+from .extract_metadata import ExtractMetadata
+
+
+# Outcome of processing one Data Table. error is the exception raised, or
+# None on success. seconds is the wall time of the whole extraction and
+# commit_latency the time spent committing its column level metadata.
+# skipped is True if the table had not changed since it was last profiled.
+TableResult = collections.namedtuple(
+    'TableResult',
+    ['data_table_id', 'success', 'error', 'seconds', 'commit_latency',
+     'skipped'],
+)
+
+# Connections of a worker process of ``process_tables``, opened for its
+# first table and kept until the process exits.
+_process_connection_provider = None
+
+
+def process_tables(data_table_ids, workers=4, processes=None,
+                   metabase_connection_string=None,
+                   data_connection_string=None, **process_table_kwargs):
+    """Update the metabase with metadata from many Data Tables.
+
+    Tables are processed concurrently by a pool of workers, each with its
+    own connections, so that ``workers`` tables are profiled by as many
+    database backends at a time.
+
+    Worker threads only run in parallel while they wait for the database,
+    as psycopg2 releases the GIL during queries but the Python code between
+    them holds it. Estimated quantiles update a KLL sketch with every
+    numeric value on the client, so with them, threads take turns on one
+    core. Worker processes each get a core instead, and open their own
+    ``ConnectionProvider``.
+
+    Args:
+        data_table_ids (list): IDs of the Data Tables to process.
+        workers (int): Number of tables processed at a time.
+        processes (bool): Run the workers in processes if True, in threads
+            if False. By default, processes are used unless the options
+            leave the work to the database: ``exact_quantiles`` or
+            ``statistics_only``.
+        metabase_connection_string (str): Defaults to
+            ``settings.metabase_connection_string``.
+        data_connection_string (str): Defaults to
+            ``settings.data_connection_string``.
+        **process_table_kwargs: Arguments of
+            ``ExtractMetadata.process_table``.
+
+    Returns:
+        list: One ``TableResult`` per Data Table, in the order of
+        ``data_table_ids``. A failure of one table does not stop the others.
+
+    """
+
+    if processes is None:
+        processes = not (process_table_kwargs.get('exact_quantiles')
+                         or process_table_kwargs.get('statistics_only'))
+
+    if processes:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(
+                functools.partial(_process_table_in_process,
+                                  metabase_connection_string=(
+                                      metabase_connection_string),
+                                  data_connection_string=(
+                                      data_connection_string),
+                                  process_table_kwargs=process_table_kwargs),
+                data_table_ids,
+            ))
+
+    connection_provider = ConnectionProvider(metabase_connection_string,
+                                             data_connection_string,
+                                             min_connections=workers,
+                                             max_connections=workers)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(
+                lambda data_table_id: _process_table(
+                    data_table_id, connection_provider, process_table_kwargs),
+                data_table_ids,
+            ))
+    finally:
+        connection_provider.close()
+
+
+def _process_table_in_process(data_table_id, metabase_connection_string,
+                              data_connection_string, process_table_kwargs):
+    """Process a Data Table in a worker process of ``process_tables``."""
+
+    global _process_connection_provider
+    if _process_connection_provider is None:
+        _process_connection_provider = ConnectionProvider(
+            metabase_connection_string, data_connection_string,
+            min_connections=1, max_connections=1)
+
+    return _process_table(data_table_id, _process_connection_provider,
+                          process_table_kwargs)
+
+
+def _process_table(data_table_id, connection_provider, process_table_kwargs):
+    """Process a Data Table and return its ``TableResult``."""
+
+    start = time.perf_counter()
+    try:
+        extract = ExtractMetadata(data_table_id, connection_provider)
+        extract.process_table(**process_table_kwargs)
+    except Exception as error:
+        return TableResult(data_table_id, False, error,
+                           time.perf_counter() - start, None, False)
+
+    return TableResult(data_table_id, True, None,
+                       time.perf_counter() - start, extract.commit_latency,
+                       extract.skipped)
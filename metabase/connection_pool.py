@@ -0,0 +1,93 @@
+"""Pooled connections to the metabase and the data database."""
+
+from psycopg2.pool import ThreadedConnectionPool
+
+from . import settings
+
+
+class ConnectionProvider():
+    """Lend connections to the metabase and the data database from pools.
+
+    Connections are kept open between loans, so that profiling many tables
+    does not pay connection setup and authentication for each of them. When
+    both connection strings are identical, one pooled connection serves as
+    both the metabase and the data connection of a loan.
+
+    The provider is thread safe.
+
+    """
+
+    def __init__(self, metabase_connection_string=None,
+                 data_connection_string=None, min_connections=1,
+                 max_connections=10):
+        """Create the pools and open their first connections.
+
+        Args:
+            metabase_connection_string (str): Defaults to
+                ``settings.metabase_connection_string``.
+            data_connection_string (str): Defaults to
+                ``settings.data_connection_string``.
+            min_connections (int): Number of connections of each pool
+                opened upfront and kept open when returned. Connections
+                returned beyond this number are closed.
+            max_connections (int): Maximum number of connections of each
+                pool. Borrowing more raises ``psycopg2.pool.PoolError``.
+
+        """
+        if metabase_connection_string is None:
+            metabase_connection_string = settings.metabase_connection_string
+        if data_connection_string is None:
+            data_connection_string = settings.data_connection_string
+
+        self.metabase_connection_string = metabase_connection_string
+        self.data_connection_string = data_connection_string
+        self.shared = metabase_connection_string == data_connection_string
+
+        self.metabase_pool = ThreadedConnectionPool(
+            min_connections, max_connections, metabase_connection_string)
+        if self.shared:
+            self.data_pool = self.metabase_pool
+        else:
+            self.data_pool = ThreadedConnectionPool(
+                min_connections, max_connections, data_connection_string)
+
+    def get_connections(self):
+        """Borrow a metabase connection and a data connection.
+
+        Returns:
+            (connection, connection): (metabase connection, data connection),
+            the same connection twice if the connection strings are
+            identical.
+
+        """
+
+        metabase_conn = self.metabase_pool.getconn()
+        if self.shared:
+            return (metabase_conn, metabase_conn)
+
+        try:
+            data_conn = self.data_pool.getconn()
+        except Exception:
+            self.metabase_pool.putconn(metabase_conn)
+            raise
+
+        return (metabase_conn, data_conn)
+
+    def put_connections(self, metabase_conn, data_conn):
+        """Return connections from ``get_connections`` to their pools.
+
+        A connection left in a transaction is rolled back, and a closed
+        connection is discarded.
+
+        """
+
+        self.metabase_pool.putconn(metabase_conn)
+        if data_conn is not metabase_conn:
+            self.data_pool.putconn(data_conn)
+
+    def close(self):
+        """Close all connections of the pools."""
+
+        self.metabase_pool.closeall()
+        if not self.shared:
+            self.data_pool.closeall()
@@ -1,157 +1,838 @@
 """Class to extract metadata from a Data Table"""
 
-import getpass
-
 import psycopg2
 from psycopg2 import sql
 
 from . import settings
 from . import extract_metadata_helper
+from .write_session import WriteSession
 
 
 class ExtractMetadata():
     """Class to extract metadata from a Data Table."""
 
-    def __init__(self, data_table_id):
+    def __init__(self, data_table_id, connection_provider=None):
         """Set Data Table ID and connect to database.
 
         Args:
            data_table_id (int): ID associated with this Data Table.
+           connection_provider (ConnectionProvider): If given, borrow the
+               connections from its pools instead of opening new ones. They
+               are returned to the pools when the table is processed.
 
         """
         self.data_table_id = data_table_id
+        self.connection_provider = connection_provider
+
+        if connection_provider is None:
+            self.data_connection_string = settings.data_connection_string
+            self.metabase_conn = psycopg2.connect(
+                settings.metabase_connection_string)
+            self.data_conn = psycopg2.connect(self.data_connection_string)
+        else:
+            self.data_connection_string = (
+                connection_provider.data_connection_string)
+            self.metabase_conn, self.data_conn = (
+                connection_provider.get_connections())
 
-        self.metabase_conn = psycopg2.connect(
-            settings.metabase_connection_string)
         self.metabase_conn.autocommit = True
         self.metabase_cur = self.metabase_conn.cursor()
 
-        self.data_conn = psycopg2.connect(settings.data_connection_string)
+        # Column level metadata is written in one transaction per table.
+        self.write_session = WriteSession(self.metabase_conn)
+        # Seconds spent committing the column level metadata.
+        self.commit_latency = None
+        # Snapshot shared by column workers, see process_table.
+        self.snapshot_id = None
+        # True if process_table found the table unchanged and skipped it.
+        self.skipped = False
+
         self.data_conn.autocommit = True
         self.data_cur = self.data_conn.cursor()
 
-        self.schema_name, self.table_name = self.__get_table_name()
+        try:
+            self.schema_name, self.table_name = self.__get_table_name()
+        except Exception:
+            self.close()
+            raise
+
+    def process_table(self, categorical_threshold=10, sample_percent=None,
+                      sample_method='SYSTEM', max_invalid_fraction=0,
+                      exact_quantiles=False, column_workers=1,
+                      itersize=extract_metadata_helper.ITERSIZE,
+                      skip_unchanged=False, checksum=False,
+                      store_sketches=False, id_column=None,
+                      estimate_rows=False, statistics_only=False):
+        """Update the metabase with metadata from this Data Table.
+
+        Args:
+            categorical_threshold (int or float): Maximum number of distinct
+                values in a code column. A float below 1 is a maximum ratio
+                of distinct values to rows instead, e.g. 0.001.
+            sample_percent (float): If given, reject column types on this
+                percentage of the table first and only verify the remaining
+                types on the whole table. Ignored when
+                ``max_invalid_fraction`` is not 0.
+            sample_method (str): 'SYSTEM' or 'BERNOULLI' sampling.
+            max_invalid_fraction (float): Fraction of the values of a numeric
+                or date column allowed not to cast. These values are profiled
+                as NULL. Requires the try cast functions in the data database.
+            exact_quantiles (bool): Compute percentiles of numeric values
+                exactly, sorting each column, instead of estimating them in
+                one streaming pass. Text length percentiles are always exact.
+            column_workers (int): If more than 1, split the columns among
+                this many data connections profiling them concurrently. The
+                whole table is then read from one exported snapshot, so the
+                column metadata matches the number of rows. Codes are still
+                counted on the connection of the snapshot, see
+                ``itersize``.
+            itersize (int): Number of rows fetched at a time from
+                server-side cursors. Code frequencies are streamed from the
+                data table to the metabase by as many at a time, so memory
+                does not grow with the number of codes. Only
+                ``process_partitioned_table`` and ``process_appended_rows``
+                hold the codes in memory, to merge them with stored ones.
+            skip_unchanged (bool): Before any scan, compare the watermark of
+                the table with the one stored when it was last profiled, and
+                skip the table if it has not changed and the options that
+                affect its metadata are the same. ``skipped`` is then True.
+                The watermark is stored after every profiling.
+            checksum (bool): Include a checksum of all rows in the
+                watermark, so that changes not yet counted in the table
+                statistics are detected too. It costs a scan of the table.
+            store_sketches (bool): Store the mergeable state of each column
+                in Column Sketch, so that ``process_appended_rows`` can later
+                profile appended rows only. Requires estimated quantiles.
+            id_column (str): Column whose values increase with each append,
+                e.g. a serial ID, for ``process_appended_rows``. Only the
+                rows up to its current greatest value are profiled, and this
+                value is stored in the watermark. Rows with a NULL ID are
+                never profiled. Requires ``store_sketches``.
+            estimate_rows (bool): Instead of counting the rows of the table,
+                analyze it and take the estimated number of rows from the
+                catalog. Data Table records that the number is estimated.
+                Cannot be combined with ``id_column``.
+            statistics_only (bool): Instead of scanning the table, analyze
+                it and estimate all metadata from the planner statistics in
+                ``pg_stats``, see ``_get_statistics_metadata``. The column
+                metadata is marked as estimated. Options of the scans are
+                ignored, except ``categorical_threshold``. The watermark of
+                the table is not stored, so ``skip_unchanged`` never skips
+                the next profile.
+
+        """
+
+        if id_column is not None and not store_sketches:
+            raise ValueError('id_column requires store_sketches.')
+        if id_column is not None and (estimate_rows or statistics_only):
+            raise ValueError('id_column requires an exact row count.')
+        if store_sketches and (exact_quantiles or statistics_only):
+            raise ValueError('Sketches require estimated quantiles from '
+                             'a scan.')
+
+        try:
+            watermark = extract_metadata_helper.get_table_watermark(
+                self.data_cur, self.schema_name, self.table_name, checksum)
+            watermark['options_hash'] = extract_metadata_helper.hash_options(
+                categorical_threshold, sample_percent, sample_method,
+                max_invalid_fraction, exact_quantiles, store_sketches,
+                id_column, estimate_rows)
+            if skip_unchanged and extract_metadata_helper.is_unchanged(
+                    extract_metadata_helper.get_stored_watermark(
+                        self.metabase_cur, self.data_table_id),
+                    watermark):
+                self.skipped = True
+                return
+
+            if estimate_rows or statistics_only:
+                # Outside of the read only snapshot transaction.
+                self.data_cur.execute(
+                    extract_metadata_helper.analyze_table_query(
+                        self.schema_name, self.table_name))
+
+            # No watermark is stored with estimated metadata, so that a
+            # later exact profile with skip_unchanged is not skipped.
+            if statistics_only:
+                self._get_statistics_metadata(categorical_threshold)
+                return
+
+            if column_workers > 1:
+                self.__open_snapshot()
+
+            max_id = None
+            condition = None
+            if id_column is not None:
+                max_id = extract_metadata_helper.get_max_id(
+                    self.data_cur, id_column, self.schema_name,
+                    self.table_name)
+                condition = extract_metadata_helper.id_range_condition(
+                    id_column, None, max_id)
+
+            # Stored with the column level metadata, so that a failure
+            # leaves the previous watermark.
+            extract_metadata_helper.update_table_watermark(
+                self.write_session, self.data_table_id, watermark, id_column,
+                max_id)
+
+            self._get_table_level_metadata(condition, estimate_rows)
+            self._get_column_level_metadata(categorical_threshold,
+                                            sample_percent,
+                                            sample_method,
+                                            max_invalid_fraction,
+                                            exact_quantiles,
+                                            column_workers,
+                                            itersize,
+                                            store_sketches,
+                                            condition)
+        finally:
+            if self.snapshot_id is not None:
+                self.__close_snapshot()
+            self.close()
+
+    def process_appended_rows(self, new_rows=None, id_column=None,
+                              itersize=extract_metadata_helper.ITERSIZE):
+        """Update the metabase with the rows appended to this Data Table.
+
+        Only the appended rows are scanned. Their column state is merged
+        into the state stored by ``process_table`` with ``store_sketches``,
+        and the metadata of every column is derived from the merged state.
+        Code frequencies are added to the stored ones.
+
+        Column types are kept as stored. Values of appended rows that do not
+        cast to them raise ValueError, and so do columns added or dropped
+        since the table was profiled: ``process_table`` must then profile
+        the whole table again. Code columns stay code columns whatever
+        their number of codes.
+
+        Args:
+            new_rows (str): SQL condition selecting the appended rows, e.g.
+                ``"load_date = '2019-06-01'"``. The ID watermark is then
+                cleared.
+            id_column (str): Instead of ``new_rows``, select the rows whose
+                ID is greater than the greatest one profiled, as stored by
+                ``process_table`` or a previous append with the same
+                ``id_column``.
+            itersize (int): Number of rows fetched at a time from
+                server-side cursors.
+
+        """
+
+        try:
+            if (new_rows is None) == (id_column is None):
+                raise ValueError('Give either new_rows or id_column.')
+
+            column_sketches = extract_metadata_helper.get_column_sketches(
+                self.metabase_cur, self.data_table_id)
+            column_names = [col for (col, _)
+                            in self.__get_declared_column_types()]
+            if (sorted(column_names) != sorted(column_sketches)
+                    or any(sketch is None
+                           for (_, sketch) in column_sketches.values())):
+                raise ValueError('Column sketches are missing, profile the '
+                                 'whole table with store_sketches.')
+            column_types = {col: column_sketches[col][0]
+                            for col in column_names}
+
+            max_id = None
+            options_hash = None
+            if id_column is None:
+                condition = sql.SQL(new_rows)
+            else:
+                stored_id_column, stored_max_id = (
+                    extract_metadata_helper.get_id_watermark(
+                        self.metabase_cur, self.data_table_id))
+                if stored_id_column != id_column:
+                    raise ValueError('The table was not profiled with this '
+                                     'id_column.')
+                max_id = extract_metadata_helper.get_max_id(
+                    self.data_cur, id_column, self.schema_name,
+                    self.table_name)
+                condition = extract_metadata_helper.id_range_condition(
+                    id_column, stored_max_id, max_id)
+                # The metadata still follows the options of the profile. Once
+                # the ID watermark is cleared, it no longer does, so that a
+                # profile with id_column is not skipped.
+                options_hash = extract_metadata_helper.get_stored_watermark(
+                    self.metabase_cur, self.data_table_id)['options_hash']
+
+            watermark = extract_metadata_helper.get_table_watermark(
+                self.data_cur, self.schema_name, self.table_name)
+            watermark['options_hash'] = options_hash
+            extract_metadata_helper.update_table_watermark(
+                self.write_session, self.data_table_id, watermark, id_column,
+                max_id)
+
+            try:
+                column_metadata = extract_metadata_helper.get_column_metadata(
+                    self.data_cur,
+                    column_types,
+                    self.schema_name,
+                    self.table_name,
+                    itersize=itersize,
+                    with_sketches=True,
+                    condition=condition,
+                )
+            except psycopg2.DataError:
+                raise ValueError('Appended values do not cast to the column '
+                                 'types, profile the whole table.')
+
+            code_frequencies = (
+                extract_metadata_helper.get_stored_code_frequencies(
+                    self.metabase_cur, self.data_table_id))
+            n_rows = 0
+            for col in column_names:
+                column_type = column_types[col]
+                sketch = extract_metadata_helper.merge_column_sketches(
+                    column_type,
+                    column_sketches[col][1],
+                    extract_metadata_helper.column_sketch(
+                        column_type, column_metadata[col]),
+                )
+                metadata = extract_metadata_helper.read_column_sketch(
+                    column_type, sketch)
+                if column_type == 'code':
+                    frequencies = code_frequencies.get(col, {})
+                    for code, frequency in (
+                            column_metadata[col]['frequencies']):
+                        frequencies[code] = (frequencies.get(code, 0)
+                                             + frequency)
+                    metadata['frequencies'] = sorted(frequencies.items())
+
+                self.__update_column_metadata(col, column_type, metadata)
+                extract_metadata_helper.update_column_sketch(
+                    self.write_session, col, self.data_table_id, sketch)
+                n_rows = sketch['non_null_count'] + sketch['null_count']
+
+            self.data_cur.execute(
+                *extract_metadata_helper.table_level_metadata_query(
+                    self.schema_name, self.table_name, row_count=None))
+            _, n_cols, table_size, total_size = self.data_cur.fetchone()
+            self.write_session.add_statement(
+                *extract_metadata_helper.update_data_table_query(
+                    self.data_table_id, n_rows, n_cols, table_size,
+                    total_size))
+
+            self.commit_latency = self.write_session.flush()
+        finally:
+            self.close()
+
+    def process_partitioned_table(self, categorical_threshold=10,
+                                  sample_percent=None,
+                                  sample_method='SYSTEM',
+                                  max_invalid_fraction=0, workers=2,
+                                  itersize=extract_metadata_helper.ITERSIZE,
+                                  checksum=False):
+        """Update the metabase with metadata from a partitioned Data Table.
+
+        The leaf partitions of the table, found through ``pg_inherits``, are
+        profiled separately, ``workers`` at a time on their own data
+        connections. The states of their columns are merged into the
+        metadata of the whole table. Each partition's watermark and column
+        states are stored in Partition Profile, so that later runs only
+        profile the partitions that changed since.
+
+        Column types are inferred on the whole table when no partition
+        state is stored. Later runs reuse them unless the columns changed,
+        a value no longer casts or a code column outgrew
+        ``categorical_threshold``. The affected columns are then inferred
+        again, and every partition is profiled with the new types.
+
+        Numeric percentiles are always estimated.
+
+        Args:
+            categorical_threshold (int or float): See ``process_table``.
+            sample_percent (float): See ``process_table``.
+            sample_method (str): See ``process_table``.
+            max_invalid_fraction (float): See ``process_table``.
+            workers (int): Number of partitions profiled at a time.
+            itersize (int): Number of rows fetched at a time from
+                server-side cursors.
+            checksum (bool): Include a checksum of all rows in the watermark
+                of each partition, see ``process_table``.
+
+        """
+
+        try:
+            partitions = extract_metadata_helper.get_partitions(
+                self.data_cur, self.schema_name, self.table_name)
+            if not partitions:
+                raise ValueError('Selected data table has no partitions.')
+
+            try_cast = extract_metadata_helper.use_try_cast(
+                self.data_cur, max_invalid_fraction)
+
+            declared_types = self.__get_declared_column_types()
+            untyped_column_names = [col for (col, column_type)
+                                    in declared_types if column_type is None]
+            try_cast_columns = untyped_column_names if try_cast else []
+
+            # States profiled with other options are profiled again, and
+            # column types inferred again.
+            options_hash = extract_metadata_helper.hash_options(
+                categorical_threshold, sample_percent, sample_method,
+                max_invalid_fraction)
+            partition_profiles = {
+                partition_name: profile
+                for partition_name, profile
+                in extract_metadata_helper.get_partition_profiles(
+                    self.metabase_cur, self.data_table_id).items()
+                if profile[0]['options_hash'] == options_hash
+            }
+            column_types = extract_metadata_helper.stored_column_types(
+                partition_profiles, declared_types)
+            if column_types is None:
+                column_types = self.__infer_column_types(declared_types,
+                                                         categorical_threshold,
+                                                         sample_percent,
+                                                         sample_method,
+                                                         try_cast,
+                                                         max_invalid_fraction)
+
+            watermarks = {
+                partition: extract_metadata_helper.get_table_watermark(
+                    self.data_cur, *partition, checksum=checksum)
+                for partition in partitions
+            }
+            for watermark in watermarks.values():
+                watermark['options_hash'] = options_hash
+
+            while True:
+                partition_states = {}
+                for partition in partitions:
+                    column_states = (
+                        extract_metadata_helper.cached_column_states(
+                            partition_profiles.get('.'.join(partition)),
+                            watermarks[partition],
+                            column_types,
+                        ))
+                    if column_states is not None:
+                        partition_states[partition] = column_states
+
+                try:
+                    partition_metadata = (
+                        extract_metadata_helper
+                        .get_partition_metadata_in_parallel(
+                            self.data_connection_string,
+                            [partition for partition in partitions
+                             if partition not in partition_states],
+                            column_types,
+                            try_cast_columns,
+                            workers,
+                            itersize,
+                        ))
+                except psycopg2.DataError:
+                    if not self.__retype_uncastable_columns(
+                            column_types, untyped_column_names,
+                            try_cast_columns, categorical_threshold):
+                        raise
+                    continue
+
+                for partition, metadata in partition_metadata.items():
+                    partition_states[partition] = (
+                        extract_metadata_helper.partition_column_states(
+                            column_types, metadata))
+
+                column_metadata = (
+                    extract_metadata_helper.merge_partition_states(
+                        column_types,
+                        [partition_states[partition]
+                         for partition in partitions],
+                    ))
+                n_rows = next((metadata['non_null_count']
+                               + metadata['null_count']
+                               for metadata in column_metadata.values()), 0)
+
+                max_distinct = categorical_threshold
+                if extract_metadata_helper.is_ratio_threshold(
+                        categorical_threshold):
+                    max_distinct = int(categorical_threshold * n_rows)
+                outgrown_columns = [
+                    col for col, column_type in column_types.items()
+                    if column_type == 'code'
+                    and len(column_metadata[col]['frequencies']) > max_distinct
+                ]
+                if not outgrown_columns:
+                    break
+                for col in outgrown_columns:
+                    column_types[col] = 'text'
+
+            if n_rows == 0:
+                raise ValueError('Selected data table has 0 rows.')
+
+            self.data_cur.execute(
+                *extract_metadata_helper.table_level_metadata_query(
+                    self.schema_name, self.table_name, row_count=None))
+            _, n_cols, table_size, total_size = self.data_cur.fetchone()
+            self.write_session.add_statement(
+                *extract_metadata_helper.update_data_table_query(
+                    self.data_table_id, n_rows, n_cols, table_size,
+                    total_size))
+
+            for (col, _) in declared_types:
+                self.__update_column_metadata(col, column_types[col],
+                                              column_metadata[col])
+            for partition in partitions:
+                extract_metadata_helper.update_partition_profile(
+                    self.write_session,
+                    self.data_table_id,
+                    '.'.join(partition),
+                    watermarks[partition],
+                    partition_states[partition],
+                )
+
+            self.commit_latency = self.write_session.flush()
+        finally:
+            self.close()
+
+    def __open_snapshot(self):
+        """Read the data table from a snapshot that other connections share.
+
+        Replace the data connection with a new one in a read only repeatable
+        read transaction, and export the snapshot of this transaction. The
+        data connection is only replaced once the snapshot is exported, so
+        that on error, ``close`` does not return the snapshot connection to
+        a pool in place of the borrowed one.
 
-    def process_table(self, categorical_threshold=10):
-        """Update the metabase with metadata from this Data Table."""
+        """
+
+        snapshot_conn = psycopg2.connect(self.data_connection_string)
+        try:
+            snapshot_conn.set_session(isolation_level='REPEATABLE READ',
+                                      readonly=True)
+            snapshot_cur = snapshot_conn.cursor()
+
+            snapshot_cur.execute('SELECT pg_export_snapshot()')
+            snapshot_id = snapshot_cur.fetchone()[0]
+        except Exception:
+            snapshot_conn.close()
+            raise
+
+        self.__data_conn_and_cur = (self.data_conn, self.data_cur)
+        self.data_conn, self.data_cur = snapshot_conn, snapshot_cur
+        self.snapshot_id = snapshot_id
 
-        self._get_table_level_metadata()
-        self._get_column_level_metadata(categorical_threshold)
+    def __close_snapshot(self):
+        """End the snapshot transaction and restore the data connection."""
+
+        try:
+            self.data_cur.close()
+            self.data_conn.close()
+        finally:
+            self.data_conn, self.data_cur = self.__data_conn_and_cur
+            self.snapshot_id = None
+
+    def close(self):
+        """Close the cursors, and close or return the connections."""
 
         self.metabase_cur.close()
-        self.metabase_conn.close()
         self.data_cur.close()
-        self.data_conn.close()
 
-    def _get_table_level_metadata(self):
-        """Extract table level metadata and store it in the metabase.
+        if self.connection_provider is None:
+            self.metabase_conn.close()
+            self.data_conn.close()
+        else:
+            self.connection_provider.put_connections(self.metabase_conn,
+                                                     self.data_conn)
+
+    def _get_table_level_metadata(self, condition=None,
+                                  estimate_rows=False):
+        """Extract table level metadata and add it to the write session.
 
         Extract table level metadata (number of rows, number of columns and
         file size (table size)) and store it in DataTable. Also set updated by
-        and date last updated.
+        and date last updated. DataTable is updated by the next flush of the
+        write session, in the transaction of the column level metadata.
 
         Size is in bytes
 
-        """
-        self.data_cur.execute(
-            sql.SQL('SELECT COUNT(*) as n_rows FROM {}.{};').format(
-                sql.Identifier(self.schema_name),
-                sql.Identifier(self.table_name),
-            )
-        )
-        n_rows = self.data_cur.fetchone()[0]
+        Args:
+            condition (sql.Composable): If given, only count the rows
+                satisfying this condition.
+            estimate_rows (bool): Take the number of rows estimated in the
+                catalog by the last ``ANALYZE`` instead of counting them.
 
-        self.data_cur.execute(
-            sql.SQL("""
-                SELECT COUNT(*)
-                FROM INFORMATION_SCHEMA.COLUMNS
-                WHERE
-                    TABLE_SCHEMA = %s
-                    AND TABLE_NAME = %s
-            """),
-            [self.schema_name, self.table_name]
-        )
-        n_cols = self.data_cur.fetchone()[0]
+        Returns:
+            int: Number of rows.
 
+        """
         self.data_cur.execute(
-            sql.SQL('SELECT PG_RELATION_SIZE(%s);'),
-            [self.schema_name + '.' + self.table_name],
-        )
-        table_size = self.data_cur.fetchone()[0]
+            *extract_metadata_helper.table_level_metadata_query(
+                self.schema_name,
+                self.table_name,
+                'estimate' if estimate_rows else 'exact',
+                condition,
+            ))
+        n_rows, n_cols, table_size, total_size = self.data_cur.fetchone()
 
         if n_rows == 0:
             raise ValueError('Selected data table has 0 rows.')
             # This will also capture n_cols == 0 and size == 0.
 
-        self.metabase_cur.execute(
-            """
-                UPDATE metabase.data_table
-                SET
-                    number_rows = %(n_rows)s,
-                    number_columns = %(n_cols)s,
-                    size = %(table_size)s,
-                    updated_by = %(user_name)s,
-                    date_last_updated = (SELECT CURRENT_TIMESTAMP)
-                WHERE data_table_id = %(data_table_id)s
-                ;
-            """,
-            {
-                'n_rows': n_rows,
-                'n_cols': n_cols,
-                'table_size': table_size,
-                'user_name': getpass.getuser(),
-                'data_table_id': self.data_table_id,
-            }
-        )
+        self.write_session.add_statement(
+            *extract_metadata_helper.update_data_table_query(
+                self.data_table_id, n_rows, n_cols, table_size, total_size,
+                estimate_rows))
 
         # TODO: Update create_by and date_created
         # https://github.com/chapinhall/adrf-metabase/pull/8#discussion_r265339190
 
-    def _get_column_level_metadata(self, categorical_threshold):
+        return n_rows
+
+    def _get_statistics_metadata(self, categorical_threshold):
+        """Estimate all metadata from statistics and store it in the metabase.
+
+        The number of rows comes from the catalog and the column metadata
+        from ``pg_stats``, without reading the table, so the table must have
+        been analyzed. Column Info rows are marked as estimated. Text
+        columns only get their Column Info row, as their lengths are not
+        estimated.
+
+        """
+
+        n_rows = self._get_table_level_metadata(estimate_rows=True)
+
+        declared_types = self.__get_declared_column_types()
+        column_types, column_metadata = (
+            extract_metadata_helper.get_statistics_metadata(
+                self.data_cur,
+                declared_types,
+                extract_metadata_helper.get_column_statistics(
+                    self.data_cur, self.schema_name, self.table_name),
+                n_rows,
+                categorical_threshold,
+            ))
+
+        for (col, _) in declared_types:
+            if column_types[col] == 'text':
+                extract_metadata_helper.update_column_info(
+                    self.write_session, col, self.data_table_id, 'text',
+                    column_metadata[col]['null_count'], estimated=True)
+            else:
+                self.__update_column_metadata(col, column_types[col],
+                                              column_metadata[col])
+
+        self.commit_latency = self.write_session.flush()
+
+    def _get_column_level_metadata(self, categorical_threshold,
+                                   sample_percent=None,
+                                   sample_method='SYSTEM',
+                                   max_invalid_fraction=0,
+                                   exact_quantiles=False,
+                                   column_workers=1,
+                                   itersize=extract_metadata_helper.ITERSIZE,
+                                   store_sketches=False, condition=None):
         """Extract column level metadata and store it in the metabase.
 
-        Process columns one by one, identify or infer type, update Column Info
-        and corresponding column table.
+        Take the types of natively typed columns from the catalog and infer
+        the types of the other columns in one scan of the table, then compute
+        the metadata of all columns together and update Column Info and
+        corresponding column table. Metadata is computed directly from the
+        data table, casting columns inline.
+
+        Castability is checked with the try cast functions if they exist in
+        the data database.
+
+        The codes of code columns are counted while they are written to the
+        metabase, through a server-side cursor. With several column workers,
+        they are counted on the connection of the snapshot.
+
+        With ``store_sketches``, the mergeable state of each column is stored
+        in Column Sketch too. Types are inferred from the whole table, but
+        only the rows satisfying ``condition``, if given, are profiled.
 
         """
 
-        column_names = self.__get_column_names()
+        try_cast = extract_metadata_helper.use_try_cast(
+            self.data_cur, max_invalid_fraction)
+
+        declared_types = self.__get_declared_column_types()
+        column_names = [col for (col, _) in declared_types]
+        untyped_column_names = [col for (col, column_type) in declared_types
+                                if column_type is None]
+        column_types = self.__infer_column_types(declared_types,
+                                                 categorical_threshold,
+                                                 sample_percent,
+                                                 sample_method,
+                                                 try_cast,
+                                                 max_invalid_fraction)
+
+        try_cast_columns = untyped_column_names if try_cast else []
+        column_metadata = self.__get_column_metadata(
+            column_types,
+            untyped_column_names,
+            try_cast_columns,
+            categorical_threshold,
+            exact_quantiles,
+            column_workers,
+            itersize,
+            store_sketches,
+            condition,
+        )
 
         for col in column_names:
-            column_type = self.__get_column_type(col, categorical_threshold)
-            if column_type == 'numeric':
-                self.__update_numeric_metadata(col)
-            elif column_type == 'text':
-                self.__update_text_metadata(col)
-            elif column_type == 'date':
-                self.__update_date_metadata(col)
-            elif column_type == 'code':
-                self.__update_code_metadata(col)
-            else:
-                raise ValueError('Unknown column type')
+            self.__update_column_metadata(col, column_types[col],
+                                          column_metadata[col])
+            if store_sketches:
+                extract_metadata_helper.update_column_sketch(
+                    self.write_session,
+                    col,
+                    self.data_table_id,
+                    extract_metadata_helper.column_sketch(
+                        column_types[col], column_metadata[col]),
+                )
+
+        code_columns = [col for col in column_names
+                        if column_types[col] == 'code']
+        if code_columns:
+            self.write_session.add_rows(
+                'code_frequency',
+                extract_metadata_helper.code_frequency_rows(
+                    self.data_cur,
+                    self.data_table_id,
+                    code_columns,
+                    self.schema_name,
+                    self.table_name,
+                    itersize,
+                    condition,
+                ),
+            )
+
+        self.commit_latency = self.write_session.flush()
+
+    def __get_column_metadata(self, column_types, untyped_column_names,
+                              try_cast_columns, categorical_threshold,
+                              exact_quantiles, column_workers=1,
+                              itersize=extract_metadata_helper.ITERSIZE,
+                              with_sketches=False, condition=None):
+        """Compute the metadata of all columns, except code frequencies.
 
-    def __get_column_names(self):
-        """Returns the names of the columns in the data table.
+        With more than one column worker and an open snapshot, the columns
+        are profiled concurrently on connections sharing the snapshot.
+
+        Columns inferred as numeric or date from patterns that turn out not
+        to cast are inferred again as code or text, updating
+        ``column_types``.
 
         Returns:
-            (str): Column names.
+            dict: Column name -> dict of metadata.
 
         """
 
-        self.data_cur.execute(
-                """
-                SELECT column_name FROM INFORMATION_SCHEMA.COLUMNS
-                WHERE table_schema = %(schema)s
-                AND table_name  = %(table)s;
-                """,
-                {
-                    'schema': self.schema_name,
-                    'table': self.table_name
-                },
+        while True:
+            try:
+                if column_workers > 1 and self.snapshot_id is not None:
+                    return (extract_metadata_helper
+                            .get_column_metadata_in_parallel(
+                                self.data_connection_string,
+                                self.snapshot_id,
+                                column_types,
+                                self.schema_name,
+                                self.table_name,
+                                try_cast_columns,
+                                exact_quantiles,
+                                column_workers,
+                                with_code_frequencies=False,
+                                with_sketches=with_sketches,
+                                condition=condition,
+                            ))
+                return extract_metadata_helper.get_column_metadata(
+                    self.data_cur,
+                    column_types,
+                    self.schema_name,
+                    self.table_name,
+                    try_cast_columns,
+                    exact_quantiles,
+                    itersize,
+                    with_code_frequencies=False,
+                    with_sketches=with_sketches,
+                    condition=condition,
                 )
+            except psycopg2.DataError:
+                if not self.__retype_uncastable_columns(
+                        column_types, untyped_column_names,
+                        try_cast_columns, categorical_threshold):
+                    raise
+
+    def __retype_uncastable_columns(self, column_types, untyped_column_names,
+                                    try_cast_columns, categorical_threshold):
+        """Infer the types of inferred columns that do not cast again.
+
+        See ``extract_metadata_helper.retype_uncastable_columns``.
+
+        Returns:
+            bool: True if some column was retyped.
+
+        """
+
+        return extract_metadata_helper.retype_uncastable_columns(
+            self.data_cur,
+            column_types,
+            untyped_column_names,
+            try_cast_columns,
+            categorical_threshold,
+            self.schema_name,
+            self.table_name,
+        )
 
-        columns = self.data_cur.fetchall()
-        return([c[0] for c in columns])
+    def __update_column_metadata(self, col, column_type, metadata):
+        """Store the metadata of a column according to its type."""
+
+        if column_type == 'numeric':
+            self.__update_numeric_metadata(col, metadata)
+        elif column_type == 'text':
+            self.__update_text_metadata(col, metadata)
+        elif column_type == 'date':
+            self.__update_date_metadata(col, metadata)
+        elif column_type == 'code':
+            self.__update_code_metadata(col, metadata)
+        else:
+            raise ValueError('Unknown column type')
+
+    def __get_declared_column_types(self):
+        """Returns the columns of the data table and their declared types.
+
+        Returns:
+            list: (column name, 'numeric', 'date' or None) tuples. None means
+            the type has to be inferred from the data.
+
+        """
+
+        return extract_metadata_helper.get_declared_column_types(
+            self.data_cur,
+            self.schema_name,
+            self.table_name,
+        )
+
+    def __infer_column_types(self, declared_types, categorical_threshold,
+                             sample_percent, sample_method, try_cast,
+                             max_invalid_fraction):
+        """Return the types of all columns, declared or inferred.
+
+        Args:
+            declared_types (list): Tuples from
+                ``__get_declared_column_types``.
+
+        Returns:
+            dict: Column name -> 'numeric', 'text', 'date' or 'code'
+
+        """
+
+        column_types = {col: column_type
+                        for (col, column_type) in declared_types
+                        if column_type is not None}
+        untyped_column_names = [col for (col, column_type) in declared_types
+                                if column_type is None]
+        if untyped_column_names:
+            column_types.update(self.__get_column_types(
+                untyped_column_names,
+                categorical_threshold,
+                sample_percent,
+                sample_method,
+                try_cast,
+                max_invalid_fraction,
+            ))
+
+        return column_types
 
     def __get_table_name(self):
         """Return the the table schema and name using the Data Table ID.
@@ -178,92 +859,93 @@ class ExtractMetadata():
         if result is None:
             raise ValueError('data_table_id not found in metabase.data_table')
 
-        schema_name_table_name_tp = result[0].split('.')
-        if len(schema_name_table_name_tp) != 2:
-            raise ValueError('file_table_name is not in <schema>.<table> '
-                             'format')
-
-        return schema_name_table_name_tp
+        return extract_metadata_helper.split_file_table_name(result[0])
 
-    def __get_column_type(self, col, categorical_threshold):
-        """Identify or infer column type.
+    def __get_column_types(self, column_names, categorical_threshold,
+                           sample_percent, sample_method, try_cast,
+                           max_invalid_fraction):
+        """Identify or infer column types.
 
-        Infers the column type.
+        Infers the types of all columns with a single scan of the table,
+        preceded by a scan of a sample if ``sample_percent`` is given, and
+        followed by a scan counting distinct values exactly if some columns
+        may be code. Only aggregates are fetched.
 
         Returns:
-          str: 'numeric', 'text', 'date' or 'code'
+          dict: Column name -> 'numeric', 'text', 'date' or 'code'
 
         """
 
-        # TODO Use server side cursor here
-
-        type = extract_metadata_helper.get_column_type(
+        types = extract_metadata_helper.get_column_types(
             self.data_cur,
-            col,
+            column_names,
             categorical_threshold,
             self.schema_name,
-            self.table_name
+            self.table_name,
+            sample_percent,
+            sample_method,
+            try_cast,
+            max_invalid_fraction,
         )
 
-        return type
+        return types
 
-    def __update_numeric_metadata(self, col):
-        """Extract metadata from a numeric column.
+    def __update_numeric_metadata(self, col, metadata):
+        """Store metadata from a numeric column.
 
-        Extract metadata from a numeric column and store metadata in Column
-        Info and Numeric Column. Update relevant audit fields.
+        Store metadata from a numeric column in Column Info and Numeric
+        Column. Update relevant audit fields.
 
         """
 
         extract_metadata_helper.update_numeric(
-            self.data_cur,
-            self.metabase_cur,
+            self.write_session,
             col,
             self.data_table_id,
+            metadata,
         )
 
-    def __update_text_metadata(self, col):
-        """Extract metadata from a text column.
+    def __update_text_metadata(self, col, metadata):
+        """Store metadata from a text column.
 
-        Extract metadata from a text column and store metadata in Column Info
-        and Text Column. Update relevant audit fields.
+        Store metadata from a text column in Column Info and Text Column.
+        Update relevant audit fields.
 
         """
 
         extract_metadata_helper.update_text(
-            self.data_cur,
-            self.metabase_cur,
+            self.write_session,
             col,
             self.data_table_id,
+            metadata,
         )
 
-    def __update_date_metadata(self, col):
-        """Extract metadata from a date column.
+    def __update_date_metadata(self, col, metadata):
+        """Store metadata from a date column.
 
-        Extract metadata from date column and store metadate in Column Info and
-        Date Column. Update relevant audit fields.
+        Store metadata from date column in Column Info and Date Column.
+        Update relevant audit fields.
 
         """
 
         extract_metadata_helper.update_date(
-            self.data_cur,
-            self.metabase_cur,
+            self.write_session,
             col,
             self.data_table_id,
+            metadata,
         )
 
-    def __update_code_metadata(self, col):
-        """Extract metadata from a categorial column.
+    def __update_code_metadata(self, col, metadata):
+        """Store metadata from a categorial column.
 
-        Extract metadata from a categorial columns and store metadata in Column
-        Info and Code Frequency. Update relevant audit fields.
+        Store metadata from a categorial columns in Column Info and Code
+        Frequency. Update relevant audit fields.
 
         """
-        # TODO: modify categorical_threshold to take percentage arguments.
 
         extract_metadata_helper.update_code(
-            self.data_cur,
-            self.metabase_cur,
+            self.write_session,
             col,
             self.data_table_id,
+            metadata,
         )
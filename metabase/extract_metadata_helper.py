@@ -1,425 +1,2876 @@
 """Helper funtions for extract_metadata.
 """
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import datetime
+import decimal
 import getpass
+import hashlib
+import json
+import threading
 
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import Json
+
+from .sketches import (HyperLogLog, KllSketch, numeric_sort_key,
+                       weighted_quantiles)
+
+
+# Patterns for the text forms of values that can be cast to NUMERIC or DATE.
+# They let the castability of every column be checked in one scan instead of
+# one cast probe per column. Values matching them are expected to cast, but
+# casts accept more forms than they match, e.g. 'Jan 5 2020' as a date, so
+# the checks they fail are probed with casts, see ``probe_type_checks_steps``.
+# Casts only trim ASCII spaces, while ``\s`` also matches Unicode spaces.
+SPACES = r'[ \t\n\r\f\v]*'
+NUMERIC_PATTERN = (
+    r'(?i)^' + SPACES
+    + r'([-+]?([0-9]+\.?[0-9]*|\.[0-9]+)(e[-+]?[0-9]+)?|nan|[-+]?inf(inity)?)'
+    + SPACES + r'$'
+)
+DATE_PATTERN = (
+    r'^' + SPACES
+    + r'([0-9]{4}[-/][0-9]{1,2}[-/][0-9]{1,2}|[0-9]{1,2}/[0-9]{1,2}/[0-9]{4})'
+    r'([ T][0-9]{1,2}:[0-9]{2}(:[0-9]{2}(\.[0-9]+)?)?([-+][0-9:]+|Z)?)?'
+    + SPACES + r'$'
+)
+TYPE_PATTERNS = {'numeric': NUMERIC_PATTERN, 'date': DATE_PATTERN}
+
+# PostgreSQL rejects queries with more target list entries than this.
+MAX_TARGET_ENTRIES = 1664
+
+# Percentiles stored for numeric values and text lengths. 50 is the median.
+PERCENTS = (1, 5, 25, 50, 75, 95, 99)
+
+# Number of rows fetched at a time by server-side cursors.
+ITERSIZE = 2000
+
+# Number of hash bits selecting a HyperLogLog register. 256 registers give a
+# relative error of about 6.5%.
+HLL_PRECISION = 8
+
+# Column types for declared PostgreSQL types that need no inference.
+DECLARED_COLUMN_TYPES = {
+    'int2': 'numeric',
+    'int4': 'numeric',
+    'int8': 'numeric',
+    'float4': 'numeric',
+    'float8': 'numeric',
+    'numeric': 'numeric',
+    'date': 'date',
+    'timestamp': 'date',
+    'timestamptz': 'date',
+}
+
+# Requests yielded by the generators named ``*_steps``. They hold the logic
+# of profiling functions without doing any I/O, so that the same logic runs
+# on a cursor with ``run_steps`` and on an asynchronous connection with
+# ``async_extract_metadata.run_steps``. The result of each request is sent
+# back to the generator, and its errors are raised in the generator.
+#
+# Run a query and get its first row, or all its rows.
+FetchOne = collections.namedtuple('FetchOne', ['query'])
+FetchAll = collections.namedtuple('FetchAll', ['query'])
+# Run a query and pass its rows to ``on_rows`` in batches, until ``on_rows``
+# returns True or the rows run out. Get None.
+FetchBatches = collections.namedtuple('FetchBatches',
+                                      ['query', 'name', 'on_rows'])
+# Run a query and get False if it raises ``psycopg2.DataError``, else True.
+Succeeds = collections.namedtuple('Succeeds', ['query'])
+
+
+def run_steps(data_cursor, steps, itersize=ITERSIZE):
+    """Execute the requests of a steps generator on a cursor.
+
+    Args:
+        steps (generator): Generator of ``FetchOne``, ``FetchAll``,
+            ``FetchBatches`` and ``Succeeds`` requests.
+        itersize (int): Number of rows fetched at a time for
+            ``FetchBatches``.
+
+    Returns:
+        The return value of the generator.
 
+    """
+
+    result = None
+    error = None
+    while True:
+        try:
+            if error is None:
+                request = steps.send(result)
+            else:
+                request = steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+
+        try:
+            result = execute_request(data_cursor, request, itersize)
+            error = None
+        except Exception as request_error:
+            result = None
+            error = request_error
+
+
+def execute_request(data_cursor, request, itersize=ITERSIZE):
+    """Execute a request of a steps generator, see ``run_steps``.
+
+    Batches are fetched through a server-side cursor. Outside autocommit
+    mode, a ``Succeeds`` query runs in a savepoint so that its failure does
+    not abort the transaction.
+
+    """
+
+    if isinstance(request, FetchBatches):
+        with server_side_cursor(data_cursor, request.name, itersize) \
+                as stream_cursor:
+            stream_cursor.execute(request.query)
+            while True:
+                rows = stream_cursor.fetchmany(stream_cursor.itersize)
+                if not rows or request.on_rows(rows):
+                    return None
+
+    if isinstance(request, Succeeds):
+        in_transaction = not data_cursor.connection.autocommit
+        if in_transaction:
+            data_cursor.execute('SAVEPOINT execute_request')
+        try:
+            data_cursor.execute(request.query)
+            succeeded = True
+        except psycopg2.DataError:
+            if not in_transaction:
+                return False
+            data_cursor.execute('ROLLBACK TO SAVEPOINT execute_request')
+            succeeded = False
+        if in_transaction:
+            data_cursor.execute('RELEASE SAVEPOINT execute_request')
+        return succeeded
+
+    data_cursor.execute(request.query)
+    if isinstance(request, FetchOne):
+        return data_cursor.fetchone()
+    return data_cursor.fetchall()
+
+
+def split_file_table_name(file_table_name):
+    """Return the schema and table names of a Data Table.
+
+    Args:
+        file_table_name (str): file_table_name of the Data Table in the
+            metabase, in <schema>.<table> format.
+
+    Returns:
+        (str, str): (schema name, table name)
+
+    """
+
+    schema_name_table_name_tp = file_table_name.split('.')
+    if len(schema_name_table_name_tp) != 2:
+        raise ValueError('file_table_name is not in <schema>.<table> '
+                         'format')
+
+    return schema_name_table_name_tp
+
+
+def table_level_metadata_query(schema_name, table_name, row_count='exact',
+                               condition=None):
+    """Return the query of the table level metadata of a table.
+
+    Its single row is (number of rows, number of columns, size in bytes,
+    total size in bytes). Everything but an exact number of rows is read
+    from the catalog. Sizes add up the table and its children, if any, as
+    rows are counted in both. The total size includes TOAST data and
+    indexes.
+
+    Args:
+        row_count (str): 'exact' counts the rows of the table. 'estimate'
+            takes the number of rows from ``pg_class.reltuples``, as of the
+            last ``ANALYZE`` or ``VACUUM``. None leaves it NULL.
+        condition (sql.Composable): If given, only count the rows
+            satisfying this condition. Requires an exact count.
+
+    Returns:
+        (sql.Composable, dict): Query and its parameters.
+
+    """
+
+    if row_count == 'exact':
+        n_rows = sql.SQL('(SELECT COUNT(*) FROM {}.{} {})').format(
+            sql.Identifier(schema_name),
+            sql.Identifier(table_name),
+            filter_clause(condition),
+        )
+    elif condition is not None:
+        raise ValueError('A condition requires an exact row count.')
+    elif row_count == 'estimate':
+        # Partitioned tables hold no rows, their reltuples adds up their
+        # partitions.
+        n_rows = sql.SQL("""SUM(
+            CASE WHEN c.relkind <> 'p' THEN GREATEST(c.reltuples, 0) END
+        )::BIGINT""")
+    elif row_count is None:
+        n_rows = sql.SQL('NULL::BIGINT')
+    else:
+        raise ValueError("row_count must be 'exact', 'estimate' or None")
+
+    return (
+        sql.SQL("""
+            WITH RECURSIVE root (relid) AS (
+                SELECT (
+                    quote_ident(%(schema)s) || '.' || quote_ident(%(table)s)
+                )::regclass::oid
+            ), tree (relid) AS (
+                SELECT relid FROM root
+                UNION
+                SELECT i.inhrelid
+                FROM pg_catalog.pg_inherits AS i
+                JOIN tree ON i.inhparent = tree.relid
+            )
+            SELECT
+                {},
+                (
+                    SELECT COUNT(*)
+                    FROM pg_catalog.pg_attribute AS a
+                    JOIN root ON a.attrelid = root.relid
+                    WHERE a.attnum > 0 AND NOT a.attisdropped
+                ),
+                SUM(PG_RELATION_SIZE(c.oid))::BIGINT,
+                SUM(PG_TOTAL_RELATION_SIZE(c.oid))::BIGINT
+            FROM tree
+            JOIN pg_catalog.pg_class AS c ON c.oid = tree.relid;
+        """).format(n_rows),
+        {
+            'schema': schema_name,
+            'table': table_name,
+        },
+    )
+
+
+def update_data_table_query(data_table_id, n_rows, n_cols, table_size,
+                            total_size=None, rows_estimated=False):
+    """Return the update of the table level metadata of a Data Table.
+
+    Args:
+        total_size (int): Size in bytes including TOAST data and indexes.
+        rows_estimated (bool): Whether ``n_rows`` is an estimate.
+
+    Returns:
+        (str, dict): Query and its parameters.
+
+    """
+
+    return (
+        """
+            UPDATE metabase.data_table
+            SET
+                number_rows = %(n_rows)s,
+                number_rows_estimated = %(rows_estimated)s,
+                number_columns = %(n_cols)s,
+                size = %(table_size)s,
+                total_size = %(total_size)s,
+                updated_by = %(user_name)s,
+                date_last_updated = (SELECT CURRENT_TIMESTAMP)
+            WHERE data_table_id = %(data_table_id)s
+            ;
+        """,
+        {
+            'n_rows': n_rows,
+            'rows_estimated': rows_estimated,
+            'n_cols': n_cols,
+            'table_size': table_size,
+            'total_size': total_size,
+            'user_name': getpass.getuser(),
+            'data_table_id': data_table_id,
+        },
+    )
+
+
+def analyze_table_query(schema_name, table_name):
+    """Return the ``ANALYZE`` of a table, refreshing its row estimate."""
+
+    return sql.SQL('ANALYZE {}.{}').format(sql.Identifier(schema_name),
+                                           sql.Identifier(table_name))
+
+
+def get_table_watermark(data_cursor, schema_name, table_name,
+                        checksum=False):
+    """Return the current state of a table, to detect changes.
+
+    The state is read from the catalog and statistics only: the file node of
+    the table, which changes when it is truncated or rewritten, its size,
+    its counters of inserted, updated and deleted rows, and a signature of
+    its column names and types. These are cheap to read but the counters
+    lag committed changes by up to a few seconds, and are reset with the
+    statistics, which only causes an unneeded profiling.
+
+    Args:
+        checksum (bool): Also compute a checksum of all rows, which detects
+            any change of the values but scans the table.
+
+    Returns:
+        dict: ``WATERMARK_COLUMNS`` -> value. checksum is None unless
+        requested, and options_hash is None until set from
+        ``hash_options``.
+
+    """
+
+    data_cursor.execute(
+        *table_watermark_query(schema_name, table_name, checksum))
+
+    return read_table_watermark(data_cursor.fetchone())
+
+
+# Columns of metabase.table_watermark describing the state of a table, in
+# the order of the results of table_watermark_query. options_hash describes
+# the options it was profiled with.
+WATERMARK_COLUMNS = (
+    'relfilenode',
+    'relation_size',
+    'n_tup_ins',
+    'n_tup_upd',
+    'n_tup_del',
+    'column_signature',
+    'checksum',
+    'options_hash',
+)
+
+
+def table_watermark_query(schema_name, table_name, checksum=False):
+    """Return the query of ``get_table_watermark``.
+
+    Returns:
+        (sql.Composable, dict): Query and its parameters.
+
+    """
+
+    if checksum:
+        checksum_expression = sql.SQL("""(
+            SELECT
+                COUNT(*) || ':' || COALESCE(SUM(
+                    ('x' || substr(md5(ROW(t.*)::TEXT), 1, 16))::BIT(64)::INT8
+                ), 0)
+            FROM {}.{} AS t
+        )""").format(sql.Identifier(schema_name), sql.Identifier(table_name))
+    else:
+        checksum_expression = sql.SQL('NULL::TEXT')
+
+    return (
+        sql.SQL("""
+            SELECT
+                c.relfilenode,
+                PG_RELATION_SIZE(c.oid),
+                s.n_tup_ins,
+                s.n_tup_upd,
+                s.n_tup_del,
+                (
+                    SELECT md5(string_agg(
+                        a.attname || ' ' || format_type(a.atttypid,
+                                                        a.atttypmod),
+                        ', ' ORDER BY a.attnum
+                    ))
+                    FROM pg_catalog.pg_attribute AS a
+                    WHERE
+                        a.attrelid = c.oid
+                        AND a.attnum > 0
+                        AND NOT a.attisdropped
+                ),
+                {},
+                NULL::TEXT
+            FROM pg_catalog.pg_class AS c
+            LEFT JOIN pg_catalog.pg_stat_user_tables AS s ON s.relid = c.oid
+            WHERE c.oid = (
+                quote_ident(%(schema)s) || '.' || quote_ident(%(table)s)
+            )::regclass;
+        """).format(checksum_expression),
+        {
+            'schema': schema_name,
+            'table': table_name,
+        },
+    )
+
+
+def get_id_watermark(metabase_cursor, data_table_id):
+    """Return the ID column of a Data Table and its greatest value profiled.
+
+    Returns:
+        (str, str): (ID column, greatest value), or (None, None).
+
+    """
+
+    metabase_cursor.execute(
+        """
+        SELECT id_column, max_id
+        FROM metabase.table_watermark
+        WHERE data_table_id = %(data_table_id)s;
+        """,
+        {'data_table_id': data_table_id},
+    )
+
+    return metabase_cursor.fetchone() or (None, None)
+
+
+def get_stored_watermark(metabase_cursor, data_table_id):
+    """Return the watermark of a Data Table when it was last profiled.
+
+    Returns:
+        dict: ``WATERMARK_COLUMNS`` -> value, or None if there is none.
+
+    """
+
+    metabase_cursor.execute(*stored_watermark_query(data_table_id))
+
+    return read_table_watermark(metabase_cursor.fetchone())
+
+
+def stored_watermark_query(data_table_id):
+    """Return the query of ``get_stored_watermark``.
+
+    Returns:
+        (sql.Composable, dict): Query and its parameters.
+
+    """
+
+    return (
+        sql.SQL("""
+            SELECT {}
+            FROM metabase.table_watermark
+            WHERE data_table_id = %(data_table_id)s;
+        """).format(sql.SQL(', ').join(
+            sql.Identifier(col) for col in WATERMARK_COLUMNS)),
+        {'data_table_id': data_table_id},
+    )
+
+
+def read_table_watermark(row):
+    """Return a watermark from a row of ``WATERMARK_COLUMNS`` or None."""
+
+    if row is None:
+        return None
+
+    return dict(zip(WATERMARK_COLUMNS, row))
+
+
+def hash_options(categorical_threshold, sample_percent=None,
+                 sample_method='SYSTEM', max_invalid_fraction=0,
+                 exact_quantiles=False, store_sketches=False,
+                 id_column=None, estimate_rows=False):
+    """Return a hash of the profiling options that affect the metadata.
+
+    It is stored as the options_hash of watermarks, so that a table
+    profiled again with other options is not skipped as unchanged. The
+    arguments are those of ``ExtractMetadata.process_table``.
+
+    Returns:
+        str: MD5 hex digest.
+
+    """
+
+    options = [
+        categorical_threshold,
+        sample_percent,
+        sample_method,
+        max_invalid_fraction,
+        exact_quantiles,
+        store_sketches,
+        id_column,
+        estimate_rows,
+    ]
+
+    return hashlib.md5(json.dumps(options).encode()).hexdigest()
+
+
+def is_unchanged(stored_watermark, watermark):
+    """Return True if a table has not changed since its stored watermark.
+
+    If ``watermark`` has a checksum, the checksums, column signatures and
+    options hashes are compared. Otherwise all other columns are, and a
+    table without statistics counters is always considered changed.
+
+    """
+
+    if stored_watermark is None:
+        return False
+
+    if watermark['checksum'] is not None:
+        return all(stored_watermark[col] == watermark[col]
+                   for col in ['column_signature', 'checksum',
+                               'options_hash'])
+
+    return all(
+        stored_watermark[col] is not None
+        and stored_watermark[col] == watermark[col]
+        for col in WATERMARK_COLUMNS
+        if col != 'checksum'
+    )
+
+
+def get_declared_column_types(data_cursor, schema_name, table_name):
+    """Return the columns of a table with types known from the catalog.
+
+    Reads the declared type of every column in one catalog query. Columns of
+    a numeric, date or timestamp type (or a domain over one) get their column
+    type directly. Other columns, such as text and varchar ones, need their
+    type inferred from the data.
+
+    Returns:
+        list: (column name, 'numeric', 'date' or None) tuples in column order.
+
+    """
+
+    data_cursor.execute(*declared_column_types_query(schema_name, table_name))
+
+    return read_declared_column_types(data_cursor.fetchall())
+
+
+def declared_column_types_query(schema_name, table_name):
+    """Return the catalog query of ``get_declared_column_types``.
+
+    Returns:
+        (str, dict): Query and its parameters.
+
+    """
+
+    return (
+        """
+        SELECT a.attname, COALESCE(b.typname, t.typname)
+        FROM pg_catalog.pg_attribute AS a
+        JOIN pg_catalog.pg_type AS t ON t.oid = a.atttypid
+        LEFT JOIN pg_catalog.pg_type AS b ON b.oid = t.typbasetype
+        WHERE
+            a.attrelid = (
+                quote_ident(%(schema)s) || '.' || quote_ident(%(table)s)
+            )::regclass
+            AND a.attnum > 0
+            AND NOT a.attisdropped
+        ORDER BY a.attnum;
+        """,
+        {
+            'schema': schema_name,
+            'table': table_name,
+        },
+    )
+
+
+def read_declared_column_types(rows):
+    """Return the column types from the rows of the catalog query."""
+
+    return [(col, DECLARED_COLUMN_TYPES.get(type_name))
+            for col, type_name in rows]
+
+
+# Query returning True if the try cast functions exist.
+TRY_CAST_FUNCTIONS_QUERY = """
+    SELECT
+        to_regprocedure('metabase.try_cast_numeric(text)') IS NOT NULL
+        AND to_regprocedure('metabase.try_cast_date(text)') IS NOT NULL
+    """
+
+
+def has_try_cast_functions(data_cursor):
+    """Return True if the try cast functions exist in the data database.
+
+    ``metabase.try_cast_numeric`` and ``metabase.try_cast_date`` are created
+    by the alembic migrations and by ``sql/try_cast_functions.sql``, which
+    installs them in a data database on its own. They return NULL for values
+    that do not cast instead of raising an error.
+
+    """
+
+    data_cursor.execute(TRY_CAST_FUNCTIONS_QUERY)
+
+    return data_cursor.fetchone()[0]
+
+
+def use_try_cast(data_cursor, max_invalid_fraction):
+    """Return True if columns are checked and cast with the try cast functions.
+
+    The try cast functions run an exception block per value, which is much
+    slower than matching patterns, so they are only used when some invalid
+    values are tolerated. Otherwise, a single invalid value already rules a
+    type out and a failing cast is handled by retyping the column.
+
+    Raises:
+        ValueError: ``max_invalid_fraction`` is set, but the try cast
+            functions do not exist in the data database.
+
+    """
+
+    if not max_invalid_fraction:
+        return False
+
+    if not has_try_cast_functions(data_cursor):
+        raise ValueError('max_invalid_fraction requires the try cast '
+                         'functions in the data database.')
+
+    return True
+
+
+def cast_expression(col, column_type, try_cast=False):
+    """Return the SQL expression casting a column to its column type.
+
+    Args:
+        try_cast (bool): Cast with the try cast functions, so values that do
+            not cast become NULL instead of raising an error.
+
+    Returns:
+        sql.Composable: Cast expression.
+
+    """
+
+    if column_type in ('code', 'text'):
+        return sql.SQL('{}::TEXT').format(sql.Identifier(col))
+
+    if try_cast:
+        return sql.SQL('metabase.{}({}::TEXT)').format(
+            sql.Identifier('try_cast_' + column_type),
+            sql.Identifier(col),
+        )
+
+    return sql.SQL('{}::{}').format(
+        sql.Identifier(col),
+        sql.SQL(column_type.upper()),
+    )
+
+
+def get_column_types(data_cursor, columns, categorical_threshold, schema_name,
+                     table_name, sample_percent=None, sample_method='SYSTEM',
+                     try_cast=False, max_invalid_fraction=0):
+    """Return the types of all columns from a single scan of the table.
+
+    For every column, check that all values look like numbers and that all
+    values look like dates, and estimate its number of distinct values, in
+    the single scan of ``distinct_value_sketches_query``. The checks failed
+    by the patterns are then probed with casts, see
+    ``probe_type_checks_steps``. A column is numeric or date according to the
+    first check it passes. The remaining columns are
+    code or text as decided by ``get_code_columns`` from the estimates.
+
+    If ``sample_percent`` is given, the numeric and date checks are first run
+    on a sample of the table. Checks that fail on the sample fail on the whole
+    table, so only the checks that passed are verified with a full scan. This
+    only holds when no invalid values are tolerated, so the sample is skipped
+    when ``max_invalid_fraction`` is not 0.
+
+    Args:
+        categorical_threshold (int or float): Maximum number of distinct
+            values in a code column, or maximum ratio of distinct values to
+            rows if it is a float below 1.
+        sample_percent (float): Percentage of the table to sample, or None to
+            check the whole table directly.
+        sample_method (str): 'SYSTEM' samples whole pages, 'BERNOULLI'
+            samples individual rows.
+        try_cast (bool): Count values that fail the try cast functions
+            instead of values that do not match a pattern.
+        max_invalid_fraction (float): Fraction of non-null values allowed to
+            fail the numeric or date check, e.g. 0.01 for a mostly numeric
+            column.
+
+    Returns:
+        dict: Column name -> 'numeric', 'date', 'code' or 'text'.
+
+    """
+
+    return run_steps(
+        data_cursor,
+        get_column_types_steps(columns, categorical_threshold, schema_name,
+                               table_name, sample_percent, sample_method,
+                               try_cast, max_invalid_fraction),
+    )
+
+
+def get_column_types_steps(columns, categorical_threshold, schema_name,
+                           table_name, sample_percent=None,
+                           sample_method='SYSTEM', try_cast=False,
+                           max_invalid_fraction=0):
+    """Steps of ``get_column_types``, see ``run_steps``."""
+
+    checks = type_checks(columns)
+    scanned_checks = checks
+
+    # With a tolerance, the invalid values of a whole column may be
+    # concentrated in the sample, so a check failing on it may still pass.
+    if sample_percent is not None and not max_invalid_fraction:
+        sample_results = yield from run_type_checks_steps(
+            scanned_checks,
+            schema_name,
+            table_name,
+            try_cast,
+            max_invalid_fraction,
+            tablesample_clause(sample_percent, sample_method),
+        )
+        scanned_checks = [check for check, passed
+                          in zip(scanned_checks, sample_results) if passed]
+
+    # The checks are counted in the scan estimating distinct values.
+    distinct_value_sketches = read_distinct_value_sketches(
+        columns,
+        (yield FetchAll(distinct_value_sketches_query(
+            columns, schema_name, table_name, scanned_checks, try_cast))),
+        scanned_checks,
+    )
+    results = yield from probe_type_checks_steps(
+        checks,
+        dict(zip(scanned_checks, distinct_value_sketches[2])),
+        schema_name,
+        table_name,
+        try_cast,
+        max_invalid_fraction,
+    )
+    column_types = read_type_checks(columns, checks, results)
+
+    other_columns = [col for col in columns if col not in column_types]
+    code_columns = yield from get_code_columns_steps(other_columns,
+                                                     categorical_threshold,
+                                                     schema_name, table_name,
+                                                     distinct_value_sketches)
+    for col in other_columns:
+        if col in code_columns:
+            column_types[col] = 'code'
+        else:
+            column_types[col] = 'text'
+
+    return column_types
+
+
+def type_checks(columns):
+    """Return the numeric and date checks of columns.
+
+    Returns:
+        list: (column name, type) tuples, the numeric check of a column
+        first.
+
+    """
+
+    return [(col, column_type)
+            for col in columns
+            for column_type in ('numeric', 'date')]
+
+
+def probe_type_checks_steps(checks, check_counts, schema_name, table_name,
+                            try_cast=False, max_invalid_fraction=0):
+    """Return the results of type checks, probing failed checks with casts.
+
+    A check failed by the patterns may still pass, as casts accept more forms
+    than the patterns match. Such a check is probed with a cast of the values
+    of its column that miss the pattern, which stops at the first value that
+    does not cast, unless the column passed an earlier check. With the try
+    cast functions, the values that do not cast are counted instead, up to
+    the number of invalid values tolerated.
+
+    Args:
+        checks (list): (column name, type) tuples from ``type_checks``.
+        check_counts (dict): Check -> (number of invalid values, number of
+            non-null values) for the checks scanned with the patterns. The
+            other checks failed on a sample.
+        try_cast (bool): Count the values that fail the try cast functions.
+        max_invalid_fraction (float): Fraction of non-null values allowed to
+            fail a check. Without the try cast functions, the probe of a
+            check fails on the first value that does not cast.
+
+    Returns:
+        list: One bool per check, True if the column passed it.
+
+    """
+
+    results = []
+    typed_columns = set()
+    for check in checks:
+        col, column_type = check
+        invalid_count, non_null_count = check_counts.get(check, (None, 0))
+        max_invalid_count = int(max_invalid_fraction * non_null_count)
+        passed = (invalid_count is not None
+                  and invalid_count <= max_invalid_count)
+        if not passed and col not in typed_columns:
+            if try_cast:
+                (invalid_count,) = yield FetchOne(try_cast_failures_query(
+                    col, column_type, schema_name, table_name,
+                    max_invalid_count + 1))
+                passed = invalid_count <= max_invalid_count
+            else:
+                passed = yield Succeeds(cast_check_query(
+                    col, column_type, schema_name, table_name,
+                    pattern_misses=True))
+        if passed:
+            typed_columns.add(col)
+        results.append(passed)
+
+    return results
+
+
+def try_cast_failures_query(col, column_type, schema_name, table_name,
+                            limit):
+    """Return the query counting values of a column that do not cast.
+
+    The values are cast with the try cast functions, and counted up to
+    ``limit`` only.
+
+    """
+
+    return sql.SQL("""
+        SELECT COUNT(*)
+        FROM (
+            SELECT 1
+            FROM {schema}.{table}
+            WHERE {col} IS NOT NULL AND {cast} IS NULL
+            LIMIT {limit}
+        ) AS failures
+        """).format(
+        schema=sql.Identifier(schema_name),
+        table=sql.Identifier(table_name),
+        col=sql.Identifier(col),
+        cast=cast_expression(col, column_type, try_cast=True),
+        limit=sql.Literal(limit),
+    )
+
+
+def tablesample_clause(sample_percent, sample_method='SYSTEM'):
+    """Return the ``TABLESAMPLE`` clause sampling a percentage of a table.
+
+    Args:
+        sample_method (str): 'SYSTEM' samples whole pages, 'BERNOULLI'
+            samples individual rows.
+
+    """
+
+    if sample_method not in ('SYSTEM', 'BERNOULLI'):
+        raise ValueError('sample_method must be SYSTEM or BERNOULLI')
+
+    return sql.SQL('TABLESAMPLE {} ({})').format(
+        sql.SQL(sample_method), sql.Literal(sample_percent))
+
+
+def read_type_checks(columns, checks, results):
+    """Return the types of the columns that passed a type check.
+
+    A column is numeric or date according to the first check it passed.
+
+    Args:
+        checks (list): (column name, type) tuples from ``type_checks``.
+        results (list): One bool per check.
+
+    Returns:
+        dict: Column name -> 'numeric' or 'date'. Columns that passed no
+        check are left out.
+
+    """
+
+    passed_checks = {check for check, passed in zip(checks, results)
+                     if passed}
+
+    column_types = {}
+    for col in columns:
+        if (col, 'numeric') in passed_checks:
+            column_types[col] = 'numeric'
+        elif (col, 'date') in passed_checks:
+            column_types[col] = 'date'
+
+    return column_types
+
+
+def is_ratio_threshold(categorical_threshold):
+    """Return True if a categorical threshold is a distinct to rows ratio."""
+
+    return (isinstance(categorical_threshold, float)
+            and categorical_threshold < 1)
+
+
+def get_code_columns(data_cursor, columns, categorical_threshold, schema_name,
+                     table_name, distinct_value_sketches=None):
+    """Return the columns with few enough distinct values to be code.
+
+    The number of distinct values of every column is estimated with
+    HyperLogLog sketches computed in a single scan, and the columns whose
+    estimate is more than three standard errors above the cutoff are text.
+    With a ratio ``categorical_threshold``, distinct values are only counted
+    exactly for columns whose estimate is within three standard errors of
+    the cutoff. With an absolute ``categorical_threshold``, they are counted
+    exactly for all the other columns, as estimates of a few distinct values
+    miss values whose hashes collide. Exact counts of all these columns come
+    from one more scan, see ``count_distinct_values``.
+
+    Args:
+        distinct_value_sketches (tuple): Result of
+            ``read_distinct_value_sketches`` for at least ``columns``, if the
+            table was already scanned for it.
+
+    Returns:
+        list: Names of the code columns.
+
+    """
+
+    return run_steps(
+        data_cursor,
+        get_code_columns_steps(columns, categorical_threshold, schema_name,
+                               table_name, distinct_value_sketches),
+    )
+
+
+def get_code_columns_steps(columns, categorical_threshold, schema_name,
+                           table_name, distinct_value_sketches=None):
+    """Steps of ``get_code_columns``, see ``run_steps``."""
+
+    if not columns:
+        return []
+
+    if distinct_value_sketches is None:
+        distinct_value_sketches = read_distinct_value_sketches(
+            columns,
+            (yield FetchAll(distinct_value_sketches_query(columns,
+                                                          schema_name,
+                                                          table_name))),
+        )
+    (n_rows, sketches, _) = distinct_value_sketches
+
+    is_ratio = is_ratio_threshold(categorical_threshold)
+    max_distinct = categorical_threshold
+    if is_ratio:
+        max_distinct = int(categorical_threshold * n_rows)
+
+    code_columns = []
+    counted_columns = []
+    for col in columns:
+        is_code = is_code_estimate(sketches[col], max_distinct)
+        if is_code is None or (is_code and not is_ratio):
+            counted_columns.append(col)
+        elif is_code:
+            code_columns.append(col)
+
+    if counted_columns:
+        n_distinct = yield from count_distinct_values_steps(
+            counted_columns, schema_name, table_name, max_distinct)
+        code_columns.extend(col for col in counted_columns
+                            if n_distinct[col] <= max_distinct)
+
+    return [col for col in columns if col in code_columns]
+
+
+def is_code_estimate(sketch, max_distinct):
+    """Decide from a HyperLogLog sketch if a column is a code column.
+
+    Returns:
+        bool: True or False if the estimate of distinct values is more than
+        three standard errors below or above ``max_distinct``, None if the
+        distinct values have to be counted exactly.
+
+    """
+
+    estimate = sketch.estimate()
+    margin = 3 * sketch.relative_error * max_distinct
+    if estimate < max_distinct - margin:
+        return True
+    if estimate > max_distinct + margin:
+        return False
+    return None
+
+
+def distinct_value_sketches_query(columns, schema_name, table_name,
+                                  checks=(), try_cast=False):
+    """Return the query of HyperLogLog sketches of columns.
+
+    The columns are unpivoted so that one grouped aggregate computes the
+    largest hash rank for every (column, register) pair, in a single scan of
+    the table. The values failing type checks are counted in the same scan.
+    Each row of its result is (column index, register, rank, number of
+    rows, number of non-null values), then the number of invalid values of
+    each check.
+
+    Args:
+        checks (list): (column name, type) tuples from ``type_checks``.
+        try_cast (bool): Count values that fail the try cast functions
+            instead of values that do not match a pattern.
+
+    """
+
+    n_rank_bits = 32 - HLL_PRECISION
+
+    invalid_counts = [
+        sql.SQL('COUNT(*) FILTER (WHERE column_index = {} AND {})').format(
+            sql.Literal(columns.index(col)),
+            invalid_value_condition(sql.SQL('value'), column_type, try_cast),
+        )
+        for col, column_type in checks
+    ]
+
+    return sql.SQL("""
+        SELECT
+            column_index,
+            hash & {register_mask},
+            MAX(COALESCE(
+                NULLIF(POSITION(B'1' IN
+                    ((hash >> {precision}) & {rank_mask})::BIT({rank_bits})
+                ), 0),
+                {rank_bits} + 1
+            )),
+            COUNT(*),
+            COUNT(value)
+            {invalid_counts}
+        FROM (
+            SELECT v.column_index, v.value, hashtext(v.value) AS hash
+            FROM {schema}.{table}
+            CROSS JOIN LATERAL (VALUES {values}) AS v (column_index, value)
+        ) AS hashes
+        GROUP BY 1, 2
+        """).format(
+        register_mask=sql.Literal((1 << HLL_PRECISION) - 1),
+        precision=sql.Literal(HLL_PRECISION),
+        rank_mask=sql.Literal((1 << n_rank_bits) - 1),
+        rank_bits=sql.Literal(n_rank_bits),
+        invalid_counts=sql.SQL('').join(
+            sql.SQL(', {}').format(count) for count in invalid_counts),
+        schema=sql.Identifier(schema_name),
+        table=sql.Identifier(table_name),
+        values=unpivoted_values(
+            sql.SQL('{}::TEXT').format(sql.Identifier(col))
+            for col in columns
+        ),
+    )
+
+
+def read_distinct_value_sketches(columns, rows, checks=()):
+    """Build the sketches of ``distinct_value_sketches_query`` from its rows.
+
+    Returns:
+        (int, dict, list): Number of rows in the table, column name ->
+        ``HyperLogLog`` sketch, and (number of invalid values, number of
+        non-null values) of the column of each check.
+
+    """
+
+    sketches = {col: HyperLogLog(HLL_PRECISION) for col in columns}
+    n_rows = 0
+    non_null_counts = [0] * len(columns)
+    invalid_counts = [0] * len(checks)
+    for row in rows:
+        column_index, register, rank, n_values, n_non_null = row[:5]
+        if column_index == 0:
+            n_rows += n_values
+        non_null_counts[column_index] += n_non_null
+        for i, n_invalid in enumerate(row[5:]):
+            invalid_counts[i] += n_invalid
+        if register is not None:
+            sketches[columns[column_index]].update_register(register, rank)
+
+    check_counts = [
+        (n_invalid, non_null_counts[columns.index(col)])
+        for (col, _), n_invalid in zip(checks, invalid_counts)
+    ]
+
+    return (n_rows, sketches, check_counts)
+
+
+def count_distinct_values(data_cursor, columns, schema_name, table_name,
+                          limit):
+    """Return the numbers of distinct values in columns, up to ``limit + 1``.
+
+    The distinct values of all columns are counted in a single scan, on the
+    server, so that only one row per column is fetched. The server holds the
+    distinct values of every column, so the columns are expected to have few
+    distinct values, as estimated by ``distinct_value_sketches_query``.
+
+    Returns:
+        dict: Column name -> number of distinct non-null values, or
+        ``limit + 1`` if there are more than ``limit``.
+
+    """
+
+    return run_steps(
+        data_cursor,
+        count_distinct_values_steps(columns, schema_name, table_name, limit),
+    )
+
+
+def count_distinct_values_steps(columns, schema_name, table_name, limit):
+    """Steps of ``count_distinct_values``, see ``run_steps``."""
+
+    n_distinct = {col: 0 for col in columns}
+    for column_index, count in (yield FetchAll(count_distinct_values_query(
+            columns, schema_name, table_name))):
+        n_distinct[columns[column_index]] = min(count, limit + 1)
+
+    return n_distinct
+
+
+def count_distinct_values_query(columns, schema_name, table_name):
+    """Return the query counting the distinct values of columns.
+
+    Values are compared as text, as in ``code_frequencies_query``. Each row
+    of its result is (column index, number of distinct non-null values).
+
+    """
+
+    return sql.SQL("""
+        SELECT column_index, COUNT(*)
+        FROM (
+            SELECT DISTINCT v.column_index, v.value
+            FROM {schema}.{table}
+            CROSS JOIN LATERAL (VALUES {values}) AS v (column_index, value)
+            WHERE v.value IS NOT NULL
+        ) AS distinct_values
+        GROUP BY 1
+        """).format(
+        schema=sql.Identifier(schema_name),
+        table=sql.Identifier(table_name),
+        values=unpivoted_values(
+            sql.SQL('{}::TEXT').format(sql.Identifier(col))
+            for col in columns
+        ),
+    )
+
+
+@contextlib.contextmanager
+def server_side_cursor(data_cursor, name, itersize=ITERSIZE):
+    """Open a named cursor on the connection of ``data_cursor``.
+
+    A named cursor keeps its result set on the server and fetches it in
+    batches of ``itersize`` rows. Named cursors only exist inside a
+    transaction, so in autocommit mode, autocommit is turned off while the
+    cursor is open and the transaction is rolled back when it is closed.
+    Otherwise the cursor is opened in the current transaction.
+
+    """
+
+    data_conn = data_cursor.connection
+    if not data_conn.autocommit:
+        with data_conn.cursor(name) as stream_cursor:
+            stream_cursor.itersize = itersize
+            yield stream_cursor
+        return
+
+    data_conn.autocommit = False
+    try:
+        with data_conn.cursor(name) as stream_cursor:
+            stream_cursor.itersize = itersize
+            yield stream_cursor
+    finally:
+        data_conn.rollback()
+        data_conn.autocommit = True
+
+
+def values_query(expressions, schema_name, table_name, condition=None):
+    """Return the query selecting expressions from the rows of a table."""
+
+    return sql.SQL('SELECT {} FROM {}.{} {}').format(
+        sql.SQL(', ').join(expressions),
+        sql.Identifier(schema_name),
+        sql.Identifier(table_name),
+        filter_clause(condition),
+    )
+
+
+def filter_clause(condition, keyword='WHERE'):
+    """Return the clause filtering rows with a condition.
+
+    Args:
+        condition (sql.Composable): Condition on the rows of a table, or
+            None to keep all rows.
+        keyword (str): 'WHERE', or 'AND' to extend a WHERE clause.
+
+    """
+
+    if condition is None:
+        return sql.SQL('')
+
+    return sql.SQL('{} ({})').format(sql.SQL(keyword), condition)
+
+
+def update_value_sketches(sketches, rows):
+    """Add the non-null values of rows to one sketch per column."""
+
+    for row in rows:
+        for sketch, value in zip(sketches, row):
+            if value is not None:
+                sketch.update(value)
+
+
+def length_counts_query(expressions, schema_name, table_name,
+                        condition=None):
+    """Return the query counting the values of each text length.
+
+    The expressions are unpivoted so that one grouped aggregate counts the
+    values of every (expression, length) pair in a single scan. Each row of
+    its result is (expression index, length, count, max byte length, min
+    byte length, total byte length) for non-null values.
+
+    """
+
+    return sql.SQL("""
+        SELECT
+            v.column_index,
+            char_length(v.value),
+            COUNT(*),
+            MAX(octet_length(v.value)),
+            MIN(octet_length(v.value)),
+            SUM(octet_length(v.value))
+        FROM {schema}.{table}
+        CROSS JOIN LATERAL (VALUES {values}) AS v (column_index, value)
+        WHERE v.value IS NOT NULL {condition}
+        GROUP BY 1, 2
+        """).format(
+        schema=sql.Identifier(schema_name),
+        table=sql.Identifier(table_name),
+        values=unpivoted_values(expressions),
+        condition=filter_clause(condition, 'AND'),
+    )
+
+
+def read_length_counts(n_expressions, rows):
+    """Split the rows of ``length_counts_query`` by expression."""
+
+    length_counts = [[] for _ in range(n_expressions)]
+    for row in rows:
+        length_counts[row[0]].append(row[1:])
+
+    return length_counts
+
+
+def stream_code_frequencies(data_cursor, expressions, schema_name,
+                            table_name, itersize=ITERSIZE, condition=None):
+    """Generate the code counts of ``code_frequencies_query`` as they arrive.
+
+    The counts are fetched through a server-side cursor, ``itersize`` at a
+    time, so that high cardinality columns are never held in memory at
+    once.
+
+    Yields:
+        (int, str, int): Expression index, code and frequency, ordered by
+        expression index and code.
+
+    """
+
+    with server_side_cursor(data_cursor, 'stream_code_frequencies',
+                            itersize) as stream_cursor:
+        stream_cursor.execute(code_frequencies_query(
+            expressions, schema_name, table_name, condition))
+        for row in stream_cursor:
+            yield row
+
+
+def code_frequencies_query(expressions, schema_name, table_name,
+                           condition=None):
+    """Return the query counting the values of each code.
+
+    The expressions are unpivoted so that one grouped aggregate counts the
+    values of every (expression, code) pair in a single scan. Each row of
+    its result is (expression index, code, frequency) for non-null values,
+    ordered by expression index and code.
+
+    """
+
+    return sql.SQL("""
+        SELECT v.column_index, v.value, COUNT(*)
+        FROM {schema}.{table}
+        CROSS JOIN LATERAL (VALUES {values}) AS v (column_index, value)
+        WHERE v.value IS NOT NULL {condition}
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        """).format(
+        schema=sql.Identifier(schema_name),
+        table=sql.Identifier(table_name),
+        values=unpivoted_values(expressions),
+        condition=filter_clause(condition, 'AND'),
+    )
+
+
+def read_code_frequencies(n_expressions, rows):
+    """Split the rows of ``code_frequencies_query`` by expression."""
+
+    code_frequencies = [[] for _ in range(n_expressions)]
+    for column_index, code, frequency in rows:
+        code_frequencies[column_index].append((code, frequency))
+
+    return code_frequencies
+
+
+def unpivoted_values(expressions):
+    """Return the ``VALUES`` list unpivoting expressions by their index."""
+
+    return sql.SQL(', ').join(
+        sql.SQL('({}, {})').format(sql.Literal(i), expression)
+        for i, expression in enumerate(expressions)
+    )
+
+
+def percentiles_expression(expression):
+    """Return the SQL expression for the exact ``PERCENTS`` of a value."""
+
+    return sql.SQL(
+        'PERCENTILE_CONT({}::FLOAT8[]) WITHIN GROUP (ORDER BY {})'
+    ).format(
+        sql.Literal([percent / 100 for percent in PERCENTS]),
+        expression,
+    )
+
+
+def run_type_checks(data_cursor, checks, schema_name, table_name,
+                    try_cast=False, max_invalid_fraction=0,
+                    sample=sql.SQL('')):
+    """Run type checks on columns in a single scan of the table.
+
+    Args:
+        checks (list): (column name, type) tuples. The type is 'numeric' or
+            'date'.
+        try_cast (bool): Check castability with the try cast functions.
+        max_invalid_fraction (float): Fraction of non-null values allowed to
+            fail the numeric or date check.
+        sample (sql.Composable): ``TABLESAMPLE`` clause to check a sample of
+            the table only.
+
+    Returns:
+        list: One bool per check, True if the column passed it.
+
+    """
+
+    return run_steps(
+        data_cursor,
+        run_type_checks_steps(checks, schema_name, table_name, try_cast,
+                              max_invalid_fraction, sample),
+    )
+
+
+def run_type_checks_steps(checks, schema_name, table_name, try_cast=False,
+                          max_invalid_fraction=0, sample=sql.SQL('')):
+    """Steps of ``run_type_checks``, see ``run_steps``."""
+
+    aggregates = type_check_aggregates(checks, try_cast, max_invalid_fraction)
+
+    return (yield from select_aggregates_steps(aggregates, schema_name,
+                                               table_name, sample))
+
+
+def type_check_aggregates(checks, try_cast=False, max_invalid_fraction=0):
+    """Return the aggregates of ``run_type_checks``, one per check."""
+
+    aggregates = []
+    for col, column_type in checks:
+        aggregates.append(
+            sql.SQL('COUNT(*) FILTER (WHERE {}) <= {} * COUNT({})').format(
+                invalid_value_condition(
+                    sql.SQL('{}::TEXT').format(sql.Identifier(col)),
+                    column_type,
+                    try_cast,
+                ),
+                sql.Literal(max_invalid_fraction),
+                sql.Identifier(col),
+            )
+        )
+
+    return aggregates
+
+
+def invalid_value_condition(value, column_type, try_cast=False):
+    """Return the condition of a text value not castable to a column type.
+
+    Args:
+        value (sql.Composable): Text expression.
+        try_cast (bool): Check with the try cast functions, see
+            ``cast_expression``, instead of the pattern of the type only.
+            Values missing the pattern are invalid without the cost of a
+            failed cast, see ``probe_type_checks_steps``.
+
+    """
+
+    if not try_cast:
+        return sql.SQL('{} !~ {}').format(
+            value, sql.Literal(TYPE_PATTERNS[column_type]))
+
+    return sql.SQL(
+        '{0} IS NOT NULL AND CASE WHEN {0} ~ {1} THEN metabase.{2}({0}) END '
+        'IS NULL'
+    ).format(
+        value,
+        sql.Literal(TYPE_PATTERNS[column_type]),
+        sql.Identifier('try_cast_' + column_type),
+    )
+
+
+def select_aggregates(data_cursor, aggregates, schema_name, table_name,
+                      sample=sql.SQL(''), condition=None):
+    """Return the values of aggregates computed over a table.
+
+    The aggregates are evaluated together in a single ``SELECT``. They are
+    only split into several queries when there are more of them than
+    PostgreSQL allows in one target list.
+
+    Args:
+        aggregates (list): ``sql.Composable`` aggregate expressions.
+        sample (sql.Composable): ``TABLESAMPLE`` clause to aggregate over a
+            sample of the table only.
+        condition (sql.Composable): If given, only aggregate the rows
+            satisfying this condition.
+
+    Returns:
+        list: One value per aggregate.
+
+    """
+
+    return run_steps(
+        data_cursor,
+        select_aggregates_steps(aggregates, schema_name, table_name, sample,
+                                condition),
+    )
+
+
+def select_aggregates_steps(aggregates, schema_name, table_name,
+                            sample=sql.SQL(''), condition=None):
+    """Steps of ``select_aggregates``, see ``run_steps``."""
+
+    results = []
+    for query in aggregate_queries(aggregates, schema_name, table_name,
+                                   sample, condition):
+        results.extend((yield FetchOne(query)))
+
+    return results
+
+
+def aggregate_queries(aggregates, schema_name, table_name,
+                      sample=sql.SQL(''), condition=None):
+    """Return the queries of ``select_aggregates``, each returning one row."""
+
+    return [
+        sql.SQL('SELECT {} FROM {}.{} {} {}').format(
+            sql.SQL(', ').join(aggregates[start:start + MAX_TARGET_ENTRIES]),
+            sql.Identifier(schema_name),
+            sql.Identifier(table_name),
+            sample,
+            filter_clause(condition),
+        )
+        for start in range(0, len(aggregates), MAX_TARGET_ENTRIES)
+    ]
+
+
+def get_column_metadata(data_cursor, column_types, schema_name, table_name,
+                        try_cast_columns=(), exact_quantiles=False,
+                        itersize=ITERSIZE, with_code_frequencies=True,
+                        with_sketches=False, condition=None):
+    """Compute the metadata of the columns of a table in a few scans.
+
+    Null counts of all columns and minimum, maximum and mean of numeric and
+    date columns are computed by a single ``SELECT`` of aggregates, which is
+    split only at the target list limit of PostgreSQL. Text lengths of all
+    text columns and codes of all code columns are each counted in one more
+    scan, and numeric percentiles are estimated in one streamed scan of all
+    numeric columns. With ``exact_quantiles``, numeric percentiles are
+    computed with ``PERCENTILE_CONT`` in the first scan instead.
+
+    Args:
+        column_types (dict): Column name -> 'numeric', 'text', 'date' or
+            'code'.
+        try_cast_columns (iterable): Numeric and date columns to cast with the
+            try cast functions.
+        itersize (int): Number of rows fetched at a time from server-side
+            cursors.
+        with_code_frequencies (bool): Count the codes of code columns,
+            holding all of them in memory. When False, they are left to be
+            streamed to the metabase by ``code_frequency_rows``.
+        with_sketches (bool): Also keep what ``column_sketch`` needs: the
+            sum and KLL sketch of numeric columns and the length counts of
+            text columns. Requires estimated quantiles.
+        condition (sql.Composable): If given, only profile the rows
+            satisfying this condition.
+
+    Returns:
+        dict: Column name -> dict of metadata named like the columns of the
+        metabase table for its type, plus null_count, non_null_count and
+        invalid_count, the number of non-null values that do not cast. The
+        metadata of a code column is its (code, frequency) tuples under
+        frequencies.
+
+    """
+
+    return run_steps(
+        data_cursor,
+        get_column_metadata_steps(column_types, schema_name, table_name,
+                                  try_cast_columns, exact_quantiles,
+                                  with_code_frequencies, with_sketches,
+                                  condition),
+        itersize,
+    )
+
+
+def get_column_metadata_steps(column_types, schema_name, table_name,
+                              try_cast_columns=(), exact_quantiles=False,
+                              with_code_frequencies=True,
+                              with_sketches=False, condition=None):
+    """Steps of ``get_column_metadata``, see ``run_steps``."""
+
+    if with_sketches and exact_quantiles:
+        raise ValueError('Sketches require estimated quantiles.')
+
+    expressions = column_expressions(column_types, try_cast_columns)
+    numeric_columns = columns_of_type(column_types, 'numeric')
+    text_columns = columns_of_type(column_types, 'text')
+    code_columns = columns_of_type(column_types, 'code')
+
+    aggregates, keys = column_metadata_aggregates(column_types, expressions,
+                                                  exact_quantiles,
+                                                  with_sketches,
+                                                  try_cast_columns)
+    results = yield from select_aggregates_steps(aggregates, schema_name,
+                                                 table_name,
+                                                 condition=condition)
+    column_metadata = read_column_aggregates(column_types, keys, results)
+
+    if numeric_columns and not exact_quantiles:
+        sketches = [KllSketch() for _ in numeric_columns]
+        yield FetchBatches(
+            values_query([expressions[col] for col in numeric_columns],
+                         schema_name, table_name, condition),
+            'get_value_sketches',
+            lambda rows: update_value_sketches(sketches, rows),
+        )
+        for col, sketch in zip(numeric_columns, sketches):
+            column_metadata[col]['percentiles'] = sketch.quantiles(
+                [percent / 100 for percent in PERCENTS])
+            if with_sketches:
+                column_metadata[col]['kll_sketch'] = sketch
+
+    for col in numeric_columns:
+        column_metadata[col].update(read_percentiles(
+            column_metadata[col].pop('percentiles')))
+
+    if text_columns:
+        length_counts = read_length_counts(
+            len(text_columns),
+            (yield FetchAll(length_counts_query(
+                [expressions[col] for col in text_columns],
+                schema_name,
+                table_name,
+                condition,
+            ))),
+        )
+        for col, col_length_counts in zip(text_columns, length_counts):
+            column_metadata[col].update(
+                get_text_metadata(col_length_counts))
+            if with_sketches:
+                column_metadata[col]['length_counts'] = col_length_counts
+
+    if code_columns and with_code_frequencies:
+        rows = []
+        yield FetchBatches(
+            code_frequencies_query(
+                [expressions[col] for col in code_columns],
+                schema_name,
+                table_name,
+                condition,
+            ),
+            'get_code_frequencies',
+            rows.extend,
+        )
+        code_frequencies = read_code_frequencies(len(code_columns), rows)
+        for col, frequencies in zip(code_columns, code_frequencies):
+            column_metadata[col]['frequencies'] = frequencies
+
+    return column_metadata
+
+
+def column_expressions(column_types, try_cast_columns=()):
+    """Return the expressions casting columns to their column types.
+
+    Returns:
+        dict: Column name -> ``sql.Composable`` from ``cast_expression``.
+
+    """
+
+    return {
+        col: cast_expression(col, column_type, col in try_cast_columns)
+        for col, column_type in column_types.items()
+    }
+
+
+def columns_of_type(column_types, column_type):
+    """Return the names of the columns of a column type."""
+
+    return [col for col, col_type in column_types.items()
+            if col_type == column_type]
+
+
+def column_metadata_aggregates(column_types, expressions,
+                               exact_quantiles=False, with_sketches=False,
+                               try_cast_columns=()):
+    """Return the aggregates of the first scan of ``get_column_metadata``.
+
+    Args:
+        try_cast_columns (iterable): Columns cast with the try cast
+            functions, whose values that do not cast are counted.
+
+    Returns:
+        (list, list): ``sql.Composable`` aggregates, the first one counting
+        rows, and the (column name, metadata name) keys of the others.
+
+    """
+
+    aggregates = [sql.SQL('COUNT(*)')]
+    keys = []
+    for col, column_type in column_types.items():
+        aggregates.append(sql.SQL('COUNT({})').format(sql.Identifier(col)))
+        keys.append((col, 'non_null_count'))
+        if column_type in ('numeric', 'date') and col in try_cast_columns:
+            aggregates.append(sql.SQL('COUNT({}) - COUNT({})').format(
+                sql.Identifier(col), expressions[col]))
+            keys.append((col, 'invalid_count'))
+
+        if column_type == 'numeric':
+            aggregates.extend(
+                sql.SQL(template).format(expressions[col])
+                for template in ['MIN({})', 'MAX({})', 'AVG({})']
+            )
+            keys.extend([(col, 'minimum'), (col, 'maximum'), (col, 'mean')])
+            if with_sketches:
+                aggregates.append(
+                    sql.SQL('SUM({})').format(expressions[col]))
+                keys.append((col, 'sum'))
+            if exact_quantiles:
+                aggregates.append(percentiles_expression(expressions[col]))
+                keys.append((col, 'percentiles'))
+        elif column_type == 'date':
+            aggregates.extend(
+                sql.SQL(template).format(expressions[col])
+                for template in ['MIN({})', 'MAX({})']
+            )
+            keys.extend([(col, 'min_date'), (col, 'max_date')])
+
+    return (aggregates, keys)
+
+
+def read_column_aggregates(column_types, keys, results):
+    """Return the metadata of columns from ``column_metadata_aggregates``.
+
+    Returns:
+        dict: Column name -> dict of metadata with null_count, non_null_count
+        and invalid_count, the number of non-null values that do not cast.
+
+    """
+
+    column_metadata = {col: {} for col in column_types}
+    for (col, key), value in zip(keys, results[1:]):
+        column_metadata[col][key] = value
+    for metadata in column_metadata.values():
+        metadata['null_count'] = results[0] - metadata['non_null_count']
+        metadata.setdefault('invalid_count', 0)
+
+    return column_metadata
+
+
+def read_percentiles(percentiles):
+    """Name the values of ``PERCENTS`` percentiles.
+
+    Args:
+        percentiles (list): One value per percent, or None if there are no
+            values.
+
+    Returns:
+        dict: percentile_<percent> -> value.
+
+    """
+
+    percentiles = percentiles or [None] * len(PERCENTS)
+
+    return {'percentile_{}'.format(percent): value
+            for percent, value in zip(PERCENTS, percentiles)}
+
+
+def get_column_metadata_in_parallel(data_connection_string, snapshot_id,
+                                    column_types, schema_name, table_name,
+                                    try_cast_columns=(),
+                                    exact_quantiles=False, workers=2,
+                                    with_code_frequencies=True,
+                                    with_sketches=False, condition=None):
+    """Compute the metadata of the columns of a table on several connections.
+
+    The columns are split into ``workers`` groups, each profiled by
+    ``get_column_metadata`` on its own connection in its own thread. All
+    connections import the same snapshot, so they see the same rows as the
+    transaction that exported it.
+
+    Args:
+        data_connection_string (str): Connection string of the data database.
+        snapshot_id (str): Snapshot from ``pg_export_snapshot()``. The
+            exporting transaction must stay open until this returns.
+        workers (int): Maximum number of connections.
+        with_code_frequencies (bool): See ``get_column_metadata``.
+        with_sketches (bool): See ``get_column_metadata``.
+        condition (sql.Composable): See ``get_column_metadata``.
+
+    Returns:
+        dict: Column name -> dict of metadata, see ``get_column_metadata``.
+
+    """
+
+    columns = list(column_types)
+    n_groups = max(1, min(workers, len(columns)))
+    groups = [{col: column_types[col] for col in columns[i::n_groups]}
+              for i in range(n_groups)]
+
+    def profile(group):
+        """Profile a group of columns in the snapshot."""
+
+        data_conn = psycopg2.connect(data_connection_string)
+        try:
+            data_conn.set_session(isolation_level='REPEATABLE READ',
+                                  readonly=True)
+            with data_conn.cursor() as data_cursor:
+                data_cursor.execute('SET TRANSACTION SNAPSHOT %s',
+                                    [snapshot_id])
+                return get_column_metadata(
+                    data_cursor, group, schema_name, table_name,
+                    try_cast_columns, exact_quantiles,
+                    with_code_frequencies=with_code_frequencies,
+                    with_sketches=with_sketches, condition=condition)
+        finally:
+            data_conn.close()
+
+    column_metadata = {}
+    with ThreadPoolExecutor(max_workers=n_groups) as executor:
+        for group_metadata in executor.map(profile, groups):
+            column_metadata.update(group_metadata)
+
+    return column_metadata
+
+
+def get_partitions(data_cursor, schema_name, table_name):
+    """Return the leaf partitions of a table.
+
+    Children are found recursively through ``pg_inherits``, so both
+    declaratively partitioned tables and tables partitioned by inheritance
+    are supported. Only relations without children of their own are
+    returned: rows stored in an inheritance parent itself are not part of
+    any partition.
+
+    Returns:
+        list: (schema name, table name) tuples, sorted, or an empty list if
+        the table has no children.
+
+    """
+
+    data_cursor.execute(
+        """
+        WITH RECURSIVE tree (relid) AS (
+            SELECT i.inhrelid
+            FROM pg_catalog.pg_inherits AS i
+            WHERE i.inhparent = (
+                quote_ident(%(schema)s) || '.' || quote_ident(%(table)s)
+            )::regclass
+            UNION
+            SELECT i.inhrelid
+            FROM pg_catalog.pg_inherits AS i
+            JOIN tree ON i.inhparent = tree.relid
+        )
+        SELECT n.nspname, c.relname
+        FROM tree
+        JOIN pg_catalog.pg_class AS c ON c.oid = tree.relid
+        JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM pg_catalog.pg_inherits AS i
+            WHERE i.inhparent = tree.relid
+        )
+        ORDER BY 1, 2;
+        """,
+        {'schema': schema_name, 'table': table_name},
+    )
+
+    return [tuple(row) for row in data_cursor.fetchall()]
+
+
+def get_partition_metadata_in_parallel(data_connection_string, partitions,
+                                       column_types, try_cast_columns=(),
+                                       workers=2, itersize=ITERSIZE):
+    """Compute the metadata of the columns of partitions concurrently.
+
+    Each of ``workers`` connections profiles one partition at a time with
+    ``get_column_metadata`` in its own thread, taking the next partition
+    when it is done, so that large partitions do not hold up the others.
+
+    Args:
+        data_connection_string (str): Connection string of the data database.
+        partitions (list): (schema name, table name) tuples.
+        column_types (dict): Column name -> column type, common to all
+            partitions.
+        workers (int): Maximum number of connections.
+
+    Returns:
+        dict: (schema name, table name) -> column metadata from
+        ``get_column_metadata`` with sketches.
+
+    """
+
+    if not partitions:
+        return {}
+
+    pending = iter(partitions)
+    lock = threading.Lock()
+
+    def profile():
+        """Profile partitions until none is left."""
+
+        results = {}
+        data_conn = psycopg2.connect(data_connection_string)
+        try:
+            data_conn.autocommit = True
+            with data_conn.cursor() as data_cursor:
+                while True:
+                    with lock:
+                        partition = next(pending, None)
+                    if partition is None:
+                        return results
+
+                    results[partition] = get_column_metadata(
+                        data_cursor, column_types, partition[0],
+                        partition[1], try_cast_columns, itersize=itersize,
+                        with_sketches=True)
+        finally:
+            data_conn.close()
+
+    partition_metadata = {}
+    n_workers = max(1, min(workers, len(partitions)))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(profile) for _ in range(n_workers)]
+        for future in futures:
+            partition_metadata.update(future.result())
+
+    return partition_metadata
+
+
+def get_column_statistics(data_cursor, schema_name, table_name):
+    """Return the planner statistics of the columns of a table.
+
+    Statistics are read from ``pg_stats`` as of the last ``ANALYZE``. For a
+    table with children, the statistics of the whole inheritance tree are
+    preferred.
+
+    Returns:
+        list: Dicts with the column_name, null_frac, n_distinct,
+        most_common_vals, most_common_freqs and histogram_bounds of each
+        column in column order, the values as text. A column without
+        statistics has None values.
+
+    """
+
+    data_cursor.execute(*column_statistics_query(schema_name, table_name))
+
+    return read_column_statistics(data_cursor.fetchall())
+
+
+def column_statistics_query(schema_name, table_name):
+    """Return the query of ``get_column_statistics``.
+
+    Returns:
+        (str, dict): Query and its parameters.
+
+    """
+
+    return (
+        """
+        SELECT
+            a.attname,
+            s.null_frac,
+            s.n_distinct,
+            s.most_common_vals::TEXT::TEXT[],
+            s.most_common_freqs,
+            s.histogram_bounds::TEXT::TEXT[]
+        FROM pg_catalog.pg_attribute AS a
+        LEFT JOIN LATERAL (
+            SELECT *
+            FROM pg_catalog.pg_stats AS s
+            WHERE
+                s.schemaname = %(schema)s
+                AND s.tablename = %(table)s
+                AND s.attname = a.attname
+            ORDER BY s.inherited DESC
+            LIMIT 1
+        ) AS s ON TRUE
+        WHERE
+            a.attrelid = (
+                quote_ident(%(schema)s) || '.' || quote_ident(%(table)s)
+            )::regclass
+            AND a.attnum > 0
+            AND NOT a.attisdropped
+        ORDER BY a.attnum;
+        """,
+        {'schema': schema_name, 'table': table_name},
+    )
+
+
+def read_column_statistics(rows):
+    """Return the statistics of ``get_column_statistics`` from its rows."""
+
+    keys = ('column_name', 'null_frac', 'n_distinct', 'most_common_vals',
+            'most_common_freqs', 'histogram_bounds')
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def get_statistics_metadata(data_cursor, declared_types, column_statistics,
+                            n_rows, categorical_threshold):
+    """Estimate the types and metadata of columns from their statistics.
+
+    Nothing is read from the table. Columns without a declared type are
+    numeric or date if all their most common values and histogram bounds
+    look like numbers or dates, then code if their estimated number of
+    distinct values is within ``categorical_threshold``, and text
+    otherwise.
+
+    Numeric and date metadata is estimated from the most common values,
+    weighted by their frequencies, and the histogram bounds, weighted
+    equally with the remaining rows. Extremes are those of the sample
+    ``ANALYZE`` read. Code frequencies are those of the most common values.
+    Text lengths are not estimated.
+
+    Args:
+        declared_types (list): Tuples from ``get_declared_column_types``.
+        column_statistics (list): From ``get_column_statistics``.
+        n_rows (int): Estimated number of rows of the table.
+        categorical_threshold (int or float): See ``get_column_types``.
+
+    Returns:
+        (dict, dict): Column name -> column type, and column name -> dict
+        of metadata as from ``get_column_metadata``, with estimated True.
+
+    """
+
+    return run_steps(data_cursor,
+                     get_statistics_metadata_steps(declared_types,
+                                                   column_statistics,
+                                                   n_rows,
+                                                   categorical_threshold))
+
+
+def get_statistics_metadata_steps(declared_types, column_statistics, n_rows,
+                                  categorical_threshold):
+    """Steps of ``get_statistics_metadata``, see ``run_steps``."""
+
+    max_distinct = categorical_threshold
+    if is_ratio_threshold(categorical_threshold):
+        max_distinct = int(categorical_threshold * n_rows)
+
+    declared_types = dict(declared_types)
+    column_types = {}
+    column_metadata = {}
+    for statistics in column_statistics:
+        col = statistics['column_name']
+        if statistics['null_frac'] is None:
+            raise ValueError('Column {} has no statistics, analyze the '
+                             'table first.'.format(col))
+
+        weighted = statistics_weighted_values(statistics, n_rows)
+        metadata = {
+            'null_count': round(statistics['null_frac'] * n_rows),
+            'estimated': True,
+        }
 
-def get_column_type(data_cursor, col, categorical_threshold, schema_name,
-                    table_name):
-    """Return the column type."""
+        column_type = declared_types[col]
+        values = None
+        if column_type is not None:
+            values = yield from cast_values_steps(
+                [value for (value, _) in weighted], column_type)
+        elif weighted:
+            # Casts accept more forms than the patterns match.
+            for candidate_type in ('numeric', 'date'):
+                values = yield from cast_values_steps(
+                    [value for (value, _) in weighted], candidate_type)
+                if values is not None:
+                    column_type = candidate_type
+                    break
+
+        if column_type is None:
+            n_distinct = statistics['n_distinct']
+            if n_distinct < 0:
+                n_distinct = -n_distinct * n_rows
+            column_type = 'code' if n_distinct <= max_distinct else 'text'
+
+        if column_type == 'numeric':
+            metadata.update(weighted_numeric_metadata(
+                [(value, count) for value, (_, count)
+                 in zip(values, weighted)]))
+        elif column_type == 'date':
+            metadata['min_date'] = min(values, default=None)
+            metadata['max_date'] = max(values, default=None)
+        elif column_type == 'code':
+            metadata['frequencies'] = sorted(
+                (value, round(frequency * n_rows))
+                for value, frequency in zip(
+                    statistics['most_common_vals'] or [],
+                    statistics['most_common_freqs'] or []))
+
+        column_types[col] = column_type
+        column_metadata[col] = metadata
+
+    return (column_types, column_metadata)
+
+
+def statistics_weighted_values(statistics, n_rows):
+    """Return the sample values of a column with their estimated counts.
+
+    Returns:
+        list: (text value, count) tuples. Each of the most common values
+        counts as its frequency of rows, and each histogram bound as an
+        equal share of the other non-null rows, at least 1.
 
-    if is_numeric(data_cursor, col, schema_name, table_name):
-        return 'numeric'
-    elif is_date(data_cursor, col, schema_name, table_name):
-        return 'date'
-    elif is_code(data_cursor, col, schema_name, table_name,
-                 categorical_threshold):
-        return 'code'
-    else:
-        # is_code creates a column in the temporary table
-        # metadata.converted_data with type text and the a copy of col. is_copy
-        # must be run before assigning type as text.
-        return 'text'
+    """
+
+    weighted = [
+        (value, max(1, round(frequency * n_rows)))
+        for value, frequency in zip(statistics['most_common_vals'] or [],
+                                    statistics['most_common_freqs'] or [])
+    ]
+
+    histogram_bounds = statistics['histogram_bounds'] or []
+    if histogram_bounds:
+        histogram_fraction = max(
+            0,
+            1 - statistics['null_frac']
+            - sum(statistics['most_common_freqs'] or []),
+        )
+        count = max(1, round(histogram_fraction * n_rows
+                             / len(histogram_bounds)))
+        weighted.extend((value, count) for value in histogram_bounds)
+
+    return weighted
 
 
-def is_numeric(data_cursor, col, schema_name, table_name):
-    """Return True if column is numeric.
+def cast_values(data_cursor, values, column_type):
+    """Cast the text forms of values to a column type in the database.
 
-    Return True if column is numeric. Converts text column to numeric and
-    stores it in temporary table metabase.converted_data.
+    Returns:
+        list: The cast values in order, or None if one does not cast.
 
     """
 
-    # Create temporary table for storing converted data.
-    data_cursor.execute(
-        """
-        CREATE TEMPORARY TABLE IF NOT EXISTS
-        converted_data
-        (data_col NUMERIC)
-        """
-    )
+    return run_steps(data_cursor, cast_values_steps(values, column_type))
+
+
+def cast_values_steps(values, column_type):
+    """Steps of ``cast_values``, see ``run_steps``."""
 
     try:
-        data_cursor.execute(
+        rows = yield FetchAll(
             sql.SQL("""
-            INSERT INTO converted_data (data_col)
-            SELECT {}::NUMERIC FROM {}.{}
-            """).format(
-                sql.Identifier(col),
-                sql.Identifier(schema_name),
-                sql.Identifier(table_name),
-            )
+                SELECT v.value::{}
+                FROM UNNEST({}::TEXT[]) WITH ORDINALITY AS v (value, i)
+                ORDER BY v.i
+            """).format(sql.SQL(column_type.upper()), sql.Literal(values))
         )
-        return True
-    except (psycopg2.ProgrammingError, psycopg2.DataError):
-        data_cursor.execute('DROP TABLE IF EXISTS converted_data')
-        return False
+    except psycopg2.DataError:
+        return None
 
+    return [value for (value,) in rows]
 
-def is_date(data_cursor, col, schema_name, table_name):
-    """Return True if column is date.
 
-    Return True if column is type date. Converts text column to date and stores
-    it in temporary table metabase.converted_data.
+def weighted_numeric_metadata(weighted):
+    """Return the metadata of a numeric column from counted values.
+
+    Args:
+        weighted (list): (Decimal value, count) tuples.
+
+    Returns:
+        dict: minimum, maximum, mean and percentiles, None if there is no
+        value.
 
     """
 
-    # Create temporary table for storing converted data.
-    data_cursor.execute(
-        """
-        CREATE TEMPORARY TABLE IF NOT EXISTS
-        converted_data
-        (data_col DATE);
-        TRUNCATE TABLE converted_data;
-        """
+    metadata = {
+        'minimum': min((value for (value, _) in weighted),
+                       key=numeric_sort_key, default=None),
+        'maximum': max((value for (value, _) in weighted),
+                       key=numeric_sort_key, default=None),
+        'mean': None,
+    }
+
+    total_count = sum(count for (_, count) in weighted)
+    if total_count:
+        metadata['mean'] = (sum(value * count for (value, count) in weighted)
+                            / total_count)
+
+    metadata.update(read_percentiles(weighted_quantiles(
+        weighted, [percent / 100 for percent in PERCENTS])))
+
+    return metadata
+
+
+def get_uncastable_columns(data_cursor, checks, schema_name, table_name):
+    """Return the columns with a value that does not cast to their type.
+
+    Casts each column in its own query, for when a query casting many
+    columns fails. Outside autocommit mode, each query runs in a savepoint
+    so that a failed cast does not abort the transaction.
+
+    Args:
+        checks (list): (column name, type) tuples. The type is 'numeric' or
+            'date'.
+
+    """
+
+    return run_steps(
+        data_cursor,
+        get_uncastable_columns_steps(checks, schema_name, table_name),
     )
 
-    try:
-        data_cursor.execute(
-            sql.SQL("""
-            INSERT INTO converted_data (data_col)
-            SELECT {}::DATE FROM {}.{}
-            """).format(
-                sql.Identifier(col),
-                sql.Identifier(schema_name),
-                sql.Identifier(table_name),
-            )
-        )
-        return True
-    except (psycopg2.ProgrammingError, psycopg2.DataError):
-        data_cursor.execute("DROP TABLE IF EXISTS converted_data")
-        return False
 
+def get_uncastable_columns_steps(checks, schema_name, table_name):
+    """Steps of ``get_uncastable_columns``, see ``run_steps``."""
+
+    uncastable_columns = []
+    for col, column_type in checks:
+        if not (yield Succeeds(cast_check_query(col, column_type,
+                                                schema_name, table_name))):
+            uncastable_columns.append(col)
+
+    return uncastable_columns
 
-def is_code(data_cursor, col, schema_name, table_name,
-            categorical_threshold):
-    """Return True if column is categorical.
 
-    Return True if column categorical. Stores a copy of the column in
-    metabase.converted_data. Note: Even if the column is not categorical, the
-    column is copied to metadata.converted_metadata as a text column and the
-    column will be assumed to be text.
+def retype_uncastable_columns(data_cursor, column_types,
+                              untyped_column_names, try_cast_columns,
+                              categorical_threshold, schema_name, table_name):
+    """Infer the types of inferred columns that do not cast again.
+
+    Some value matched the numeric or date pattern but does not cast after
+    all. Such columns are inferred again as code or text, updating
+    ``column_types``.
+
+    Args:
+        untyped_column_names (list): Columns whose types were inferred.
+        try_cast_columns (iterable): Columns cast with the try cast
+            functions, which cannot fail.
+
+    Returns:
+        bool: True if some column was retyped.
 
     """
 
-    # Create temporary table for storing converted data.
-    data_cursor.execute(
-        """
-        CREATE TEMPORARY TABLE IF NOT EXISTS
-        converted_data
-        (data_col TEXT);
-        TRUNCATE TABLE converted_data;
-        """
+    return run_steps(
+        data_cursor,
+        retype_uncastable_columns_steps(column_types, untyped_column_names,
+                                        try_cast_columns,
+                                        categorical_threshold, schema_name,
+                                        table_name),
     )
 
-    data_cursor.execute(
-        sql.SQL(
-            """
-            SELECT COUNT(DISTINCT {}) FROM {}.{}
-            """).format(
-            sql.Identifier(col),
-            sql.Identifier(schema_name),
-            sql.Identifier(table_name),
-        )
+
+def retype_uncastable_columns_steps(column_types, untyped_column_names,
+                                    try_cast_columns, categorical_threshold,
+                                    schema_name, table_name):
+    """Steps of ``retype_uncastable_columns``, see ``run_steps``."""
+
+    uncastable_columns = yield from get_uncastable_columns_steps(
+        [(col, column_types[col])
+         for col in untyped_column_names
+         if column_types[col] in ('numeric', 'date')
+         and col not in try_cast_columns],
+        schema_name,
+        table_name,
     )
-    n_distinct = data_cursor.fetchall()[0][0]
 
-    data_cursor.execute(sql.SQL("""
-        INSERT INTO converted_data (data_col)
-        SELECT {} FROM {}.{}
-        """).format(
-                sql.Identifier(col),
-                sql.Identifier(schema_name),
-                sql.Identifier(table_name),
-        )
-        )
+    code_columns = yield from get_code_columns_steps(uncastable_columns,
+                                                     categorical_threshold,
+                                                     schema_name, table_name)
+    for col in uncastable_columns:
+        column_types[col] = 'code' if col in code_columns else 'text'
+
+    return bool(uncastable_columns)
+
+
+def cast_check_query(col, column_type, schema_name, table_name,
+                     pattern_misses=False):
+    """Return the query casting every value of a column to its type.
+
+    Args:
+        pattern_misses (bool): Only cast the text of the values that do not
+            match the pattern of the type.
+
+    """
+
+    cast = cast_expression(col, column_type)
+    condition = sql.SQL('')
+    if pattern_misses:
+        text = sql.SQL('{}::TEXT').format(sql.Identifier(col))
+        cast = sql.SQL('{}::{}').format(text, sql.SQL(column_type.upper()))
+        condition = sql.SQL(' WHERE {}').format(
+            invalid_value_condition(text, column_type))
+
+    return sql.SQL('SELECT COUNT({}) FROM {}.{}{}').format(
+        cast,
+        sql.Identifier(schema_name),
+        sql.Identifier(table_name),
+        condition,
+    )
 
-    if n_distinct <= categorical_threshold:
-        return True
-    else:
-        return False
 
+def update_numeric(write_session, col, data_table_id, numeric_metadata):
+    """Update Column Info  and Numeric Column for a numerical column.
 
-def update_numeric(data_cursor, metabase_cursor, col, data_table_id):
-    """Update Column Info  and Numeric Column for a numerical column."""
+    Args:
+        write_session (WriteSession): Session buffering the rows.
+        numeric_metadata (dict): Metadata from ``get_column_metadata``.
 
-    update_column_info(metabase_cursor, col, data_table_id, 'numeric')
+    """
+
+    update_column_info(write_session, col, data_table_id, 'numeric',
+                       numeric_metadata['null_count'],
+                       numeric_metadata.get('estimated', False),
+                       numeric_metadata.get('invalid_count'))
     # Update created by, created date.
 
-    (minimum, maximum, mean, median) = get_numeric_metadata(data_cursor, col,
-                                                            data_table_id)
+    row = {
+        'data_table_id': data_table_id,
+        'column_name': col,
+        'minimum': numeric_metadata['minimum'],
+        'maximum': numeric_metadata['maximum'],
+        'mean': numeric_metadata['mean'],
+        'median': numeric_metadata['percentile_50'],
+        'updated_by': getpass.getuser(),
+    }
+    for percent in PERCENTS:
+        if percent != 50:
+            row['percentile_{}'.format(percent)] = (
+                numeric_metadata['percentile_{}'.format(percent)])
 
-    metabase_cursor.execute(
-        """
-        INSERT INTO metabase.numeric_column
-        (
-        data_table_id,
-        column_name,
-        minimum,
-        maximum,
-        mean,
-        median,
-        updated_by,
-        date_last_updated
-        )
-        VALUES
-        (
-        %(data_table_id)s,
-        %(column_name)s,
-        %(minimum)s,
-        %(maximum)s,
-        %(mean)s,
-        %(median)s,
-        %(updated_by)s,
-        (SELECT CURRENT_TIMESTAMP)
-        )
-        """,
-        {
+    write_session.add('numeric_column', row)
+
+
+def update_text(write_session, col, data_table_id, text_metadata):
+    """Update Column Info  and Numeric Column for a numerical column.
+
+    Args:
+        write_session (WriteSession): Session buffering the rows.
+        text_metadata (dict): Metadata from ``get_column_metadata``.
+
+    """
+
+    update_column_info(write_session, col, data_table_id, 'text',
+                       text_metadata['null_count'],
+                       text_metadata.get('estimated', False),
+                       text_metadata.get('invalid_count'))
+    # Update created by, created date.
+
+    row = {
+        'data_table_id': data_table_id,
+        'column_name': col,
+        'max_length': text_metadata['max_length'],
+        'min_length': text_metadata['min_length'],
+        'median_length': text_metadata['percentile_50'],
+        'max_byte_length': text_metadata['max_byte_length'],
+        'min_byte_length': text_metadata['min_byte_length'],
+        'total_byte_length': text_metadata['total_byte_length'],
+        'length_histogram': Json(text_metadata['length_histogram']),
+        'updated_by': getpass.getuser(),
+    }
+    for percent in PERCENTS:
+        if percent != 50:
+            row['percentile_{}_length'.format(percent)] = (
+                text_metadata['percentile_{}'.format(percent)])
+
+    write_session.add('text_column', row)
+
+
+def get_text_metadata(length_counts):
+    """Get metadata of a text column from the counts of its lengths.
+
+    Lengths have few distinct values, so length percentiles are computed
+    exactly from the counts without sorting the column.
+
+    Args:
+        length_counts (list): Tuples from ``get_length_counts``.
+
+    Returns:
+        dict: max_length, min_length, percentile_<percent> for each of
+        ``PERCENTS``, max_byte_length, min_byte_length, total_byte_length and
+        length_histogram, the number of values per power of two bucket of
+        lengths (see ``length_bucket``).
+
+    """
+
+    text_metadata = {
+        'max_length': max((row[0] for row in length_counts), default=None),
+        'min_length': min((row[0] for row in length_counts), default=None),
+        'max_byte_length': max((row[2] for row in length_counts),
+                               default=None),
+        'min_byte_length': min((row[3] for row in length_counts),
+                               default=None),
+        'total_byte_length': sum(row[4] for row in length_counts),
+        'length_histogram': {},
+    }
+
+    text_metadata.update(read_percentiles(weighted_quantiles(
+        ((length, count) for (length, count, _, _, _) in length_counts),
+        [percent / 100 for percent in PERCENTS],
+    )))
+
+    histogram = text_metadata['length_histogram']
+    for (length, count, _, _, _) in length_counts:
+        bucket = str(length_bucket(length))
+        histogram[bucket] = histogram.get(bucket, 0) + count
+
+    return text_metadata
+
+
+def length_bucket(length):
+    """Return the power of two bucket of a length.
+
+    Bucket 0 holds empty values and bucket ``2 ** i`` holds lengths from
+    ``2 ** i`` to ``2 ** (i + 1) - 1``.
+
+    """
+
+    if length == 0:
+        return 0
+    return 1 << (length.bit_length() - 1)
+
+
+def update_date(write_session, col, data_table_id, date_metadata):
+    """Update Column Info and Date Column for a date column.
+
+    Args:
+        write_session (WriteSession): Session buffering the rows.
+        date_metadata (dict): Metadata from ``get_column_metadata``.
+
+    """
+
+    update_column_info(write_session, col, data_table_id, 'date',
+                       date_metadata['null_count'],
+                       date_metadata.get('estimated', False),
+                       date_metadata.get('invalid_count'))
+
+    write_session.add('date_column', {
+        'data_table_id': data_table_id,
+        'column_name': col,
+        'min_date': date_metadata['min_date'],
+        'max_date': date_metadata['max_date'],
+        'updated_by': getpass.getuser(),
+    })
+
+
+def update_code(write_session, col, data_table_id, code_metadata):
+    """Update Column Info and Code Frequency for a categorical column.
+
+    Args:
+        write_session (WriteSession): Session buffering the rows.
+        code_metadata (dict): Metadata from ``get_column_metadata``. Without
+            frequencies, only Column Info is updated and the codes are
+            expected from ``code_frequency_rows``.
+
+    """
+
+    update_column_info(write_session, col, data_table_id, 'code',
+                       code_metadata['null_count'],
+                       code_metadata.get('estimated', False),
+                       code_metadata.get('invalid_count'))
+
+    updated_by = getpass.getuser()
+    for code, frequency in code_metadata.get('frequencies', []):
+        write_session.add('code_frequency', {
             'data_table_id': data_table_id,
             'column_name': col,
-            'minimum': minimum,
-            'maximum': maximum,
-            'mean': mean,
-            'median': median,
-            'updated_by': getpass.getuser(),
-        }
-    )
+            'code': code,
+            'frequency': frequency,
+            'updated_by': updated_by,
+        })
 
 
-def get_numeric_metadata(data_cursor, col, data_table_id):
-    """Get metdata from a numeric column."""
+def code_frequency_rows(data_cursor, data_table_id, code_columns,
+                        schema_name, table_name, itersize=ITERSIZE,
+                        condition=None):
+    """Generate the Code Frequency rows of code columns from one scan.
 
-    data_cursor.execute(
-        """
-        SELECT
-        min(data_col),
-        max(data_col),
-        avg(data_col),
-        PERCENTILE_CONT(0.5)
-            WITHIN GROUP (ORDER BY data_col)
-        FROM converted_data
-        """
+    The codes are counted by ``stream_code_frequencies`` when the generator
+    is first consumed, e.g. by ``WriteSession.add_rows`` at flush, so that
+    only ``itersize`` counts are in memory at a time.
+
+    Yields:
+        dict: Code Frequency row.
+
+    """
+
+    yield from read_code_frequency_rows(
+        data_table_id,
+        code_columns,
+        stream_code_frequencies(
+            data_cursor,
+            [cast_expression(col, 'code') for col in code_columns],
+            schema_name,
+            table_name,
+            itersize,
+            condition,
+        ),
     )
 
-    return data_cursor.fetchall()[0]
 
+def read_code_frequency_rows(data_table_id, code_columns, rows):
+    """Generate the Code Frequency rows of ``code_frequencies_query`` rows.
 
-def update_text(data_cursor, metabase_cursor, col, data_table_id):
-    """Update Column Info  and Numeric Column for a numerical column."""
+    Args:
+        code_columns (list): Code columns in the order of the expressions of
+            the query.
+
+    """
+
+    updated_by = getpass.getuser()
+    for column_index, code, frequency in rows:
+        yield {
+            'data_table_id': data_table_id,
+            'column_name': code_columns[column_index],
+            'code': code,
+            'frequency': frequency,
+            'updated_by': updated_by,
+        }
 
-    update_column_info(metabase_cursor, col, data_table_id, 'text')
-    # Update created by, created date.
 
-    (max_len, min_len, median_len) = get_text_metadata(data_cursor, col,
-                                                       data_table_id)
+def column_sketch(column_type, metadata):
+    """Return the mergeable state of a column, serializable as JSON.
+
+    The state holds the counts of null, non-null and invalid values of the
+    column and, for its type, the extremes and sum of numeric values with
+    their KLL sketch, the extremes of dates or the length counts of text
+    values. Codes are counted in Code Frequency itself.
+    ``merge_column_sketches`` adds the state of appended rows.
+
+    Args:
+        column_type (str): 'numeric', 'text', 'date' or 'code'.
+        metadata (dict): Metadata from ``get_column_metadata`` with
+            ``with_sketches``.
+
+    """
+
+    sketch = {
+        'non_null_count': metadata['non_null_count'],
+        'null_count': metadata['null_count'],
+        'invalid_count': metadata['invalid_count'],
+    }
+
+    if column_type == 'numeric':
+        sketch.update({
+            key: None if metadata[key] is None else str(metadata[key])
+            for key in ['minimum', 'maximum', 'sum']
+        })
+        sketch['kll_sketch'] = metadata['kll_sketch'].to_dict()
+    elif column_type == 'date':
+        sketch.update({
+            key: None if metadata[key] is None else metadata[key].isoformat()
+            for key in ['min_date', 'max_date']
+        })
+    elif column_type == 'text':
+        sketch['length_counts'] = [list(row)
+                                   for row in metadata['length_counts']]
+
+    return sketch
+
+
+def merge_column_sketches(column_type, sketch, other):
+    """Return the state of a column from the states of two sets of rows.
+
+    Args:
+        sketch (dict): State from ``column_sketch``.
+        other (dict): State of other rows of the same column.
+
+    """
+
+    merged = {
+        'non_null_count': sketch['non_null_count'] + other['non_null_count'],
+        'null_count': sketch['null_count'] + other['null_count'],
+        'invalid_count': None,
+    }
+    # States stored before invalid values were counted have no count.
+    if (sketch.get('invalid_count') is not None
+            and other.get('invalid_count') is not None):
+        merged['invalid_count'] = (sketch['invalid_count']
+                                   + other['invalid_count'])
+
+    if column_type == 'numeric':
+        merged['minimum'] = merge_extremes(
+            lambda values: min(values, key=numeric_sort_key),
+            sketch['minimum'], other['minimum'], decimal.Decimal)
+        merged['maximum'] = merge_extremes(
+            lambda values: max(values, key=numeric_sort_key),
+            sketch['maximum'], other['maximum'], decimal.Decimal)
+        merged['sum'] = merge_extremes(
+            sum, sketch['sum'], other['sum'], decimal.Decimal)
+        kll_sketch = KllSketch.from_dict(sketch['kll_sketch'])
+        kll_sketch.merge(KllSketch.from_dict(other['kll_sketch']))
+        merged['kll_sketch'] = kll_sketch.to_dict()
+    elif column_type == 'date':
+        merged['min_date'] = merge_extremes(
+            min, sketch['min_date'], other['min_date'], parse_date)
+        merged['max_date'] = merge_extremes(
+            max, sketch['max_date'], other['max_date'], parse_date)
+    elif column_type == 'text':
+        length_counts = {}
+        for length, count, max_bytes, min_bytes, total_bytes in (
+                sketch['length_counts'] + other['length_counts']):
+            if length in length_counts:
+                previous = length_counts[length]
+                length_counts[length] = [
+                    length,
+                    previous[1] + count,
+                    max(previous[2], max_bytes),
+                    min(previous[3], min_bytes),
+                    previous[4] + total_bytes,
+                ]
+            else:
+                length_counts[length] = [length, count, max_bytes,
+                                         min_bytes, total_bytes]
+        merged['length_counts'] = [length_counts[length]
+                                   for length in sorted(length_counts)]
+
+    return merged
+
+
+def merge_extremes(function, value, other, parse):
+    """Combine two serialized values that may be None with a function.
+
+    Args:
+        function: ``min``, ``max`` or ``sum``, applied to a list.
+        parse: Function parsing a serialized value.
+
+    Returns:
+        str: The serialized result, or None if both values are None.
+
+    """
+
+    values = [parse(v) for v in [value, other] if v is not None]
+    if not values:
+        return None
+
+    result = function(values)
+    return result.isoformat() if isinstance(result, datetime.date) \
+        else str(result)
+
+
+def parse_date(value):
+    """Parse a date serialized by ``column_sketch``."""
+
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def read_column_sketch(column_type, sketch):
+    """Return the metadata of a column from its state.
+
+    Returns:
+        dict: Metadata as from ``get_column_metadata``, without the
+        frequencies of code columns.
+
+    """
+
+    metadata = {
+        'non_null_count': sketch['non_null_count'],
+        'null_count': sketch['null_count'],
+        'invalid_count': sketch.get('invalid_count'),
+    }
+
+    if column_type == 'numeric':
+        for key in ['minimum', 'maximum', 'sum']:
+            metadata[key] = (None if sketch[key] is None
+                             else decimal.Decimal(sketch[key]))
+        metadata['mean'] = (metadata['sum'] / sketch['non_null_count']
+                            if sketch['non_null_count'] else None)
+        metadata.update(read_percentiles(
+            KllSketch.from_dict(sketch['kll_sketch']).quantiles(
+                [percent / 100 for percent in PERCENTS])))
+    elif column_type == 'date':
+        for key in ['min_date', 'max_date']:
+            metadata[key] = (None if sketch[key] is None
+                             else parse_date(sketch[key]))
+    elif column_type == 'text':
+        metadata.update(get_text_metadata(
+            [tuple(row) for row in sketch['length_counts']]))
+
+    return metadata
+
+
+def update_column_sketch(write_session, col, data_table_id, sketch):
+    """Add the state of a column from ``column_sketch`` to the session."""
+
+    write_session.add('column_sketch', {
+        'data_table_id': data_table_id,
+        'column_name': col,
+        'sketch': Json(sketch),
+        'updated_by': getpass.getuser(),
+    })
+
+
+def get_column_sketches(metabase_cursor, data_table_id):
+    """Return the stored types and states of the columns of a Data Table.
+
+    Returns:
+        dict: Column name -> (column type, state from ``column_sketch`` or
+        None).
+
+    """
 
     metabase_cursor.execute(
         """
-        INSERT INTO metabase.text_column
-        (
-        data_table_id,
-        column_name,
-        max_length,
-        min_length,
-        median_length,
-        updated_by,
-        date_last_updated
-        )
-        VALUES
-        (
-        %(data_table_id)s,
-        %(column_name)s,
-        %(max_length)s,
-        %(min_length)s,
-        %(median_length)s,
-        %(updated_by)s,
-        (SELECT CURRENT_TIMESTAMP)
-        )
+        SELECT c.column_name, c.data_type, s.sketch
+        FROM metabase.column_info AS c
+        LEFT JOIN metabase.column_sketch AS s
+            USING (data_table_id, column_name)
+        WHERE c.data_table_id = %(data_table_id)s;
         """,
-        {
-            'data_table_id': data_table_id,
-            'column_name': col,
-            'max_length': max_len,
-            'min_length': min_len,
-            'median_length': median_len,
-            'updated_by': getpass.getuser(),
-        }
+        {'data_table_id': data_table_id},
     )
 
+    return {col: (column_type, sketch)
+            for col, column_type, sketch in metabase_cursor.fetchall()}
 
-def get_text_metadata(data_cursor, col, data_table_id):
-    """Get metadata from a text column."""
 
-    # Create tempory table to hold text lengths.
-    data_cursor.execute(
-        """
-        CREATE TEMPORARY TABLE text_length
-        AS
-        SELECT char_length(data_col)
-        FROM converted_data
+def get_stored_code_frequencies(metabase_cursor, data_table_id):
+    """Return the stored code frequencies of a Data Table.
+
+    Returns:
+        dict: Column name -> dict of code -> frequency.
+
+    """
+
+    metabase_cursor.execute(
         """
+        SELECT column_name, code, frequency
+        FROM metabase.code_frequency
+        WHERE data_table_id = %(data_table_id)s;
+        """,
+        {'data_table_id': data_table_id},
     )
 
-    data_cursor.execute(
-        """
-        SELECT
-        MAX(text_length.char_length),
-        MIN(text_length.char_length),
-        PERCENTILE_CONT(0.5)
-            WITHIN GROUP (ORDER BY text_length.char_length)
-        FROM text_length;
-        """
+    code_frequencies = {}
+    for col, code, frequency in metabase_cursor.fetchall():
+        code_frequencies.setdefault(col, {})[code] = frequency
+
+    return code_frequencies
+
+
+def get_max_id(data_cursor, id_column, schema_name, table_name):
+    """Return the greatest value of an ID column, as text, or None."""
+
+    data_cursor.execute(max_id_query(id_column, schema_name, table_name))
+
+    return data_cursor.fetchone()[0]
+
+
+def max_id_query(id_column, schema_name, table_name):
+    """Return the query of ``get_max_id``."""
+
+    return sql.SQL('SELECT MAX({})::TEXT FROM {}.{}').format(
+        sql.Identifier(id_column),
+        sql.Identifier(schema_name),
+        sql.Identifier(table_name),
     )
 
-    (max_len, min_len, median_len) = data_cursor.fetchall()[0]
 
-    data_cursor.execute("DROP TABLE text_length")
+def id_range_condition(id_column, min_id, max_id):
+    """Return the condition selecting rows by a range of IDs.
 
-    return (max_len, min_len, median_len)
+    Args:
+        min_id (str): Exclusive lower bound, or None for no bound.
+        max_id (str): Inclusive upper bound, or None to select no row.
 
+    Returns:
+        sql.Composable: Condition on the rows.
 
-def update_date(data_cursor, metabase_cursor, col, data_table_id):
-    """Update Column Info and Date Column for a date column."""
+    """
 
-    update_column_info(metabase_cursor, col, data_table_id, 'date')
+    if max_id is None:
+        return sql.SQL('FALSE')
 
-    (minimum, maximum) = get_date_metadata(data_cursor, col, data_table_id)
+    condition = sql.SQL('{} <= {}').format(
+        sql.Identifier(id_column), sql.Literal(max_id))
+    if min_id is not None:
+        condition = sql.SQL('{} > {} AND {}').format(
+            sql.Identifier(id_column), sql.Literal(min_id), condition)
 
-    metabase_cursor.execute(
-        """
-        INSERT INTO metabase.date_column
-        (
-        data_table_id,
-        column_name,
-        min_date,
-        max_date,
-        updated_by,
-        date_last_updated
-        )
-        VALUES
-        (
-        %(data_table_id)s,
-        %(column_name)s,
-        %(min_date)s,
-        %(max_date)s,
-        %(updated_by)s,
-        (SELECT CURRENT_TIMESTAMP)
-        )
-        """,
-        {
-            'data_table_id': data_table_id,
-            'column_name': col,
-            'min_date': minimum,
-            'max_date': maximum,
-            'updated_by': getpass.getuser(),
+    return condition
+
+
+def partition_column_states(column_types, column_metadata):
+    """Return the mergeable state of the columns of a partition.
+
+    Returns:
+        dict: Column name -> {'column_type', 'sketch', 'frequencies'}, the
+        sketch from ``column_sketch`` and the [code, frequency] pairs of a
+        code column, serializable as JSON.
+
+    """
+
+    return {
+        col: {
+            'column_type': column_type,
+            'sketch': column_sketch(column_type, column_metadata[col]),
+            'frequencies': [list(row) for row in
+                            column_metadata[col].get('frequencies', [])],
         }
-        )
+        for col, column_type in column_types.items()
+    }
 
 
-def get_date_metadata(data_cursor, col, data_table_id):
-    """Get metadata from a date column."""
+def merge_partition_states(column_types, partition_states):
+    """Return the metadata of columns from the states of all partitions.
 
-    data_cursor.execute(
-        """
-        SELECT
-        min(data_col),
-        max(data_col)
-        FROM converted_data
-        """
-    )
+    Args:
+        partition_states (list): Column states of each partition from
+            ``partition_column_states``, with the same column types.
 
-    return data_cursor.fetchall()[0]
+    Returns:
+        dict: Column name -> metadata from ``read_column_sketch``. The
+        frequencies of a code column are summed over the partitions, as
+        sorted (code, frequency) tuples.
 
+    """
 
-def update_code(data_cursor, metabase_cursor, col, data_table_id):
-    """Update Column Info and Code Frequency for a categorical column."""
+    column_metadata = {}
+    for col, column_type in column_types.items():
+        sketch = None
+        frequencies = {}
+        for column_states in partition_states:
+            state = column_states[col]
+            sketch = (state['sketch'] if sketch is None
+                      else merge_column_sketches(column_type, sketch,
+                                                 state['sketch']))
+            for code, frequency in state['frequencies']:
+                frequencies[code] = frequencies.get(code, 0) + frequency
 
-    update_column_info(metabase_cursor, col, data_table_id, 'code')
+        column_metadata[col] = read_column_sketch(column_type, sketch)
+        if column_type == 'code':
+            column_metadata[col]['frequencies'] = sorted(frequencies.items())
 
-    code_freq_tp_ls = get_code_metadata(data_cursor, col, data_table_id)
+    return column_metadata
 
-    metabase_cursor.execute(
-        'CREATE TEMPORARY TABLE code_freq_temp (code TEXT, freq INT);')
 
-    for code, freq in code_freq_tp_ls:
-        metabase_cursor.execute(
-            'INSERT INTO code_freq_temp (code, freq) VALUES (%s, %s);',
-            [code, freq],
-        )
+def get_partition_profiles(metabase_cursor, data_table_id):
+    """Return the stored watermarks and column states of the partitions.
+
+    Returns:
+        dict: Partition name -> (watermark, column states from
+        ``partition_column_states``).
+
+    """
 
     metabase_cursor.execute(
-        """
-        INSERT INTO metabase.code_frequency (
-            data_table_id,
-            column_name,
-            code,
-            frequency,
-            updated_by,
-            date_last_updated
-        ) SELECT
-            %(data_table_id)s,
-            %(column_name)s,
-            code,
-            freq,
-            %(updated_by)s,
-            CURRENT_TIMESTAMP
-        FROM code_freq_temp;
-        """,
-        {
-            'data_table_id': data_table_id,
-            'column_name': col,
-            'updated_by': getpass.getuser(),
-        },
+        sql.SQL("""
+            SELECT partition_name, column_states, {}
+            FROM metabase.partition_profile
+            WHERE data_table_id = %(data_table_id)s;
+        """).format(sql.SQL(', ').join(
+            sql.Identifier(col) for col in WATERMARK_COLUMNS)),
+        {'data_table_id': data_table_id},
     )
 
-    metabase_cursor.execute('DROP TABLE code_freq_temp;')
+    return {row[0]: (read_table_watermark(row[2:]), row[1])
+            for row in metabase_cursor.fetchall()}
 
 
-def get_code_metadata(data_cursor, col, data_table_id):
-    data_cursor.execute(
-        """
-        SELECT data_col AS code, COUNT(*) AS frequency
-        FROM converted_data
-        GROUP BY data_col
-        ORDER BY data_col;
-        """
-    )
-    code_frequency_tp_ls = data_cursor.fetchall()
+def stored_column_types(partition_profiles, declared_types):
+    """Return the column types of the stored partition states.
+
+    Args:
+        partition_profiles (dict): From ``get_partition_profiles``.
+        declared_types (list): Tuples from ``get_declared_column_types``.
+
+    Returns:
+        dict: Column name -> column type, or None if no state is stored or
+        the columns or their declared types changed since.
+
+    """
+
+    if not partition_profiles:
+        return None
+
+    _, column_states = partition_profiles[min(partition_profiles)]
+    column_types = {col: state['column_type']
+                    for col, state in column_states.items()}
+
+    if sorted(column_types) != sorted(col for (col, _) in declared_types):
+        return None
+    if any(declared_type is not None and column_types[col] != declared_type
+           for (col, declared_type) in declared_types):
+        return None
+
+    return column_types
 
-    return code_frequency_tp_ls
 
+def cached_column_states(partition_profile, watermark, column_types):
+    """Return the stored column states of an unchanged partition.
 
-def update_column_info(cursor, col, data_table_id, data_type):
-    """Add a row for this data column to the column info metadata table."""
+    Args:
+        partition_profile (tuple): (watermark, column states) from
+            ``get_partition_profiles``, or None.
+        watermark (dict): Current watermark of the partition.
+        column_types (dict): Column name -> column type to profile.
 
-    # TODO How to handled existing rows?
+    Returns:
+        dict: Column states, or None if the partition must be profiled.
+
+    """
+
+    if partition_profile is None:
+        return None
+
+    stored_watermark, column_states = partition_profile
+    if not is_unchanged(stored_watermark, watermark):
+        return None
+    if {col: state['column_type']
+            for col, state in column_states.items()} != column_types:
+        return None
+
+    return column_states
+
+
+def update_partition_profile(write_session, data_table_id, partition_name,
+                             watermark, column_states):
+    """Add the watermark and column states of a partition to the session."""
+
+    row = {
+        'data_table_id': data_table_id,
+        'partition_name': partition_name,
+        'column_states': Json(column_states),
+    }
+    row.update(watermark)
+    row['updated_by'] = getpass.getuser()
+
+    write_session.add('partition_profile', row)
+
+
+def update_table_watermark(write_session, data_table_id, watermark,
+                           id_column=None, max_id=None):
+    """Add the watermark of a Data Table to the session.
+
+    It replaces the stored watermark when the session is flushed, together
+    with the metadata profiled from this state of the table.
+
+    Args:
+        id_column (str): Column identifying appended rows by increasing
+            values, if any.
+        max_id (str): Greatest value of ``id_column`` profiled.
+
+    """
+
+    row = {'data_table_id': data_table_id}
+    row.update(watermark)
+    row['id_column'] = id_column
+    row['max_id'] = max_id
+    row['updated_by'] = getpass.getuser()
+
+    write_session.add('table_watermark', row)
+
+
+def update_column_info(write_session, col, data_table_id, data_type,
+                       null_count=None, estimated=False, invalid_count=None):
+    """Add a row for this data column to the column info metadata table.
+
+    An existing row for the column is replaced when the session is flushed.
+
+    Args:
+        estimated (bool): Whether the metadata of the column is estimated
+            from statistics rather than computed from the data.
+        invalid_count (int): Number of non-null values that do not cast to
+            the column type, left out of its metadata. None if unknown, as
+            for estimated metadata.
+
+    """
 
     # Create Column Info entry
-    cursor.execute(
-        """
-        INSERT INTO metabase.column_info
-        (data_table_id,
-        column_name,
-        data_type,
-        updated_by,
-        date_last_updated
-        )
-        VALUES
-        (
-        %(data_table_id)s,
-        %(column_name)s,
-        %(data_type)s,
-        %(updated_by)s,
-        (SELECT CURRENT_TIMESTAMP)
-        )
-        """,
-        {
-            'data_table_id': data_table_id,
-            'column_name': col,
-            'data_type': data_type,
-            'updated_by': getpass.getuser(),
-        }
-    )
+    write_session.add('column_info', {
+        'data_table_id': data_table_id,
+        'column_name': col,
+        'data_type': data_type,
+        'null_count': null_count,
+        'invalid_count': invalid_count,
+        'estimated': estimated,
+        'updated_by': getpass.getuser(),
+    })
@@ -0,0 +1,242 @@
+"""Probabilistic sketches for profiling large tables."""
+
+import math
+import random
+
+
+class HyperLogLog():
+    """HyperLogLog sketch estimating the number of distinct values.
+
+    The sketch works on 32 bit hashes. The lowest ``precision`` bits of a hash
+    select a register and the register keeps the largest rank seen, where the
+    rank is the position of the leftmost 1 in the remaining bits.
+
+    """
+
+    def __init__(self, precision=8):
+        """Create an empty sketch.
+
+        Args:
+            precision (int): Number of hash bits used to select a register.
+                The sketch has ``2 ** precision`` registers.
+
+        """
+        self.precision = precision
+        self.n_registers = 1 << precision
+        self.registers = [0] * self.n_registers
+
+    @property
+    def relative_error(self):
+        """Standard error of the estimate relative to the true count."""
+
+        return 1.04 / math.sqrt(self.n_registers)
+
+    def update_register(self, index, rank):
+        """Record a hash with the given register index and rank."""
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Merge another sketch with the same precision into this one."""
+
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge sketches of different precision.')
+
+        self.registers = [max(a, b)
+                          for a, b in zip(self.registers, other.registers)]
+
+    def estimate(self):
+        """Return the estimated number of distinct values."""
+
+        m = self.n_registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+
+        n_zero_registers = self.registers.count(0)
+        if estimate <= 2.5 * m and n_zero_registers > 0:
+            # Small range correction.
+            estimate = m * math.log(m / n_zero_registers)
+        elif estimate > 2 ** 32 / 30:
+            # Large range correction for 32 bit hashes.
+            estimate = -2 ** 32 * math.log(1 - estimate / 2 ** 32)
+
+        return estimate
+
+
+class KllSketch():
+    """KLL sketch estimating quantiles of a stream of values.
+
+    Values are kept in a hierarchy of compactors. When a compactor is full,
+    it is sorted and every other value, starting at a random offset, is
+    promoted to the next compactor with twice the weight. The rank error is
+    about ``1.7 / k`` with high probability, and no value is dropped until
+    the sketch holds about ``3 * k`` values, so small columns are exact.
+
+    """
+
+    def __init__(self, k=200):
+        """Create an empty sketch.
+
+        Args:
+            k (int): Capacity of the top compactor, trading memory for
+                accuracy.
+
+        """
+        self.k = k
+        self.n = 0
+        self.size = 0
+        self.compactors = []
+        self._grow()
+
+    def _capacity(self, level):
+        """Return the capacity of the compactor at a level."""
+
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil(self.k * (2 / 3) ** depth)) + 1
+
+    def _grow(self):
+        """Add a compactor on top of the hierarchy."""
+
+        self.compactors.append([])
+        self.max_size = sum(self._capacity(level)
+                            for level in range(len(self.compactors)))
+
+    def update(self, value):
+        """Add a value to the sketch."""
+
+        self.compactors[0].append(value)
+        self.n += 1
+        self.size += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def merge(self, other):
+        """Merge another sketch into this one."""
+
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+        self.n += other.n
+        self.size += other.size
+        self._compress()
+
+    def to_dict(self):
+        """Return the state of the sketch, serializable as JSON.
+
+        Values are converted to floats.
+
+        """
+
+        return {
+            'k': self.k,
+            'n': self.n,
+            'compactors': [[float(value) for value in compactor]
+                           for compactor in self.compactors],
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        """Return a sketch from the state returned by ``to_dict``."""
+
+        sketch = cls(state['k'])
+        while len(sketch.compactors) < len(state['compactors']):
+            sketch._grow()
+        sketch.compactors = [list(compactor)
+                             for compactor in state['compactors']]
+        sketch.n = state['n']
+        sketch.size = sum(len(compactor) for compactor in sketch.compactors)
+
+        return sketch
+
+    def _compress(self):
+        """Compact full compactors until the sketch fits its capacity."""
+
+        while self.size >= self.max_size:
+            for level, compactor in enumerate(self.compactors):
+                if len(compactor) >= self._capacity(level):
+                    break
+            if level + 1 == len(self.compactors):
+                self._grow()
+
+            compactor.sort(key=numeric_sort_key)
+            leftover = [compactor.pop()] if len(compactor) % 2 else []
+            offset = random.randint(0, 1)
+            self.compactors[level + 1].extend(compactor[offset::2])
+            self.compactors[level] = leftover
+            self.size = sum(len(c) for c in self.compactors)
+
+    def quantiles(self, fractions):
+        """Return estimated quantiles, interpolated like PERCENTILE_CONT.
+
+        Args:
+            fractions (list): Fractions between 0 and 1.
+
+        Returns:
+            list: One value per fraction, or None for each if the sketch is
+            empty. Values are exact while the sketch holds every value.
+
+        """
+
+        return weighted_quantiles(
+            ((value, 2 ** level)
+             for level, compactor in enumerate(self.compactors)
+             for value in compactor),
+            fractions,
+        )
+
+
+def weighted_quantiles(weighted, fractions):
+    """Return quantiles of weighted values, interpolated like PERCENTILE_CONT.
+
+    Args:
+        weighted (iterable): (value, weight) pairs, weight being the number
+            of times the value occurs.
+        fractions (list): Fractions between 0 and 1.
+
+    Returns:
+        list: One value per fraction, or None for each if there is no value.
+
+    """
+
+    weighted = sorted(weighted, key=lambda pair: numeric_sort_key(pair[0]))
+    total_weight = sum(weight for _, weight in weighted)
+    if total_weight == 0:
+        return [None] * len(fractions)
+
+    def value_at(rank):
+        """Return the value at a 0-based rank in the weighted values."""
+
+        cumulative_weight = 0
+        for value, weight in weighted:
+            cumulative_weight += weight
+            if rank < cumulative_weight:
+                return value
+        return weighted[-1][0]
+
+    results = []
+    for fraction in fractions:
+        rank = fraction * (total_weight - 1)
+        lower = value_at(math.floor(rank))
+        if rank == math.floor(rank):
+            # Not interpolated, as infinity minus infinity is NaN.
+            results.append(float(lower))
+            continue
+        upper = value_at(math.ceil(rank))
+        results.append(float(lower)
+                       + (rank - math.floor(rank))
+                       * (float(upper) - float(lower)))
+
+    return results
+
+
+def numeric_sort_key(value):
+    """Return the key ordering numbers like PostgreSQL, NaN after the others.
+
+    ``decimal.Decimal`` refuses to order NaN, and float NaN breaks sorting.
+
+    """
+
+    is_nan = value != value
+    return (is_nan, 0 if is_nan else value)
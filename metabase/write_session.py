@@ -0,0 +1,248 @@
+"""Buffered writes of column level metadata to the metabase."""
+
+import itertools
+import time
+
+from psycopg2 import sql
+
+
+# Number of rows sent to the metabase by each multi-row INSERT.
+INSERT_PAGE_SIZE = 1000
+
+# Metabase tables in the order their rows are inserted, referenced tables
+# first.
+TABLE_ORDER = (
+    'column_info',
+    'numeric_column',
+    'text_column',
+    'date_column',
+    'code_frequency',
+    'column_sketch',
+    'partition_profile',
+    'table_watermark',
+)
+
+# Primary key columns of the metabase tables.
+KEY_COLUMNS = {
+    'column_info': ('data_table_id', 'column_name'),
+    'numeric_column': ('data_table_id', 'column_name'),
+    'text_column': ('data_table_id', 'column_name'),
+    'date_column': ('data_table_id', 'column_name'),
+    'code_frequency': ('data_table_id', 'column_name', 'code'),
+    'column_sketch': ('data_table_id', 'column_name'),
+    'partition_profile': ('data_table_id', 'partition_name'),
+    'table_watermark': ('data_table_id',),
+}
+
+
+class WriteSession():
+    """Buffer rows for metabase tables and write them in one transaction.
+
+    Rows are kept in memory until ``flush``, which sends them with multi-row
+    inserts and commits once, so that the metadata of a table is either
+    written completely or not at all.
+
+    The existing rows of the profiled data tables are deleted before the
+    rows are inserted, so re-profiling a table refreshes its metadata in
+    place. Other rows replace existing rows with the same key.
+
+    Large sets of rows can be added as iterables with ``add_rows``. They are
+    only consumed by ``flush``, one page of rows at a time. Other statements,
+    e.g. the update of the table level metadata, can be added with
+    ``add_statement`` to run in the same transaction.
+
+    """
+
+    def __init__(self, metabase_conn):
+        """Create an empty session.
+
+        Args:
+            metabase_conn: psycopg2 connection to the metabase.
+
+        """
+        self.metabase_conn = metabase_conn
+        self.queries = []
+        self.rows = {}
+        self.streams = {}
+        self.commit_latency = None
+
+    def add(self, table, row):
+        """Buffer a row for a table of the metabase schema.
+
+        Args:
+            table (str): Table name, one of ``TABLE_ORDER``.
+            row (dict): Column name -> value. All rows of a table must have
+                the same columns. date_last_updated is set at insert.
+
+        """
+
+        if table not in TABLE_ORDER:
+            raise ValueError('Unknown metabase table: {}'.format(table))
+
+        self.rows.setdefault(table, []).append(row)
+
+    def add_statement(self, query, params=None):
+        """Buffer a statement to execute in the transaction of ``flush``.
+
+        Statements are executed in the order they were added, before the
+        rows are written.
+
+        Args:
+            query (str or sql.Composable): Statement.
+            params (dict): Parameters of the statement.
+
+        """
+
+        self.queries.append((query, params))
+
+    def add_rows(self, table, rows):
+        """Add an iterable of rows for a table, consumed lazily by ``flush``.
+
+        The rows are inserted after the rows buffered with ``add``. A
+        generator that is not exhausted when ``flush`` fails is closed.
+
+        Args:
+            table (str): Table name, one of ``TABLE_ORDER``.
+            rows (iterable): Rows as for ``add``.
+
+        """
+
+        if table not in TABLE_ORDER:
+            raise ValueError('Unknown metabase table: {}'.format(table))
+
+        self.streams.setdefault(table, []).append(rows)
+
+    def flush(self):
+        """Upsert all buffered rows in a single transaction.
+
+        Statements added with ``add_statement`` are executed first. Existing
+        rows of the data tables with buffered column_info rows are
+        deleted first, so that rows that are not written again disappear,
+        e.g. codes that disappeared or metadata of a column whose type
+        changed.
+
+        Returns:
+            float: Seconds spent committing the transaction.
+
+        """
+
+        autocommit = self.metabase_conn.autocommit
+        self.metabase_conn.autocommit = False
+        try:
+            with self.metabase_conn.cursor() as metabase_cursor:
+                for query, params in self.statements():
+                    metabase_cursor.execute(query, params)
+
+            start = time.perf_counter()
+            self.metabase_conn.commit()
+            self.commit_latency = time.perf_counter() - start
+        except Exception:
+            self.metabase_conn.rollback()
+            self.close_streams()
+            raise
+        finally:
+            self.metabase_conn.autocommit = autocommit
+
+        self.queries = []
+        self.rows = {}
+        self.streams = {}
+
+        return self.commit_latency
+
+    def close_streams(self):
+        """Close and discard the iterables added with ``add_rows``."""
+
+        for streams in self.streams.values():
+            for rows in streams:
+                if hasattr(rows, 'close'):
+                    rows.close()
+        self.streams = {}
+
+    def statements(self):
+        """Generate the statements writing the buffered rows.
+
+        Statements are generated as they are executed, so that rows from
+        ``add_rows`` are read one page at a time.
+
+        Yields:
+            (query, parameters): Statements to execute in order in one
+            transaction.
+
+        """
+
+        for query, params in self.queries:
+            yield query, params
+
+        data_table_ids = sorted({
+            row['data_table_id']
+            for row in self.rows.get('column_info', [])
+        })
+        if data_table_ids:
+            for table in reversed(TABLE_ORDER):
+                yield self.__delete_rows(table, data_table_ids)
+
+        for table in TABLE_ORDER:
+            yield from self.upsert_statements(
+                table,
+                itertools.chain(self.rows.get(table, []),
+                                *self.streams.get(table, [])),
+            )
+
+    def upsert_statements(self, table, rows):
+        """Generate the multi-row inserts upserting rows, a page at a time.
+
+        Args:
+            table (str): Table name, one of ``TABLE_ORDER``.
+            rows (iterable): Rows as for ``add``.
+
+        """
+
+        rows = iter(rows)
+        while True:
+            page = list(itertools.islice(rows, INSERT_PAGE_SIZE))
+            if not page:
+                break
+            yield self.__upsert(table, page)
+
+    @staticmethod
+    def __upsert(table, rows):
+        """Return a multi-row insert upserting rows into a metabase table."""
+
+        columns = list(rows[0])
+        updated_columns = [col for col in columns
+                           if col not in KEY_COLUMNS[table]]
+        updated_columns.append('date_last_updated')
+
+        row_template = sql.SQL('({}, CURRENT_TIMESTAMP)').format(
+            sql.SQL(', ').join(sql.Placeholder() * len(columns)))
+
+        query = sql.SQL("""
+            INSERT INTO metabase.{table} ({columns}, date_last_updated)
+            VALUES {values}
+            ON CONFLICT ({keys}) DO UPDATE SET {updates}
+            """).format(
+            table=sql.Identifier(table),
+            columns=sql.SQL(', ').join(
+                sql.Identifier(col) for col in columns),
+            values=sql.SQL(', ').join([row_template] * len(rows)),
+            keys=sql.SQL(', ').join(
+                sql.Identifier(col) for col in KEY_COLUMNS[table]),
+            updates=sql.SQL(', ').join(
+                sql.SQL('{0} = EXCLUDED.{0}').format(sql.Identifier(col))
+                for col in updated_columns
+            ),
+        )
+
+        return (query, [row[col] for row in rows for col in columns])
+
+    @staticmethod
+    def __delete_rows(table, data_table_ids):
+        """Return the deletion of the rows of data tables from a table."""
+
+        return (
+            sql.SQL("""
+            DELETE FROM metabase.{}
+            WHERE data_table_id = ANY(%(data_table_ids)s)
+            """).format(sql.Identifier(table)),
+            {'data_table_ids': data_table_ids},
+        )
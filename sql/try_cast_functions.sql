@@ -0,0 +1,30 @@
+-- Functions returning NULL instead of failing a cast.
+--
+-- Type inference uses them when process_table is given a
+-- max_invalid_fraction, to tolerate values that do not cast. Install them
+-- in the data database on their own:
+--
+--     psql -d <data database> -f sql/try_cast_functions.sql
+--
+-- The metabase migrations create the same functions in the metabase.
+
+CREATE SCHEMA IF NOT EXISTS metabase;
+
+CREATE OR REPLACE FUNCTION metabase.try_cast_numeric(value TEXT)
+RETURNS NUMERIC AS $$
+BEGIN
+    RETURN value::NUMERIC;
+EXCEPTION WHEN data_exception THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+-- Not immutable: date input depends on the DateStyle setting.
+CREATE OR REPLACE FUNCTION metabase.try_cast_date(value TEXT)
+RETURNS DATE AS $$
+BEGIN
+    RETURN value::DATE;
+EXCEPTION WHEN data_exception THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql STABLE;
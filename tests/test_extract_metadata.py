@@ -1,17 +1,28 @@
 """Tests for extract_metadata.py"""
 
+import asyncio
 import datetime
+import os
+import time
 import unittest
 from unittest.mock import MagicMock, patch
 
 import alembic.config
 from alembic.config import Config
+import psycopg2
+from psycopg2 import sql
+import psycopg2.pool
 import pytest
 import sqlalchemy
 from sqlalchemy.ext.automap import automap_base
 import testing.postgresql
 
+from metabase import async_extract_metadata
+from metabase import batch
+from metabase import connection_pool
 from metabase import extract_metadata
+from metabase import extract_metadata_helper
+from metabase import write_session
 
 
 class ExtractMetadataTest(unittest.TestCase):
@@ -83,6 +94,22 @@ class ExtractMetadataTest(unittest.TestCase):
         self.engine.execute("TRUNCATE TABLE metabase.code_frequency")
         self.engine.execute('DROP TABLE IF EXISTS data.table_1')
 
+    def metadata_rows(self, tables=('data_table', 'column_info',
+                                    'numeric_column', 'text_column',
+                                    'date_column', 'code_frequency')):
+        """Return the metadata rows without their audit columns."""
+
+        rows = []
+        for table in tables:
+            for row in self.engine.execute(
+                    'SELECT * FROM metabase.{}'.format(table)):
+                row = dict(row)
+                row.pop('updated_by')
+                row.pop('date_last_updated')
+                rows.append((table, sorted(row.items())))
+
+        return sorted(rows, key=repr)
+
     def test_get_table_name_data_table_id_not_found(self):
         """
         Test the validity of `data_table_id` as an argument to the constructor
@@ -179,6 +206,7 @@ class ExtractMetadataTest(unittest.TestCase):
             extract = extract_metadata.ExtractMetadata(data_table_id=1)
 
         extract._get_table_level_metadata()
+        extract.write_session.flush()
 
         result = self.engine.execute("""
             SELECT number_rows
@@ -203,6 +231,7 @@ class ExtractMetadataTest(unittest.TestCase):
             extract = extract_metadata.ExtractMetadata(data_table_id=1)
 
         extract._get_table_level_metadata()
+        extract.write_session.flush()
 
         self.engine.execute('DROP TABLE data.table_test_n_rows;')
 
@@ -216,6 +245,41 @@ class ExtractMetadataTest(unittest.TestCase):
 
         assert 2 == result_n_rows
 
+    def test_get_table_level_metadata_estimated_rows(self):
+        """Test estimating the number of rows from the catalog."""
+
+        self.engine.execute("""
+            INSERT INTO metabase.data_table (data_table_id, file_table_name)
+                VALUES (1, 'data.table_1');
+
+            CREATE TABLE data.table_1 (c1 INT PRIMARY KEY);
+            INSERT INTO data.table_1 SELECT generate_series(1, 1000);
+        """)
+
+        def table_level_metadata(**kwargs):
+            with patch('metabase.extract_metadata.settings',
+                       self.mock_params):
+                extract = extract_metadata.ExtractMetadata(data_table_id=1)
+            extract.process_table(**kwargs)
+
+            return tuple(self.engine.execute("""
+                SELECT number_rows, number_rows_estimated, number_columns,
+                    total_size > size
+                FROM metabase.data_table
+            """).fetchone())
+
+        # A small table is analyzed whole, so its estimate is exact.
+        assert (1000, True, 1, True) == table_level_metadata(
+            estimate_rows=True)
+        assert (1000, False, 1, True) == table_level_metadata()
+
+        with pytest.raises(ValueError):
+            table_level_metadata(estimate_rows=True, store_sketches=True,
+                                 id_column='c1')
+        with pytest.raises(ValueError):
+            extract_metadata_helper.table_level_metadata_query(
+                'data', 'table_1', 'estimate', sql.SQL('c1 > 1'))
+
     def test_get_table_level_metadata_num_of_cols_0_col_raise_error(self):
         """
         The following group of tests share data table `data.table_test_n_cols`:
@@ -269,6 +333,7 @@ class ExtractMetadataTest(unittest.TestCase):
             extract = extract_metadata.ExtractMetadata(data_table_id=1)
 
         extract._get_table_level_metadata()
+        extract.write_session.flush()
 
         result = self.engine.execute("""
             SELECT number_columns, number_rows
@@ -294,6 +359,7 @@ class ExtractMetadataTest(unittest.TestCase):
             extract = extract_metadata.ExtractMetadata(data_table_id=1)
 
         extract._get_table_level_metadata()
+        extract.write_session.flush()
 
         self.engine.execute('DROP TABLE data.table_test_n_cols;')
 
@@ -321,6 +387,7 @@ class ExtractMetadataTest(unittest.TestCase):
             extract = extract_metadata.ExtractMetadata(data_table_id=1)
 
         extract._get_table_level_metadata()
+        extract.write_session.flush()
 
         self.engine.execute('DROP TABLE data.table_test_updated_by;')
 
@@ -349,6 +416,7 @@ class ExtractMetadataTest(unittest.TestCase):
             extract = extract_metadata.ExtractMetadata(data_table_id=1)
 
         extract._get_table_level_metadata()
+        extract.write_session.flush()
 
         self.engine.execute('DROP TABLE data.table_test_date_last_updated;')
 
@@ -564,3 +632,1701 @@ class ExtractMetadataTest(unittest.TestCase):
         assert results[1][3] == 1
         assert isinstance(results[1][4], str)
         assert isinstance(results[1][5], datetime.datetime)
+
+    def test_get_column_level_metadata_column_types(self):
+        """Test inferring the types of all columns of a text table."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1
+               (c_num TEXT, c_text TEXT, c_code TEXT, c_date TEXT);
+
+           INSERT INTO data.table_1 (c_num, c_text, c_code, c_date)
+           VALUES
+           ('1', 'text_1', 'code_1', '2018-01-01'),
+           ('-2.5', 'text_2', 'code_1', '2018-02-01'),
+           (NULL, 'text_3', 'code_2', NULL);
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        extract._get_column_level_metadata(categorical_threshold=2)
+
+        results = self.engine.execute("""
+            SELECT column_name, data_type
+            FROM metabase.column_info
+            ORDER BY column_name
+        """).fetchall()
+
+        assert [
+            ('c_code', 'code'),
+            ('c_date', 'date'),
+            ('c_num', 'numeric'),
+            ('c_text', 'text'),
+        ] == [tuple(r) for r in results]
+
+    def test_get_column_level_metadata_invalid_date_is_not_date(self):
+        """Test a column that looks like dates but does not cast to date."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_date TEXT);
+
+           INSERT INTO data.table_1 (c_date)
+           VALUES
+           ('2018-01-01'),
+           ('2018-02-30');
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        extract._get_column_level_metadata(categorical_threshold=2)
+
+        results = self.engine.execute("""
+            SELECT data_type FROM metabase.column_info
+        """).fetchall()
+
+        assert [('code',)] == [tuple(r) for r in results]
+
+    def test_get_column_level_metadata_column_types_sampled(self):
+        """Test that sampled type inference is verified on the full table."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_num TEXT, c_mixed TEXT);
+
+           INSERT INTO data.table_1 (c_num, c_mixed)
+           SELECT i::TEXT, i::TEXT FROM generate_series(1, 1000) AS i;
+
+           UPDATE data.table_1 SET c_mixed = 'x' WHERE c_num = '1000';
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        extract._get_column_level_metadata(
+            categorical_threshold=2,
+            sample_percent=1,
+            sample_method='BERNOULLI',
+        )
+
+        results = self.engine.execute("""
+            SELECT column_name, data_type
+            FROM metabase.column_info
+            ORDER BY column_name
+        """).fetchall()
+
+        assert [
+            ('c_mixed', 'text'),
+            ('c_num', 'numeric'),
+        ] == [tuple(r) for r in results]
+
+    def test_get_column_level_metadata_declared_types(self):
+        """Test that natively typed columns skip type inference."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1
+               (c_num BIGINT, c_ts TIMESTAMP, c_code VARCHAR(10));
+
+           INSERT INTO data.table_1 (c_num, c_ts, c_code)
+           VALUES
+           (1, '2018-01-01 10:00', 'a'),
+           (2, '2018-02-01 11:00', 'a');
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        with patch('metabase.extract_metadata.extract_metadata_helper'
+                   '.get_column_types',
+                   return_value={'c_code': 'code'}) as get_column_types:
+            extract._get_column_level_metadata(categorical_threshold=2)
+
+        assert ['c_code'] == get_column_types.call_args[0][1]
+
+        results = self.engine.execute("""
+            SELECT column_name, data_type
+            FROM metabase.column_info
+            ORDER BY column_name
+        """).fetchall()
+
+        assert [
+            ('c_code', 'code'),
+            ('c_num', 'numeric'),
+            ('c_ts', 'date'),
+        ] == [tuple(r) for r in results]
+
+    def test_get_column_level_metadata_mostly_numeric(self):
+        """Test a numeric column with a tolerated fraction of bad values."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_num TEXT, c_code TEXT);
+
+           INSERT INTO data.table_1 (c_num, c_code)
+           VALUES ('1', 'a'), ('2', 'a'), ('3', 'b'), ('n/a', 'b'),
+           (NULL, NULL);
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        extract._get_column_level_metadata(
+            categorical_threshold=2,
+            max_invalid_fraction=0.25,
+        )
+
+        results = self.engine.execute("""
+            SELECT column_name, minimum, maximum
+            FROM metabase.numeric_column
+        """).fetchall()
+
+        assert [('c_num', 1, 3)] == [tuple(r) for r in results]
+
+        # The bad value is counted apart from the null values.
+        results = self.engine.execute("""
+            SELECT column_name, data_type, null_count, invalid_count
+            FROM metabase.column_info
+            ORDER BY column_name
+        """).fetchall()
+
+        assert [
+            ('c_code', 'code', 1, 0),
+            ('c_num', 'numeric', 1, 1),
+        ] == [tuple(r) for r in results]
+
+    def test_get_column_level_metadata_mostly_numeric_sampled(self):
+        """Test that a tolerated fraction of bad values skips the sample."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_num TEXT);
+
+           INSERT INTO data.table_1 (c_num)
+           SELECT i::TEXT FROM generate_series(1, 99) AS i;
+
+           INSERT INTO data.table_1 (c_num) VALUES ('n/a');
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        # The check is only run on the whole table, whatever the sample.
+        with patch('metabase.extract_metadata_helper.run_type_checks_steps',
+                   wraps=extract_metadata_helper.run_type_checks_steps) \
+                as checks:
+            extract._get_column_level_metadata(
+                categorical_threshold=2,
+                sample_percent=1,
+                sample_method='BERNOULLI',
+                max_invalid_fraction=0.05,
+            )
+
+        assert not checks.called
+
+        results = self.engine.execute("""
+            SELECT column_name, minimum, maximum
+            FROM metabase.numeric_column
+        """).fetchall()
+
+        assert [('c_num', 1, 99)] == [tuple(r) for r in results]
+
+    def test_get_column_level_metadata_try_cast_only_with_tolerance(self):
+        """Test that patterns alone check types when nothing is tolerated."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_num TEXT);
+
+           INSERT INTO data.table_1 (c_num) VALUES ('1'), ('2');
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        with patch('metabase.extract_metadata_helper.has_try_cast_functions',
+                   wraps=extract_metadata_helper.has_try_cast_functions) \
+                as has_try_cast_functions:
+            extract._get_column_level_metadata(categorical_threshold=1)
+
+        assert not has_try_cast_functions.called
+
+        # Values not matching the pattern are not passed to the functions by
+        # the scan checking types.
+        condition = extract_metadata_helper.invalid_value_condition(
+            sql.SQL('value'), 'numeric', try_cast=True,
+        ).as_string(extract.data_cur)
+        assert 'CASE WHEN value ~ ' in condition
+        assert 'metabase."try_cast_numeric"(value)' in condition
+
+    def test_get_column_level_metadata_without_try_cast_functions(self):
+        """Test type inference when the try cast functions do not exist."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_num TEXT, c_date TEXT);
+
+           INSERT INTO data.table_1 (c_num, c_date)
+           VALUES
+           ('1', '2018-01-01'),
+           ('2', '2018-02-30');
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        with patch('metabase.extract_metadata.extract_metadata_helper'
+                   '.has_try_cast_functions', return_value=False):
+            with pytest.raises(ValueError):
+                extract._get_column_level_metadata(
+                    categorical_threshold=2,
+                    max_invalid_fraction=0.5,
+                )
+
+            extract._get_column_level_metadata(categorical_threshold=2)
+
+        results = self.engine.execute("""
+            SELECT column_name, data_type
+            FROM metabase.column_info
+            ORDER BY column_name
+        """).fetchall()
+
+        assert [
+            ('c_date', 'code'),
+            ('c_num', 'numeric'),
+        ] == [tuple(r) for r in results]
+
+    def test_try_cast_functions_script(self):
+        """Test installing the try cast functions on their own."""
+
+        script = os.path.join(os.path.dirname(__file__), '..', 'sql',
+                              'try_cast_functions.sql')
+
+        conn = psycopg2.connect(self.connection_string)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    DROP FUNCTION metabase.try_cast_date(TEXT);
+                    DROP FUNCTION metabase.try_cast_numeric(TEXT);
+                """)
+                assert not extract_metadata_helper.has_try_cast_functions(
+                    cursor)
+
+                with open(script) as script_file:
+                    cursor.execute(script_file.read())
+
+                assert extract_metadata_helper.has_try_cast_functions(cursor)
+                cursor.execute("""
+                    SELECT
+                        metabase.try_cast_numeric('1.5') = 1.5,
+                        metabase.try_cast_numeric('n/a') IS NULL,
+                        metabase.try_cast_date('2018-02-30') IS NULL
+                """)
+                assert (True, True, True) == cursor.fetchone()
+            conn.commit()
+        finally:
+            conn.close()
+
+    def test_count_distinct_values_up_to_limit(self):
+        """Test that distinct values are counted up to the limit only."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_high TEXT, c_low TEXT);
+
+           INSERT INTO data.table_1 (c_high, c_low)
+           SELECT i::TEXT, mod(i, 3)::TEXT FROM generate_series(1, 10000) AS i;
+
+           INSERT INTO data.table_1 (c_high, c_low) VALUES (NULL, NULL);
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        assert {'c_high': 6, 'c_low': 3} == (
+            extract_metadata_helper.count_distinct_values(
+                extract.data_cur, ['c_high', 'c_low'], 'data', 'table_1', 5))
+
+    def test_get_column_level_metadata_array_and_jsonb(self):
+        """Test profiling array and jsonb columns as code columns."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_array INT[], c_json JSONB);
+
+           INSERT INTO data.table_1 (c_array, c_json)
+           VALUES
+           ('{1,2}', '{"a": 1}'),
+           ('{1,2}', '{"a": 1}'),
+           ('{3}', '{"b": [2]}');
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        assert {'c_array': 2, 'c_json': 2} == (
+            extract_metadata_helper.count_distinct_values(
+                extract.data_cur, ['c_array', 'c_json'], 'data', 'table_1',
+                5))
+
+        extract._get_column_level_metadata(categorical_threshold=2)
+
+        results = self.engine.execute("""
+            SELECT column_name, code, frequency
+            FROM metabase.code_frequency
+            ORDER BY column_name, code
+        """).fetchall()
+
+        assert [
+            ('c_array', '{1,2}', 2),
+            ('c_array', '{3}', 1),
+            ('c_json', '{"a": 1}', 2),
+            ('c_json', '{"b": [2]}', 1),
+        ] == [tuple(row) for row in results]
+
+    def test_get_column_types_code_columns_scans(self):
+        """Test that code columns are counted in one scan of the table."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (
+               c_num TEXT, c_code_1 TEXT, c_code_2 TEXT, c_code_3 TEXT,
+               c_code_4 TEXT, c_text TEXT
+           );
+
+           INSERT INTO data.table_1
+           SELECT
+               i::TEXT,
+               'a_' || mod(i, 2),
+               'b_' || mod(i, 3),
+               'c_' || mod(i, 4),
+               'd_' || mod(i, 5),
+               'text_' || i
+           FROM generate_series(1, 10000) AS i;
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        columns = ['c_num', 'c_code_1', 'c_code_2', 'c_code_3', 'c_code_4',
+                   'c_text']
+        with patch('metabase.extract_metadata_helper.execute_request',
+                   wraps=extract_metadata_helper.execute_request) \
+                as execute_request:
+            column_types = extract_metadata_helper.get_column_types(
+                extract.data_cur, columns, 4, 'data', 'table_1')
+        requests = [args[1] for args, _ in execute_request.call_args_list]
+
+        assert {
+            'c_num': 'numeric',
+            'c_code_1': 'code',
+            'c_code_2': 'code',
+            'c_code_3': 'code',
+            'c_code_4': 'text',
+            'c_text': 'text',
+        } == column_types
+        # The type checks with the distinct value estimates, the cast probes
+        # of the numeric and date checks failed by the patterns, each stopping
+        # at the first value, then the exact counts of the columns that may
+        # be code, each fetching a few rows.
+        assert (
+            [extract_metadata_helper.FetchAll]
+            + [extract_metadata_helper.Succeeds] * 10
+            + [extract_metadata_helper.FetchAll]
+        ) == [type(request) for request in requests]
+        assert 'SELECT DISTINCT' in requests[-1].query.as_string(
+            extract.data_cur)
+
+    def test_get_column_types_cast_forms_outside_patterns(self):
+        """Test that types follow casts where the patterns do not."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (
+               c_nan TEXT, c_infinity TEXT, c_unicode_space TEXT,
+               c_date TEXT
+           );
+
+           INSERT INTO data.table_1
+           VALUES
+           ('1.5', '1', '1', 'Jan 5 2020'),
+           ('NaN', 'Infinity', E'\\u2003' || '2', '20200106'),
+           ('2', '-inf', '3', '7-Jan-2020');
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        columns = ['c_nan', 'c_infinity', 'c_unicode_space', 'c_date']
+        expected = {
+            'c_nan': 'numeric',
+            'c_infinity': 'numeric',
+            'c_unicode_space': 'text',
+            'c_date': 'date',
+        }
+        for options in [{},
+                        {'sample_percent': 100},
+                        {'try_cast': True, 'max_invalid_fraction': 0.01}]:
+            assert expected == extract_metadata_helper.get_column_types(
+                extract.data_cur, columns, 1, 'data', 'table_1', **options)
+
+        # Numeric Column holds integers, which cannot be NaN or infinite.
+        self.engine.execute("""
+            ALTER TABLE data.table_1 DROP COLUMN c_nan, DROP COLUMN c_infinity
+        """)
+        extract._get_column_level_metadata(categorical_threshold=1)
+
+        results = self.engine.execute("""
+            SELECT min_date, max_date
+            FROM metabase.date_column
+        """).fetchall()
+
+        assert [(datetime.date(2020, 1, 5), datetime.date(2020, 1, 7))] == [
+            tuple(r) for r in results]
+
+    def test_get_column_level_metadata_ratio_threshold(self):
+        """Test a categorical threshold given as a distinct to rows ratio."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_code TEXT, c_near TEXT, c_text TEXT);
+
+           INSERT INTO data.table_1 (c_code, c_near, c_text)
+           SELECT
+               'code_' || mod(i, 3),
+               'near_' || mod(i, 10),
+               'text_' || i
+           FROM generate_series(1, 1000) AS i;
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        extract._get_column_level_metadata(categorical_threshold=0.01)
+
+        results = self.engine.execute("""
+            SELECT column_name, data_type
+            FROM metabase.column_info
+            ORDER BY column_name
+        """).fetchall()
+
+        assert [
+            ('c_code', 'code'),
+            ('c_near', 'code'),
+            ('c_text', 'text'),
+        ] == [tuple(r) for r in results]
+
+    def test_get_column_types_ratio_threshold_single_scan(self):
+        """Test that types and distinct estimates come from one scan."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (
+               c_num TEXT, c_mostly_num TEXT, c_date TEXT, c_code TEXT,
+               c_text TEXT
+           );
+
+           INSERT INTO data.table_1
+           SELECT
+               i::TEXT,
+               CASE WHEN i = 7 THEN 'n/a' ELSE i::TEXT END,
+               (DATE '2018-01-01' + i)::TEXT,
+               'code_' || mod(i, 3),
+               'text_' || i
+           FROM generate_series(1, 1000) AS i;
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        columns = ['c_num', 'c_mostly_num', 'c_date', 'c_code', 'c_text']
+        with patch('metabase.extract_metadata_helper.execute_request',
+                   wraps=extract_metadata_helper.execute_request) \
+                as execute_request:
+            column_types = extract_metadata_helper.get_column_types(
+                extract.data_cur, columns, 0.01, 'data', 'table_1',
+                max_invalid_fraction=0.01)
+        requests = [args[1] for args, _ in execute_request.call_args_list]
+
+        assert {
+            'c_num': 'numeric',
+            'c_mostly_num': 'numeric',
+            'c_date': 'date',
+            'c_code': 'code',
+            'c_text': 'text',
+        } == column_types
+        # Then only the cast probes of the numeric check of c_date and of
+        # both checks of c_code and c_text, each stopping at the first value.
+        assert (
+            [extract_metadata_helper.FetchAll]
+            + [extract_metadata_helper.Succeeds] * 5
+        ) == [type(request) for request in requests]
+
+    def test_get_column_level_metadata_no_converted_data(self):
+        """Test that columns are not copied into a temporary table."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_num TEXT, c_date TEXT, c_code TEXT);
+
+           INSERT INTO data.table_1 (c_num, c_date, c_code)
+           VALUES
+           ('1', '2018-01-01', 'a'),
+           ('2', '2018-02-01', 'a');
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        extract._get_column_level_metadata(categorical_threshold=2)
+
+        extract.data_cur.execute(
+            "SELECT to_regclass('pg_temp.converted_data')")
+
+        assert extract.data_cur.fetchone()[0] is None
+        assert 3 == self.engine.execute(
+            'SELECT COUNT(*) FROM metabase.column_info').fetchone()[0]
+
+    def test_get_column_level_metadata_percentiles(self):
+        """Test approximate and exact percentiles of numbers and lengths."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 AS
+           SELECT i AS c_num, repeat('x', i) AS c_text
+           FROM generate_series(1, 101) AS i;
+        """)
+
+        for exact_quantiles in [False, True]:
+            with patch('metabase.extract_metadata.settings',
+                       self.mock_params):
+                extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+            extract._get_column_level_metadata(
+                categorical_threshold=2, exact_quantiles=exact_quantiles)
+
+            numeric_results = self.engine.execute("""
+                SELECT median, percentile_1, percentile_25, percentile_99
+                FROM metabase.numeric_column
+            """).fetchall()
+            text_results = self.engine.execute("""
+                SELECT median_length, percentile_5_length,
+                percentile_95_length
+                FROM metabase.text_column
+            """).fetchall()
+
+            assert [(51, 2, 26, 100)] == numeric_results
+            assert [(51, 6, 96)] == text_results
+
+            self.engine.execute("""
+                TRUNCATE metabase.column_info, metabase.numeric_column,
+                metabase.text_column CASCADE
+            """)
+
+    def test_get_column_level_metadata_text_lengths(self):
+        """Test byte lengths and the length histogram of a text column."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_text TEXT);
+
+           INSERT INTO data.table_1 (c_text)
+           VALUES (''), ('é'), ('ab'), ('abc'), ('abcde'), (NULL);
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        extract._get_column_level_metadata(categorical_threshold=2)
+
+        results = self.engine.execute("""
+            SELECT
+            max_length,
+            min_length,
+            median_length,
+            max_byte_length,
+            min_byte_length,
+            total_byte_length,
+            length_histogram
+            FROM metabase.text_column
+        """).fetchall()[0]
+
+        assert (5, 0, 2, 5, 0, 12,
+                {'0': 1, '1': 1, '2': 2, '4': 1}) == tuple(results)
+        extract.data_cur.execute("SELECT to_regclass('pg_temp.text_length')")
+        assert extract.data_cur.fetchone()[0] is None
+
+    def test_get_column_level_metadata_fused_chunks(self):
+        """Test null counts and metadata split over several SELECTs."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1
+               (c_num INT, c_date DATE, c_text TEXT, c_code TEXT);
+
+           INSERT INTO data.table_1 (c_num, c_date, c_text, c_code)
+           VALUES
+           (1, '2018-01-01', 'abc', 'a'),
+           (NULL, NULL, 'de', NULL),
+           (3, '2018-03-01', NULL, 'a');
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        with patch('metabase.extract_metadata_helper.MAX_TARGET_ENTRIES', 2):
+            extract._get_column_level_metadata(categorical_threshold=1)
+
+        column_info = self.engine.execute("""
+            SELECT column_name, data_type, null_count
+            FROM metabase.column_info
+            ORDER BY column_name
+        """).fetchall()
+        numeric_results = self.engine.execute("""
+            SELECT minimum, maximum, mean, median
+            FROM metabase.numeric_column
+        """).fetchall()
+        date_results = self.engine.execute("""
+            SELECT min_date, max_date
+            FROM metabase.date_column
+        """).fetchall()
+
+        assert [
+            ('c_code', 'code', 1),
+            ('c_date', 'date', 1),
+            ('c_num', 'numeric', 1),
+            ('c_text', 'text', 1),
+        ] == [tuple(r) for r in column_info]
+        assert [(1, 3, 2, 2)] == [tuple(r) for r in numeric_results]
+        assert [(datetime.date(2018, 1, 1), datetime.date(2018, 3, 1))] == [
+            tuple(r) for r in date_results]
+
+    def test_get_column_level_metadata_many_code_columns(self):
+        """Test code frequencies of several columns counted together."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_1 TEXT, c_2 TEXT, c_3 TEXT);
+
+           INSERT INTO data.table_1 (c_1, c_2, c_3)
+           VALUES
+           ('a', 'yes', 'x'),
+           ('b', 'yes', NULL),
+           ('a', 'no', 'x');
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        extract._get_column_level_metadata(categorical_threshold=2)
+
+        results = self.engine.execute("""
+            SELECT column_name, code, frequency
+            FROM metabase.code_frequency
+            ORDER BY column_name, code
+        """).fetchall()
+
+        assert [
+            ('c_1', 'a', 2),
+            ('c_1', 'b', 1),
+            ('c_2', 'no', 1),
+            ('c_2', 'yes', 2),
+            ('c_3', 'x', 2),
+        ] == [tuple(r) for r in results]
+
+    def test_get_column_level_metadata_code_frequency_pages(self):
+        """Test writing code frequencies over several multi-row inserts."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 AS
+           SELECT chr(97 + mod(i, 5)) AS c_code
+           FROM generate_series(1, 20) AS i;
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        with patch('metabase.write_session.INSERT_PAGE_SIZE', 2):
+            extract._get_column_level_metadata(categorical_threshold=5)
+
+        results = self.engine.execute("""
+            SELECT code, frequency
+            FROM metabase.code_frequency
+            ORDER BY code
+        """).fetchall()
+
+        assert [('a', 4), ('b', 4), ('c', 4), ('d', 4), ('e', 4)] == [
+            tuple(r) for r in results]
+        extract.metabase_cur.execute(
+            "SELECT to_regclass('pg_temp.code_freq_temp')")
+        assert extract.metabase_cur.fetchone()[0] is None
+
+    def test_get_column_level_metadata_single_transaction(self):
+        """Test that column metadata is written all at once or not at all."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_num INT, c_text TEXT);
+
+           INSERT INTO data.table_1 (c_num, c_text)
+           VALUES (1, 'abc'), (2, 'de'), (3, 'f');
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        # A text row without its column info row fails at the last insert.
+        def add_orphan_row(write_session, col, data_table_id, metadata):
+            write_session.add('text_column', {'data_table_id': data_table_id,
+                                              'column_name': col})
+
+        with patch('metabase.extract_metadata_helper.update_text',
+                   side_effect=add_orphan_row):
+            with pytest.raises(psycopg2.IntegrityError):
+                extract._get_column_level_metadata(categorical_threshold=2)
+
+        assert 0 == self.engine.execute(
+            'SELECT COUNT(*) FROM metabase.column_info').fetchone()[0]
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+        extract._get_column_level_metadata(categorical_threshold=2)
+
+        assert 2 == self.engine.execute(
+            'SELECT COUNT(*) FROM metabase.column_info').fetchone()[0]
+        assert isinstance(extract.commit_latency, float)
+
+    def test_get_column_level_metadata_reprofile(self):
+        """Test that profiling a table again refreshes its metadata."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_code TEXT, c_num TEXT);
+
+           INSERT INTO data.table_1 (c_code, c_num)
+           VALUES ('a', '1'), ('b', '2'), ('a', '3');
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+        extract._get_column_level_metadata(categorical_threshold=2)
+
+        self.engine.execute("""
+           UPDATE data.table_1 SET c_code = 'c' WHERE c_code = 'b';
+           UPDATE data.table_1 SET c_num = 'x' || c_num;
+        """)
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+        extract._get_column_level_metadata(categorical_threshold=2)
+
+        column_info = self.engine.execute("""
+            SELECT column_name, data_type
+            FROM metabase.column_info
+            ORDER BY column_name
+        """).fetchall()
+        code_frequency = self.engine.execute("""
+            SELECT code, frequency
+            FROM metabase.code_frequency
+            ORDER BY code
+        """).fetchall()
+
+        assert [('c_code', 'code'), ('c_num', 'text')] == [
+            tuple(r) for r in column_info]
+        assert [('a', 2), ('c', 1)] == [tuple(r) for r in code_frequency]
+        assert 0 == self.engine.execute(
+            'SELECT COUNT(*) FROM metabase.numeric_column').fetchone()[0]
+        assert 1 == self.engine.execute(
+            'SELECT COUNT(*) FROM metabase.text_column').fetchone()[0]
+
+    def test_write_session_replaces_rows(self):
+        """Test that a flush replaces the rows of the profiled tables.
+
+        Rows are replaced whatever the time zone of the metabase
+        connection, as stale rows are not told apart by timestamp.
+
+        """
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1'), (2, 'data.table_2');
+        """)
+
+        def flush(data_table_id, codes):
+            conn = psycopg2.connect(
+                self.connection_string,
+                options='-c TimeZone=America/New_York')
+            session = write_session.WriteSession(conn)
+            extract_metadata_helper.update_code(
+                session, 'c', data_table_id,
+                {'null_count': 0,
+                 'frequencies': [(code, 1) for code in codes]})
+            session.flush()
+            conn.close()
+
+        flush(1, ['a', 'b'])
+        flush(2, ['a'])
+        flush(1, ['b', 'c'])
+
+        assert [(1, 'b'), (1, 'c'), (2, 'a')] == [
+            tuple(r) for r in self.engine.execute("""
+                SELECT data_table_id, code FROM metabase.code_frequency
+                ORDER BY 1, 2
+            """)]
+
+    def test_process_table_writes_table_level_metadata_atomically(self):
+        """Test that Data Table is only updated with the column metadata."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_num INT);
+
+           INSERT INTO data.table_1 (c_num) VALUES (1), (2), (3);
+        """)
+
+        def number_rows():
+            return self.engine.execute(
+                'SELECT number_rows FROM metabase.data_table').fetchone()[0]
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+        with patch('metabase.extract_metadata_helper.get_column_metadata',
+                   side_effect=psycopg2.OperationalError):
+            with pytest.raises(psycopg2.OperationalError):
+                extract.process_table(categorical_threshold=2)
+
+        assert number_rows() is None
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+        extract.process_table(categorical_threshold=2)
+
+        assert 3 == number_rows()
+
+    def test_process_table_connection_provider(self):
+        """Test borrowing connections from a connection provider."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_num INT);
+
+           INSERT INTO data.table_1 (c_num) VALUES (1), (2), (3);
+        """)
+
+        provider = connection_pool.ConnectionProvider(
+            self.connection_string, self.connection_string)
+
+        backend_pids = []
+        for _ in range(2):
+            extract = extract_metadata.ExtractMetadata(
+                data_table_id=1, connection_provider=provider)
+            assert extract.metabase_conn is extract.data_conn
+            backend_pids.append(extract.data_conn.get_backend_pid())
+            extract.process_table(categorical_threshold=2)
+
+        provider.close()
+
+        assert backend_pids[0] == backend_pids[1]
+        assert 1 == self.engine.execute(
+            'SELECT COUNT(*) FROM metabase.numeric_column').fetchone()[0]
+
+    def test_process_table_snapshot_error(self):
+        """Test that a failed snapshot returns the borrowed connections."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_num INT);
+
+           INSERT INTO data.table_1 (c_num) VALUES (1), (2), (3);
+        """)
+
+        provider = connection_pool.ConnectionProvider(
+            self.connection_string, self.connection_string)
+        extract = extract_metadata.ExtractMetadata(
+            data_table_id=1, connection_provider=provider)
+        data_conn = extract.data_conn
+
+        snapshot_conn = MagicMock()
+        snapshot_conn.cursor.return_value.execute.side_effect = (
+            psycopg2.OperationalError)
+        with patch('metabase.extract_metadata.psycopg2.connect',
+                   return_value=snapshot_conn), \
+                patch.object(provider, 'put_connections',
+                             wraps=provider.put_connections) \
+                as put_connections:
+            with pytest.raises(psycopg2.OperationalError):
+                extract.process_table(categorical_threshold=2,
+                                      column_workers=2)
+
+        provider.close()
+
+        assert snapshot_conn.close.called
+        assert extract.data_conn is data_conn
+        put_connections.assert_called_once_with(extract.metabase_conn,
+                                                data_conn)
+
+    def test_process_table_stream_code_frequencies(self):
+        """Test streaming code frequencies on a shared pooled connection."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 AS
+           SELECT 'code_' || mod(i, 50) AS c_code, chr(97 + mod(i, 2)) AS c_ab
+           FROM generate_series(1, 200) AS i;
+        """)
+
+        provider = connection_pool.ConnectionProvider(
+            self.connection_string, self.connection_string)
+        extract = extract_metadata.ExtractMetadata(
+            data_table_id=1, connection_provider=provider)
+        conn = extract.data_conn
+
+        with patch('metabase.extract_metadata_helper.server_side_cursor',
+                   wraps=extract_metadata_helper.server_side_cursor) \
+                as server_side_cursor, \
+                patch('metabase.write_session.INSERT_PAGE_SIZE', 3):
+            extract.process_table(categorical_threshold=100, itersize=2)
+
+        server_side_cursor.assert_any_call(extract.data_cur,
+                                           'stream_code_frequencies', 2)
+        assert conn.autocommit
+        provider.close()
+
+        results = self.engine.execute("""
+            SELECT column_name, COUNT(*), SUM(frequency)
+            FROM metabase.code_frequency
+            GROUP BY column_name
+            ORDER BY column_name
+        """).fetchall()
+        assert [('c_ab', 2, 200), ('c_code', 50, 200)] == [
+            tuple(r) for r in results]
+
+    def test_code_frequencies_streamed_on_every_engine(self):
+        """Test that code frequencies are streamed to the metabase."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 AS
+           SELECT 'code_' || mod(i, 5) AS c_code, i AS c_num
+           FROM generate_series(1, 100) AS i;
+        """)
+
+        def code_frequencies():
+            return [tuple(r) for r in self.engine.execute("""
+                SELECT code, frequency
+                FROM metabase.code_frequency
+                ORDER BY code
+            """).fetchall()]
+
+        def process_async():
+            loop = asyncio.new_event_loop()
+            try:
+                (result,) = loop.run_until_complete(
+                    async_extract_metadata.process_tables(
+                        [1],
+                        metabase_connection_string=self.connection_string,
+                        data_connection_string=self.connection_string,
+                        categorical_threshold=5,
+                        itersize=2,
+                    ))
+            finally:
+                loop.close()
+            assert result.success, result.error
+
+        def process_sync(column_workers):
+            with patch('metabase.extract_metadata.settings',
+                       self.mock_params):
+                extract = extract_metadata.ExtractMetadata(1)
+            extract.process_table(categorical_threshold=5,
+                                  column_workers=column_workers, itersize=2)
+
+        expected = [('code_{}'.format(i), 20) for i in range(5)]
+        for process in [lambda: process_sync(1), lambda: process_sync(2),
+                        process_async]:
+            self.engine.execute('TRUNCATE TABLE metabase.column_info '
+                                'CASCADE')
+            # Codes are only collected in memory by read_code_frequencies.
+            with patch('metabase.extract_metadata_helper'
+                       '.read_code_frequencies') as read_code_frequencies:
+                process()
+
+            assert not read_code_frequencies.called
+            assert expected == code_frequencies()
+
+    def test_process_table_skip_unchanged(self):
+        """Test skipping tables that did not change since their profiling."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (c_num INT, c_text TEXT);
+           INSERT INTO data.table_1 VALUES (1, 'a'), (2, 'b'), (3, 'c');
+        """)
+
+        def process_table(categorical_threshold=2, **kwargs):
+            """Profile the table and return True if it was skipped."""
+
+            self.engine.execute(
+                'UPDATE metabase.data_table SET number_rows = NULL')
+            with patch('metabase.extract_metadata.settings',
+                       self.mock_params):
+                extract = extract_metadata.ExtractMetadata(data_table_id=1)
+            extract.process_table(categorical_threshold, **kwargs)
+
+            number_rows = self.engine.execute(
+                'SELECT number_rows FROM metabase.data_table').fetchone()[0]
+            assert extract.skipped == (number_rows is None)
+            return extract.skipped
+
+        def wait_for_statistics(n_tup_ins, n_tup_upd):
+            """Wait until the statistics count the changes of the table."""
+
+            for _ in range(100):
+                self.engine.execute('SELECT pg_stat_clear_snapshot()')
+                if (n_tup_ins, n_tup_upd) == tuple(self.engine.execute("""
+                    SELECT n_tup_ins, n_tup_upd FROM pg_stat_user_tables
+                    WHERE relid = 'data.table_1'::regclass
+                """).fetchone()):
+                    return
+                time.sleep(0.1)
+
+        wait_for_statistics(3, 0)
+
+        # Without a stored watermark, the table is profiled.
+        assert not process_table(skip_unchanged=True)
+        assert process_table(skip_unchanged=True)
+        assert not process_table()
+
+        # An update in place changes the counters.
+        self.engine.execute("UPDATE data.table_1 SET c_text = 'z' "
+                            "WHERE c_num = 1")
+        wait_for_statistics(3, 1)
+        assert not process_table(skip_unchanged=True)
+        assert process_table(skip_unchanged=True)
+
+        # So do options that change the metadata, but not the others.
+        assert not process_table(skip_unchanged=True,
+                                 categorical_threshold=3)
+        assert process_table(skip_unchanged=True, categorical_threshold=3,
+                             itersize=10)
+        assert not process_table(skip_unchanged=True,
+                                 categorical_threshold=3,
+                                 exact_quantiles=True)
+
+        # A truncate changes the file node.
+        self.engine.execute('TRUNCATE data.table_1; '
+                            'INSERT INTO data.table_1 VALUES (4, NULL)')
+        assert not process_table(skip_unchanged=True)
+
+        # A new column changes the column signature.
+        self.engine.execute('ALTER TABLE data.table_1 ADD COLUMN c_new INT')
+        assert not process_table(skip_unchanged=True)
+        assert 3 == self.engine.execute(
+            'SELECT COUNT(*) FROM metabase.column_info').fetchone()[0]
+
+        # Checksums are compared when requested.
+        assert not process_table(skip_unchanged=True, checksum=True)
+        assert process_table(skip_unchanged=True, checksum=True)
+        self.engine.execute("UPDATE metabase.table_watermark "
+                            "SET checksum = 'stale'")
+        assert not process_table(skip_unchanged=True, checksum=True)
+
+    def test_process_appended_rows(self):
+        """Test merging appended rows into the stored column sketches."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 (id INT, c_num TEXT, c_date TEXT,
+                                      c_code TEXT, c_text TEXT);
+           INSERT INTO data.table_1 VALUES
+               (1, '1', '2019-01-01', 'a', 'x'),
+               (2, '2', '2019-01-02', 'b', 'yy'),
+               (3, '3', NULL, 'a', 'zzz'),
+               (4, NULL, '2019-01-04', 'b', NULL);
+        """)
+
+        def extract():
+            with patch('metabase.extract_metadata.settings',
+                       self.mock_params):
+                return extract_metadata.ExtractMetadata(data_table_id=1)
+
+        extract().process_table(categorical_threshold=2,
+                                store_sketches=True, id_column='id')
+        assert ('id', '4') == tuple(self.engine.execute(
+            'SELECT id_column, max_id FROM metabase.table_watermark'
+        ).fetchone())
+
+        # Appended rows are found by their ID.
+        self.engine.execute("""
+            INSERT INTO data.table_1 VALUES
+                (5, '4', '2018-12-31', 'a', 'wwww'),
+                (6, '10', NULL, NULL, 'v');
+        """)
+        extract().process_appended_rows(id_column='id')
+        appended = self.metadata_rows()
+        extract().process_table(categorical_threshold=2,
+                                store_sketches=True, id_column='id')
+        assert appended == self.metadata_rows()
+        assert [(6, 1, 4)] == [tuple(r) for r in self.engine.execute(
+            'SELECT number_rows, null_count, mean '
+            'FROM metabase.data_table '
+            'JOIN metabase.column_info USING (data_table_id) '
+            'JOIN metabase.numeric_column USING (data_table_id, column_name) '
+            "WHERE column_name = 'c_num'"
+        )]
+
+        # Or by a condition, which clears the ID watermark.
+        self.engine.execute("""
+            INSERT INTO data.table_1 VALUES
+                (7, '-1', '2020-01-01', 'b', 'uuuuu');
+        """)
+        extract().process_appended_rows(new_rows='id > 6')
+        appended = self.metadata_rows()
+        extract().process_table(categorical_threshold=2,
+                                store_sketches=True)
+        assert appended == self.metadata_rows()
+
+        with pytest.raises(ValueError):
+            extract().process_appended_rows(id_column='id')
+
+        # Without sketches, the whole table must be profiled.
+        extract().process_table(categorical_threshold=2)
+        assert 0 == self.engine.execute(
+            'SELECT COUNT(*) FROM metabase.column_sketch').fetchone()[0]
+        with pytest.raises(ValueError):
+            extract().process_appended_rows(new_rows='id > 7')
+
+    def test_process_partitioned_table(self):
+        """Test merging the metadata of partitions and caching them."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1'), (2, 'data.table_1');
+
+           CREATE TABLE data.table_1 (id INT, c_num TEXT, c_code TEXT,
+                                      c_text TEXT)
+           PARTITION BY RANGE (id);
+           CREATE TABLE data.table_1_a PARTITION OF data.table_1
+           FOR VALUES FROM (0) TO (10);
+           CREATE TABLE data.table_1_b PARTITION OF data.table_1
+           FOR VALUES FROM (10) TO (20);
+
+           INSERT INTO data.table_1 VALUES
+               (1, '1.5', 'a', 'x'),
+               (2, NULL, 'b', 'yy'),
+               (11, '-3', 'a', NULL),
+               (12, '7', NULL, 'zzz'),
+               (13, '2', 'b', 'x');
+        """)
+
+        def column_metadata(data_table_id):
+            """Return the column metadata rows of a Data Table."""
+
+            key = ('data_table_id', data_table_id)
+            return [
+                (table, [item for item in row if item != key])
+                for table, row in self.metadata_rows(
+                    ('column_info', 'numeric_column', 'text_column',
+                     'code_frequency'))
+                if key in row
+            ]
+
+        def profiled_partitions(categorical_threshold=2):
+            """Profile the partitions and return those that were scanned.
+
+            Data Table 2 is the same table profiled as a whole.
+
+            """
+
+            with patch('metabase.extract_metadata.settings',
+                       self.mock_params):
+                extract_metadata.ExtractMetadata(
+                    data_table_id=2).process_table(categorical_threshold)
+                extract = extract_metadata.ExtractMetadata(data_table_id=1)
+            with patch('metabase.extract_metadata_helper.get_column_metadata',
+                       wraps=extract_metadata_helper.get_column_metadata) \
+                    as get_column_metadata:
+                extract.process_partitioned_table(categorical_threshold,
+                                                  checksum=True)
+
+            assert column_metadata(2) == column_metadata(1)
+            return sorted(c[0][3] for c in get_column_metadata.call_args_list)
+
+        assert ['table_1_a', 'table_1_b'] == profiled_partitions()
+        assert [(5, 2)] == [tuple(r) for r in self.engine.execute(
+            'SELECT number_rows, COUNT(*) FROM metabase.data_table '
+            'JOIN metabase.partition_profile USING (data_table_id) '
+            'GROUP BY 1')]
+        assert 0 < self.engine.execute(
+            'SELECT size FROM metabase.data_table '
+            'WHERE data_table_id = 1').fetchone()[0]
+
+        # Unchanged partitions are merged from their stored states.
+        assert [] == profiled_partitions()
+
+        self.engine.execute(
+            "INSERT INTO data.table_1 VALUES (3, '0', 'b', 'x')")
+        assert ['table_1_a'] == profiled_partitions()
+
+        # A code column with too many codes becomes text.
+        self.engine.execute(
+            "INSERT INTO data.table_1 VALUES (14, '0', 'c', 'x')")
+        assert ['table_1_a', 'table_1_b', 'table_1_b'] == (
+            profiled_partitions())
+        assert ['text'] == [r[0] for r in self.engine.execute(
+            "SELECT DISTINCT data_type FROM metabase.column_info "
+            "WHERE column_name = 'c_code'")]
+
+        # Other options infer the types and profile the partitions again.
+        assert ['table_1_a', 'table_1_b'] == profiled_partitions(3)
+        assert ['code'] == [r[0] for r in self.engine.execute(
+            "SELECT DISTINCT data_type FROM metabase.column_info "
+            "WHERE column_name = 'c_code'")]
+
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(data_table_id=1)
+        self.engine.execute('CREATE TABLE data.table_2 (c INT)')
+        extract.table_name = 'table_2'
+        with pytest.raises(ValueError):
+            extract.process_partitioned_table()
+        self.engine.execute('DROP TABLE data.table_2')
+
+    def test_process_table_statistics_only(self):
+        """Test estimating the metadata from the planner statistics."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 AS
+           SELECT
+               i AS c_int,
+               CASE WHEN mod(i, 10) > 0 THEN i::TEXT END AS c_num,
+               DATE '2019-01-01' + i AS c_date,
+               chr(97 + mod(i, 3)) AS c_code,
+               md5(i::TEXT) AS c_text
+           FROM generate_series(1, 1000) AS i;
+        """)
+
+        def process_table(**kwargs):
+            with patch('metabase.extract_metadata.settings',
+                       self.mock_params):
+                extract = extract_metadata.ExtractMetadata(data_table_id=1)
+            extract.process_table(categorical_threshold=5, **kwargs)
+
+            return [tuple(r) for r in self.engine.execute("""
+                SELECT column_name, data_type, null_count, estimated
+                FROM metabase.column_info
+                ORDER BY column_name
+            """)]
+
+        expected_columns = [
+            ('c_code', 'code', 0),
+            ('c_date', 'date', 0),
+            ('c_int', 'numeric', 0),
+            ('c_num', 'numeric', 100),
+            ('c_text', 'text', 0),
+        ]
+        assert [column + (True,) for column in expected_columns] == (
+            process_table(statistics_only=True))
+        assert (1000, True) == tuple(self.engine.execute(
+            'SELECT number_rows, number_rows_estimated '
+            'FROM metabase.data_table').fetchone())
+
+        # ANALYZE reads the whole small table, so extremes are exact.
+        numeric_rows = self.engine.execute("""
+            SELECT column_name, minimum, maximum, mean, median
+            FROM metabase.numeric_column
+            ORDER BY column_name
+        """).fetchall()
+        assert [('c_int', 1, 1000), ('c_num', 1, 999)] == [
+            tuple(r[:3]) for r in numeric_rows]
+        for row in numeric_rows:
+            assert 450 < row['mean'] < 550
+            assert 450 < row['median'] < 550
+        assert (datetime.date(2019, 1, 2), datetime.date(2021, 9, 27)) == (
+            tuple(self.engine.execute(
+                'SELECT min_date, max_date FROM metabase.date_column'
+            ).fetchone()))
+        assert [('a', 333), ('b', 334), ('c', 333)] == [
+            tuple(r) for r in self.engine.execute(
+                'SELECT code, frequency FROM metabase.code_frequency '
+                'ORDER BY code')]
+        assert 0 == self.engine.execute(
+            'SELECT COUNT(*) FROM metabase.text_column').fetchone()[0]
+        assert 0 == self.engine.execute(
+            'SELECT COUNT(*) FROM metabase.table_watermark').fetchone()[0]
+
+        # The estimated metadata does not make the table look profiled.
+        assert [column + (False,) for column in expected_columns] == (
+            process_table(skip_unchanged=True))
+
+    def test_connection_provider_different_databases(self):
+        """Test that different connection strings get their own pools."""
+
+        provider = connection_pool.ConnectionProvider(
+            self.connection_string,
+            self.connection_string + '?application_name=data',
+            max_connections=1,
+        )
+
+        metabase_conn, data_conn = provider.get_connections()
+        assert metabase_conn is not data_conn
+
+        with pytest.raises(psycopg2.pool.PoolError):
+            provider.get_connections()
+
+        provider.put_connections(metabase_conn, data_conn)
+        assert (metabase_conn, data_conn) == provider.get_connections()
+
+        provider.close()
+
+    def test_process_tables(self):
+        """Test processing several tables with a pool of workers."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1'), (2, 'data.table_2'),
+           (3, 'data.missing');
+
+           CREATE TABLE data.table_1 (c_num INT);
+           INSERT INTO data.table_1 (c_num) VALUES (1), (2), (3);
+
+           CREATE TABLE data.table_2 (c_text TEXT);
+           INSERT INTO data.table_2 (c_text) VALUES ('abc'), ('de'), ('f');
+        """)
+
+        try:
+            with patch('metabase.connection_pool.settings', self.mock_params):
+                results = batch.process_tables([1, 2, 3, 4], workers=2,
+                                               categorical_threshold=2)
+        finally:
+            self.engine.execute('DROP TABLE data.table_2')
+
+        assert [1, 2, 3, 4] == [r.data_table_id for r in results]
+        assert [True, True, False, False] == [r.success for r in results]
+        assert isinstance(results[2].error, psycopg2.ProgrammingError)
+        assert isinstance(results[3].error, ValueError)
+        assert all(r.seconds > 0 for r in results)
+        assert isinstance(results[0].commit_latency, float)
+        assert [('c_num', 'numeric'), ('c_text', 'text')] == [
+            tuple(r) for r in self.engine.execute("""
+                SELECT column_name, data_type
+                FROM metabase.column_info
+                ORDER BY column_name
+            """).fetchall()]
+
+    def test_process_tables_workers(self):
+        """Test that CPU bound options run workers in processes."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1'), (2, 'data.missing');
+
+           CREATE TABLE data.table_1 (c_num INT);
+           INSERT INTO data.table_1 (c_num) VALUES (1), (2), (3);
+        """)
+
+        for kwargs, executor in [
+                ({}, 'ProcessPoolExecutor'),
+                ({'exact_quantiles': True}, 'ThreadPoolExecutor'),
+                ({'processes': False}, 'ThreadPoolExecutor'),
+        ]:
+            with patch('metabase.batch.' + executor,
+                       wraps=getattr(batch, executor)) as pool:
+                results = batch.process_tables(
+                    [1, 2],
+                    workers=2,
+                    metabase_connection_string=self.connection_string,
+                    data_connection_string=self.connection_string,
+                    **kwargs
+                )
+
+            assert pool.called
+            assert [True, False] == [r.success for r in results]
+            assert isinstance(results[1].error, psycopg2.ProgrammingError)
+            assert [(1, 3)] == [
+                tuple(r) for r in self.engine.execute("""
+                    SELECT minimum, maximum FROM metabase.numeric_column
+                """).fetchall()]
+
+    def test_process_table_column_workers(self):
+        """Test profiling columns on several connections in a snapshot."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 AS
+           SELECT
+               i AS c_num,
+               repeat('x', i) AS c_text,
+               DATE '2018-01-01' + i AS c_date,
+               chr(97 + mod(i, 3)) AS c_code,
+               CASE WHEN i = 7 THEN '2018-02-30' ELSE '2018-01-01' END
+                   AS c_bad_date
+           FROM generate_series(1, 20) AS i;
+        """)
+
+        queries = {
+            'column_info': 'SELECT column_name, data_type, null_count '
+                           'FROM metabase.column_info',
+            'numeric_column': 'SELECT column_name, minimum, maximum, median '
+                              'FROM metabase.numeric_column',
+            'text_column': 'SELECT column_name, max_length, median_length '
+                           'FROM metabase.text_column',
+            'date_column': 'SELECT column_name, min_date, max_date '
+                           'FROM metabase.date_column',
+            'code_frequency': 'SELECT column_name, code, frequency '
+                              'FROM metabase.code_frequency',
+        }
+
+        results = []
+        for column_workers in [1, 3]:
+            with patch('metabase.extract_metadata.settings',
+                       self.mock_params):
+                extract = extract_metadata.ExtractMetadata(data_table_id=1)
+
+            with patch('metabase.extract_metadata.extract_metadata_helper'
+                       '.has_try_cast_functions', return_value=False):
+                extract.process_table(categorical_threshold=3,
+                                      column_workers=column_workers)
+
+            assert extract.snapshot_id is None
+            results.append({
+                table: sorted(tuple(r) for r in
+                              self.engine.execute(query).fetchall())
+                for table, query in queries.items()
+            })
+
+        assert results[0] == results[1]
+        assert ('c_bad_date', 'code', 0) in results[1]['column_info']
+        assert 5 == len(results[1]['column_info'])
+
+    def test_async_process_tables(self):
+        """Test that the async engine writes the same rows as the sync one."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1'), (2, 'data.table_2'),
+           (3, 'data.missing');
+
+           CREATE TABLE data.table_1 AS
+           SELECT
+               i AS c_num,
+               (i * 1.5)::TEXT AS c_num_text,
+               repeat('x', i) AS c_text,
+               DATE '2018-01-01' + i AS c_date,
+               chr(97 + mod(i, 3)) AS c_code,
+               CASE WHEN i = 7 THEN '2018-02-30' ELSE '2018-01-01' END
+                   AS c_bad_date
+           FROM generate_series(1, 20) AS i;
+
+           CREATE TABLE data.table_2 (c_text TEXT);
+           INSERT INTO data.table_2 (c_text) VALUES ('abc'), ('de'), (NULL);
+        """)
+
+        def metabase_rows():
+            """Return the rows of the metabase, without update times."""
+
+            return {
+                table: sorted(
+                    r[0] for r in self.engine.execute(
+                        "SELECT (to_jsonb(t) - 'date_last_updated')::TEXT "
+                        "FROM metabase.{} AS t".format(table)
+                    ).fetchall())
+                for table in ['data_table', 'column_info', 'numeric_column',
+                              'text_column', 'date_column', 'code_frequency',
+                              'table_watermark']
+            }
+
+        # Without the try cast functions, c_bad_date fails to cast and is
+        # inferred again.
+        try:
+            with patch('metabase.extract_metadata_helper'
+                       '.TRY_CAST_FUNCTIONS_QUERY', 'SELECT FALSE'):
+                for data_table_id in [1, 2]:
+                    with patch('metabase.extract_metadata.settings',
+                               self.mock_params):
+                        extract = extract_metadata.ExtractMetadata(
+                            data_table_id)
+                    extract.process_table(categorical_threshold=3)
+                sync_rows = metabase_rows()
+
+                self.engine.execute(
+                    'TRUNCATE TABLE metabase.column_info CASCADE; '
+                    'UPDATE metabase.data_table SET number_rows = NULL')
+
+                loop = asyncio.new_event_loop()
+                try:
+                    results = loop.run_until_complete(
+                        async_extract_metadata.process_tables(
+                            [1, 2, 3],
+                            concurrency=2,
+                            metabase_connection_string=self.connection_string,
+                            data_connection_string=self.connection_string,
+                            categorical_threshold=3,
+                        ))
+                finally:
+                    loop.close()
+                async_rows = metabase_rows()
+        finally:
+            self.engine.execute('DROP TABLE data.table_2')
+
+        assert [1, 2, 3] == [r.data_table_id for r in results]
+        assert [True, True, False] == [r.success for r in results]
+        assert isinstance(results[2].error, psycopg2.ProgrammingError)
+        assert isinstance(results[0].commit_latency, float)
+        assert sync_rows == async_rows
+        assert 7 == len(async_rows['column_info'])
+        assert any('"c_bad_date"' in row and '"code"' in row
+                   for row in async_rows['column_info'])
+
+    def test_async_process_tables_sketches_and_statistics(self):
+        """Test the async engine with sketches and with statistics only."""
+
+        self.engine.execute("""
+           INSERT INTO metabase.data_table (data_table_id, file_table_name)
+           VALUES (1, 'data.table_1');
+
+           CREATE TABLE data.table_1 AS
+           SELECT
+               i AS c_id,
+               (i * 1.5)::TEXT AS c_num_text,
+               repeat('x', i) AS c_text,
+               chr(97 + mod(i, 3)) AS c_code
+           FROM generate_series(1, 20) AS i;
+        """)
+
+        def metabase_rows():
+            """Return the rows of the metabase, without update times."""
+
+            return {
+                table: sorted(
+                    r[0] for r in self.engine.execute(
+                        "SELECT (to_jsonb(t) - 'date_last_updated')::TEXT "
+                        "FROM metabase.{} AS t".format(table)
+                    ).fetchall())
+                for table in ['data_table', 'column_info', 'numeric_column',
+                              'text_column', 'code_frequency',
+                              'column_sketch', 'table_watermark']
+            }
+
+        def clear_metabase():
+            self.engine.execute(
+                'TRUNCATE TABLE metabase.column_info, '
+                'metabase.table_watermark CASCADE; '
+                'UPDATE metabase.data_table SET number_rows = NULL')
+
+        def process_async(**kwargs):
+            loop = asyncio.new_event_loop()
+            try:
+                (result,) = loop.run_until_complete(
+                    async_extract_metadata.process_tables(
+                        [1],
+                        metabase_connection_string=self.connection_string,
+                        data_connection_string=self.connection_string,
+                        **kwargs
+                    ))
+            finally:
+                loop.close()
+            assert result.success, result.error
+            return metabase_rows()
+
+        for kwargs in [
+                {'store_sketches': True, 'id_column': 'c_id'},
+                {'statistics_only': True},
+        ]:
+            with patch('metabase.extract_metadata.settings',
+                       self.mock_params):
+                extract = extract_metadata.ExtractMetadata(1)
+            extract.process_table(categorical_threshold=3, **kwargs)
+            sync_rows = metabase_rows()
+            clear_metabase()
+
+            assert sync_rows == process_async(categorical_threshold=3,
+                                              **kwargs)
+            clear_metabase()
+
+        assert 4 == len(sync_rows['column_info'])
+        assert all('"estimated": true' in row
+                   for row in sync_rows['column_info'])
+
+        # The sketches of the first run feed process_appended_rows.
+        process_async(categorical_threshold=3, store_sketches=True,
+                      id_column='c_id')
+        self.engine.execute("""
+           INSERT INTO data.table_1 (c_id, c_num_text, c_text, c_code)
+           VALUES (21, '31.5', 'y', 'a');
+        """)
+        with patch('metabase.extract_metadata.settings', self.mock_params):
+            extract = extract_metadata.ExtractMetadata(1)
+        extract.process_appended_rows(id_column='c_id')
+
+        assert (21, 21) == self.engine.execute("""
+            SELECT
+                (SELECT number_rows FROM metabase.data_table),
+                (SELECT SUM(frequency) FROM metabase.code_frequency)
+        """).fetchone()
@@ -0,0 +1,128 @@
+"""Tests for sketches.py"""
+
+import decimal
+import hashlib
+import json
+import math
+import random
+
+import pytest
+
+from metabase.sketches import HyperLogLog, KllSketch, weighted_quantiles
+
+
+def hll_of(values, precision=8):
+    """Return a HyperLogLog sketch of values, hashed to 32 bits."""
+
+    sketch = HyperLogLog(precision)
+    n_rank_bits = 32 - precision
+    for value in values:
+        digest = hashlib.md5(str(value).encode()).digest()
+        hash_value = int.from_bytes(digest[:4], 'big')
+        remaining = (hash_value >> precision) & ((1 << n_rank_bits) - 1)
+        rank = n_rank_bits - remaining.bit_length() + 1
+        sketch.update_register(hash_value & (sketch.n_registers - 1), rank)
+    return sketch
+
+
+def test_hyperloglog_empty():
+    assert 0 == HyperLogLog().estimate()
+
+
+@pytest.mark.parametrize('n_distinct', [10, 1000, 100000])
+def test_hyperloglog_estimate_within_error(n_distinct):
+    sketch = hll_of(range(n_distinct))
+
+    error = abs(sketch.estimate() - n_distinct) / n_distinct
+
+    assert error < 3 * sketch.relative_error
+
+
+def test_hyperloglog_ignores_duplicates():
+    assert (hll_of(range(1000)).registers
+            == hll_of(list(range(1000)) * 3).registers)
+
+
+def test_hyperloglog_merge():
+    sketch = hll_of(range(0, 6000))
+    sketch.merge(hll_of(range(4000, 10000)))
+
+    assert sketch.registers == hll_of(range(10000)).registers
+
+
+def test_hyperloglog_merge_different_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(8).merge(HyperLogLog(10))
+
+
+def kll_of(values, k=200):
+    """Return a KLL sketch of values."""
+
+    sketch = KllSketch(k)
+    for value in values:
+        sketch.update(value)
+    return sketch
+
+
+def test_kll_empty():
+    assert [None, None] == KllSketch().quantiles([0.5, 0.9])
+
+
+def test_kll_small_input_is_exact():
+    sketch = kll_of([3, 1, 2])
+
+    assert [1.0, 1.5, 2.0, 3.0] == sketch.quantiles([0, 0.25, 0.5, 1])
+
+
+def test_kll_rank_error():
+    random.seed(0)
+    values = [random.random() for _ in range(100000)]
+    sketch = kll_of(values)
+    values.sort()
+
+    for fraction, estimate in zip([0.01, 0.25, 0.5, 0.75, 0.99],
+                                  sketch.quantiles([0.01, 0.25, 0.5, 0.75,
+                                                    0.99])):
+        rank = sum(1 for value in values if value <= estimate) / len(values)
+        assert abs(rank - fraction) < 0.02
+
+    assert sketch.size < sketch.max_size
+
+
+def test_kll_merge():
+    random.seed(0)
+    sketch = kll_of(range(0, 50000))
+    sketch.merge(kll_of(range(50000, 100000)))
+
+    assert 100000 == sketch.n
+    assert abs(sketch.quantiles([0.5])[0] - 50000) < 2000
+
+
+def test_kll_dict_round_trip():
+    random.seed(0)
+    sketch = kll_of(range(10000))
+    copy = KllSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+
+    assert sketch.n == copy.n
+    assert sketch.quantiles([0.1, 0.5, 0.9]) == copy.quantiles(
+        [0.1, 0.5, 0.9])
+
+    copy.merge(kll_of(range(10000, 20000)))
+    assert 20000 == copy.n
+    assert abs(copy.quantiles([0.5])[0] - 10000) < 500
+
+
+def test_weighted_quantiles():
+    assert ([1.0, 1.0, 2.0, 3.0]
+            == weighted_quantiles([(3, 1), (1, 2)], [0, 0.5, 0.75, 1]))
+    assert [None] == weighted_quantiles([], [0.5])
+
+
+def test_weighted_quantiles_nan_last():
+    # PostgreSQL orders NaN after every other number, infinity included.
+    weighted = [(decimal.Decimal('NaN'), 1), (decimal.Decimal('Infinity'), 1),
+                (decimal.Decimal('-1.5'), 2)]
+
+    quantiles = weighted_quantiles(weighted, [0, 1 / 3, 0.5, 2 / 3, 1])
+    assert [-1.5, -1.5, float('inf'), float('inf')] == quantiles[:4]
+    assert math.isnan(quantiles[4])